@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Build the similarity search dataset of a FASTA file on the CPU: embed every sequence with ESM-2 across a pool of
+processes, then write the Hugging Face dataset, the exact faiss index and the hit store the service loads.
+
+python llm_homology_api/src/build_index.py uniprot_sprot.fasta.gz /scratch/sprot/sprot_esm_650m_faiss \
+    --model facebook/esm2_t33_650M_UR50D
+
+Run from the repository root as a script, its directory is on the import path, so no PYTHONPATH is needed.
+
+The FASTA file is streamed in shards of --shard-size sequences. Each shard is sorted by length and cut into batches
+of at most --max-tokens padded tokens, which the worker processes embed in parallel. Finished shards are written to
+the work directory (<output>.shards by default), so running the same command again after a crash resumes with the
+first unfinished shard. Once every shard is embedded, the outputs are written next to each other:
+- <output>: the dataset with tags and embeddings columns, the MODEL_DIR of the service
+- <output>.index: the exact inner product faiss index of the dataset
+- <output>.hitstore: the hit store (HIT_STORE_DIR)
+- <output>.indexes: the approximate indexes of --index-engines (INDEX_DIR)
+- <output>.sequences: the exact sequence index, so queries already in the database skip the model (SEQUENCE_INDEX_DIR)
+- <output>.manifest.json: how the dataset was built
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from dependencies.embedding_cache import normalize_sequence
+from dependencies.fasta import iter_chunks, read_fasta
+from dependencies.hit_store import HitStore
+from dependencies.index_engines import FaissIndex
+from dependencies.sequence_index import SequenceIndex, sequence_digests
+from dependencies.windowing import embed_windowed, length_sorted_batches
+
+BUILD_FILE = "build.json"
+
+# The embedder of the current process, set by init_worker
+_embedder = None
+_window = (0, 0)
+
+
+def esm2_embedder(model_name: str, local_model_dir: str, engine: str):
+    """Load the lean Esm2Embedder of a worker process"""
+    from dependencies.embedder import Esm2Embedder
+
+    return Esm2Embedder(
+        local_model_dir=local_model_dir, model_name=model_name, half_precision=False, lean=True, engine=engine
+    )
+
+
+def init_worker(embedder_factory, threads: int, window_size: int, window_overlap: int):
+    """
+    Load the embedder once per worker process
+    :param embedder_factory: Returns an object with an embed_pooled method, e.g. a partial of esm2_embedder
+    :param threads: The number of torch threads of the process
+    :param window_size: Longer sequences are embedded as overlapping windows, 0 to never split
+    :param window_overlap: The number of residues shared by consecutive windows
+    """
+    global _embedder, _window
+    # The build runs on the CPU; several processes sharing one GPU would only fight over it
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _embedder = embedder_factory()
+    _window = (window_size, window_overlap)
+
+
+def embed_batch(sequences: list[str]) -> np.ndarray:
+    """Embed a batch with the embedder of this process, as queries are embedded by the service"""
+    return embed_windowed(_embedder.embed_pooled, sequences, *_window)
+
+
+def shard_paths(work_dir: Path, shard: int) -> tuple[Path, Path]:
+    """The embeddings and tags files of a shard"""
+    return work_dir / f"shard_{shard:05d}.npy", work_dir / f"shard_{shard:05d}.tags.json"
+
+
+def sequences_path(work_dir: Path, shard: int) -> Path:
+    """The sequence digests and embedding norms of a shard, see SequenceIndex"""
+    return work_dir / f"shard_{shard:05d}.sequences.npz"
+
+
+def write_shard(
+    work_dir: Path, shard: int, tags: list[str], embeddings: np.ndarray, digests: np.ndarray, norms: np.ndarray
+):
+    """Write a finished shard. The embeddings are renamed into place last, their presence marks the shard done."""
+    embeddings_path, tags_path = shard_paths(work_dir, shard)
+    tmp_embeddings_path = embeddings_path.with_name(f"{embeddings_path.name}.tmp.npy")
+    tmp_tags_path = tags_path.with_name(f"{tags_path.name}.tmp")
+    tmp_sequences_path = sequences_path(work_dir, shard).with_suffix(".tmp.npz")
+    with open(tmp_tags_path, "w") as f:
+        json.dump(tags, f)
+    np.savez(tmp_sequences_path, digests=digests, norms=norms)
+    np.save(tmp_embeddings_path, embeddings)
+    os.replace(tmp_tags_path, tags_path)
+    os.replace(tmp_sequences_path, sequences_path(work_dir, shard))
+    os.replace(tmp_embeddings_path, embeddings_path)
+
+
+def read_shard(work_dir: Path, shard: int) -> tuple[list[str], np.ndarray]:
+    embeddings_path, tags_path = shard_paths(work_dir, shard)
+    with open(tags_path) as f:
+        tags = json.load(f)
+    return tags, np.load(embeddings_path, mmap_mode="r")
+
+
+def check_build(work_dir: Path, build: dict):
+    """Record the build settings in the work directory, refusing to resume shards written with other settings"""
+    build_path = work_dir / BUILD_FILE
+    if build_path.exists():
+        with open(build_path) as f:
+            previous = json.load(f)
+        if previous != build:
+            changed = sorted(key for key in build.keys() | previous.keys() if build.get(key) != previous.get(key))
+            raise SystemExit(
+                f"{work_dir} holds shards built with different {', '.join(changed)}; "
+                "remove it or choose another --work-dir"
+            )
+        return
+    work_dir.mkdir(parents=True, exist_ok=True)
+    with open(build_path, "w") as f:
+        json.dump(build, f, indent=2)
+
+
+def build_shards(
+    fasta: str | Path,
+    work_dir: str | Path,
+    embedder_factory,
+    embedder_name: str,
+    workers: int = 1,
+    threads_per_worker: int = 1,
+    shard_size: int = 100000,
+    max_tokens: int = 16384,
+    window_size: int = 0,
+    window_overlap: int = 0,
+    dtype: str = "float16",
+    normalize: bool = True,
+) -> int:
+    """
+    Embed every sequence of a FASTA file into shards in work_dir, skipping the shards already there
+    :param fasta: The FASTA file, plain or gzip compressed
+    :param work_dir: Where the shards and their checkpoints are written
+    :param embedder_factory: Returns the embedder of a worker process, see init_worker
+    :param embedder_name: Identifies the embedder, shards embedded by another one are never resumed
+    :param workers: The number of worker processes, 0 to embed in this process
+    :param threads_per_worker: The number of torch threads of each worker
+    :param shard_size: The number of sequences per shard
+    :param max_tokens: The most padded tokens in a batch, see length_sorted_batches
+    :param window_size: Longer sequences are embedded as overlapping windows, 0 to never split
+    :param window_overlap: The number of residues shared by consecutive windows
+    :param dtype: The dtype the embeddings are stored in
+    :param normalize: Whether to store unit vectors, so inner product scores are cosine similarities
+    :return: The number of shards
+    """
+    work_dir = Path(work_dir)
+    fasta = Path(fasta)
+    check_build(
+        work_dir,
+        {
+            "fasta": str(fasta.resolve()),
+            "fasta_bytes": fasta.stat().st_size,
+            "embedder": embedder_name,
+            "shard_size": shard_size,
+            "window_size": window_size,
+            "window_overlap": window_overlap,
+            "dtype": dtype,
+            "normalize": normalize,
+        },
+    )
+    worker_args = (embedder_factory, threads_per_worker, window_size, window_overlap)
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=worker_args)
+        map_batches = functools.partial(executor.map, embed_batch)
+    else:
+        executor = None
+        init_worker(*worker_args)
+        map_batches = functools.partial(map, embed_batch)
+
+    num_shards = embedded = 0
+    start = time.perf_counter()
+    try:
+        for shard, (tags, sequences) in enumerate(iter_chunks(read_fasta(fasta), shard_size)):
+            num_shards = shard + 1
+            if shard_paths(work_dir, shard)[0].exists():
+                logging.info(f"Shard {shard} is already embedded")
+                continue
+            # Embedded and hashed as the queries are, whatever the case of the FASTA file
+            sequences = [normalize_sequence(sequence) for sequence in sequences]
+            batches = length_sorted_batches(sequences, max_tokens, window_size, window_overlap)
+            embeddings = None
+            batch_sequences = ([sequences[i] for i in batch] for batch in batches)
+            for batch, batch_embeddings in zip(batches, map_batches(batch_sequences)):
+                if embeddings is None:
+                    embeddings = np.empty((len(sequences), batch_embeddings.shape[1]), dtype=np.float32)
+                embeddings[batch] = batch_embeddings
+            norms = np.ones(len(sequences), dtype=np.float32)
+            if normalize:
+                norms = np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)
+                embeddings /= norms[:, None]
+            write_shard(work_dir, shard, tags, embeddings.astype(dtype), sequence_digests(sequences), norms)
+            embedded += len(sequences)
+            elapsed = time.perf_counter() - start
+            logging.info(f"Embedded shard {shard}: {embedded} sequences in {elapsed:.0f}s, {embedded / elapsed:.1f}/s")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return num_shards
+
+
+def write_flat_index(hit_store: HitStore, index_path: str | Path, chunk_size: int = 65536):
+    """Write the exact inner product index loaded by the SimilaritySearch alongside the dataset"""
+    import faiss
+
+    index = faiss.IndexFlatIP(hit_store.embeddings.shape[1])
+    for start in range(0, len(hit_store), chunk_size):
+        index.add(np.array(hit_store.embeddings[start : start + chunk_size], dtype=np.float32, order="C"))
+    faiss.write_index(index, str(index_path))
+
+
+def write_dataset(work_dir: Path, num_shards: int, output: Path, dtype: str):
+    """
+    Write the tags and embeddings columns of the shards as a Hugging Face dataset. The shards are appended to one
+    Arrow stream that the dataset memory-maps while saving, so the database is never held in memory.
+    """
+    import pyarrow as pa
+    from datasets import Dataset, DatasetInfo, Features, Sequence, Value
+
+    features = Features({"tags": Value("string"), "embeddings": Sequence(Value(dtype))})
+    arrow_path = work_dir / "dataset.arrow"
+    with pa.OSFile(str(arrow_path), "wb") as sink, pa.ipc.new_stream(sink, features.arrow_schema) as writer:
+        for shard in range(num_shards):
+            tags, embeddings = read_shard(work_dir, shard)
+            num_rows, dim = embeddings.shape
+            offsets = pa.array(np.arange(0, num_rows * dim + 1, dim, dtype=np.int32))
+            embeddings_column = pa.ListArray.from_arrays(offsets, pa.array(np.ravel(embeddings)))
+            writer.write_table(
+                pa.Table.from_arrays([pa.array(tags, pa.string()), embeddings_column], schema=features.arrow_schema)
+            )
+    Dataset.from_file(str(arrow_path), info=DatasetInfo(features=features)).save_to_disk(str(output))
+    arrow_path.unlink()
+
+
+def write_sequence_index(work_dir: Path, num_shards: int, index_dir: Path, num_rows: int) -> bool:
+    """
+    Write the sequence index of the shards, see SequenceIndex
+    :return: Whether it was written, shards embedded before sequence indexes were recorded have none
+    """
+    missing = [shard for shard in range(num_shards) if not sequences_path(work_dir, shard).exists()]
+    if missing:
+        logging.warning(f"Shards {missing} have no sequence digests, not writing the sequence index")
+        return False
+    with open(work_dir / BUILD_FILE) as f:
+        build = json.load(f)
+
+    def chunks():
+        for shard in range(num_shards):
+            with np.load(sequences_path(work_dir, shard)) as shard_sequences:
+                yield shard_sequences["digests"], shard_sequences["norms"]
+
+    SequenceIndex.write(
+        index_dir,
+        chunks(),
+        num_rows,
+        embedder=build["embedder"],
+        window_size=build["window_size"],
+        window_overlap=build["window_overlap"],
+        normalized=build["normalize"],
+    )
+    return True
+
+
+def assemble(
+    work_dir: str | Path, output: str | Path, num_shards: int, dtype: str, index_engines=(), **index_kwargs
+) -> dict:
+    """
+    Write the outputs of the build from the shards, replacing those of a previous build
+    :param work_dir: The directory holding every shard
+    :param output: The dataset directory, the other outputs are written next to it
+    :param num_shards: The number of shards
+    :param dtype: The dtype the embeddings are stored in
+    :param index_engines: The approximate index engines to build, see FaissIndex
+    :param index_kwargs: The build settings of the approximate indexes
+    :return: The paths of the outputs
+    """
+    work_dir, output = Path(work_dir), Path(output)
+    outputs = {
+        "dataset": output,
+        "flat_index": Path(f"{output}.index"),
+        "hit_store": Path(f"{output}.hitstore"),
+        "index_dir": Path(f"{output}.indexes"),
+        "sequence_index": Path(f"{output}.sequences"),
+    }
+    for path in outputs.values():
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+    shard_rows = [len(read_shard(work_dir, shard)[0]) for shard in range(num_shards)]
+    dim = read_shard(work_dir, 0)[1].shape[1]
+    logging.info(f"Writing the hit store of {sum(shard_rows)} sequences")
+    hit_store = HitStore.write(
+        outputs["hit_store"],
+        (read_shard(work_dir, shard) for shard in range(num_shards)),
+        num_rows=sum(shard_rows),
+        dim=dim,
+        dtype=dtype,
+        source=str(output),
+    )
+    logging.info(f"Writing the dataset {output}")
+    write_dataset(work_dir, num_shards, output, dtype)
+    logging.info(f"Writing the flat index {outputs['flat_index']}")
+    write_flat_index(hit_store, outputs["flat_index"])
+    for engine in index_engines:
+        FaissIndex.open_or_build(hit_store, outputs["index_dir"], engine, **index_kwargs)
+    logging.info(f"Writing the sequence index {outputs['sequence_index']}")
+    if not write_sequence_index(work_dir, num_shards, outputs["sequence_index"], len(hit_store)):
+        del outputs["sequence_index"]
+    # Absolute paths, so the manifest can be listed in the INDEX_SHARDS manifest of a service started elsewhere
+    return {key: str(path.resolve()) for key, path in outputs.items()} | {"num_rows": len(hit_store), "dim": dim}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fasta", help="The FASTA file to embed, plain or gzip compressed")
+    parser.add_argument("output", help="The dataset directory to write, the MODEL_DIR of the service")
+    parser.add_argument("--model", default="facebook/esm2_t33_650M_UR50D", help="The ESM-2 checkpoint")
+    parser.add_argument("--engine", choices=["torch", "int8", "onnx"], default="torch", help="See Esm2Embedder")
+    parser.add_argument("--local-model-dir", default="local_models")
+    parser.add_argument("--threads-per-worker", type=int, default=4)
+    parser.add_argument("--workers", type=int, help="Worker processes, defaults to the cores / --threads-per-worker")
+    parser.add_argument("--shard-size", type=int, default=100000, help="Sequences per shard (and checkpoint)")
+    parser.add_argument("--max-tokens", type=int, default=16384, help="Padded tokens per batch")
+    parser.add_argument("--window-size", type=int, default=1022, help="As LONG_SEQUENCE_WINDOW of the service")
+    parser.add_argument("--window-overlap", type=int, default=256, help="As LONG_SEQUENCE_OVERLAP of the service")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--no-normalize", action="store_true", help="Store the embeddings as they are pooled")
+    parser.add_argument("--work-dir", help="Where the shards are written, defaults to <output>.shards")
+    parser.add_argument("--keep-shards", action="store_true", help="Keep the work directory once the build is done")
+    parser.add_argument("--index-engines", nargs="*", choices=["ivf", "ivfpq", "hnsw"], default=[])
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--pq-nbits", type=int, default=8)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    output = Path(args.output)
+    work_dir = Path(args.work_dir or f"{output}.shards")
+    workers = args.workers if args.workers is not None else max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+    start = time.perf_counter()
+    num_shards = build_shards(
+        args.fasta,
+        work_dir,
+        functools.partial(esm2_embedder, args.model, args.local_model_dir, args.engine),
+        f"{args.model} ({args.engine})",
+        workers=workers,
+        threads_per_worker=args.threads_per_worker,
+        shard_size=args.shard_size,
+        max_tokens=args.max_tokens,
+        window_size=args.window_size,
+        window_overlap=args.window_overlap,
+        dtype=args.dtype,
+        normalize=not args.no_normalize,
+    )
+    if not num_shards:
+        raise SystemExit(f"{args.fasta} holds no sequences")
+    outputs = assemble(
+        work_dir,
+        output,
+        num_shards,
+        args.dtype,
+        index_engines=args.index_engines,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        pq_nbits=args.pq_nbits,
+        hnsw_m=args.hnsw_m,
+    )
+    manifest = {
+        "fasta": str(Path(args.fasta).resolve()),
+        "model": args.model,
+        "engine": args.engine,
+        "dtype": args.dtype,
+        "normalized": not args.no_normalize,
+        "window_size": args.window_size,
+        "window_overlap": args.window_overlap,
+        "index_engines": args.index_engines,
+        "shards": num_shards,
+        "build_seconds": round(time.perf_counter() - start, 1),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    } | outputs
+    with open(f"{output}.manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    if not args.keep_shards:
+        shutil.rmtree(work_dir)
+    logging.info(f"Built {output} from {outputs['num_rows']} sequences in {manifest['build_seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
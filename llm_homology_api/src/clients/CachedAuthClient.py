@@ -1,6 +1,9 @@
+import asyncio
+import functools
+import logging
 from functools import cached_property
 
-import requests
+import aiohttp
 from cacheout import LRUCache
 from fastapi import HTTPException
 
@@ -21,56 +24,115 @@ class UserAuthRoles:
 
 
 class CachedAuthClient:
+    """
+    Validates tokens against the KBase auth service and caches the results.
+
+    - Requests go through one aiohttp session, so connections to the auth service are pooled and kept alive
+    - Concurrent lookups of a token that is not cached share a single call to the auth service
+    - Tokens rejected by the auth service are remembered for a short time, so retries do not reach it again
+    - A cached token that is about to expire is still served while it is revalidated in the background
+    """
+
     def __init__(
         self,
         valid_tokens_cache: LRUCache = None,
         auth_url: str = None,
         admin_roles: list[str] = None,
+        invalid_tokens_cache: LRUCache = None,
+        refresh_ahead_seconds: float = 2,
+        timeout_seconds: float = 10,
+        max_connections: int = 100,
     ):
         """
         Initialize the CachedAuthClient
         :param valid_tokens_cache: The cache to use for valid tokens
         :param auth_url: KBases auth service URL
         :param admin_roles: A list of roles that are considered admin roles
+        :param invalid_tokens_cache: The cache to use for tokens the auth service rejected
+        :param refresh_ahead_seconds: Revalidate a cached token in the background once it expires in less than this
+        :param timeout_seconds: The timeout of a call to the auth service
+        :param max_connections: The size of the connection pool to the auth service
         """
-        if not valid_tokens_cache:
-            self.valid_tokens = LRUCache(ttl=10)
-        self.valid_tokens = valid_tokens_cache
+        # An empty cache is falsy, so compare with None
+        self.valid_tokens = valid_tokens_cache if valid_tokens_cache is not None else LRUCache(ttl=10)
+        self.invalid_tokens = invalid_tokens_cache if invalid_tokens_cache is not None else LRUCache(ttl=2)
         self.auth_url = auth_url
         self.admin_roles = admin_roles
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_connections = max_connections
+        self._session = None  # type: aiohttp.ClientSession | None
+        self._session_loop = None
+        self._in_flight = {}  # type: dict[str, asyncio.Task]
 
-    def is_authorized(self, token: str) -> bool:
+    async def is_authorized(self, token: str) -> bool:
         """
         A token is authorized if it is valid
         :param token:
         :return: True if the token is valid, False otherwise
         :raises: HTTPException if the token is invalid or the auth service is down
         """
-        return bool(self.get_user_auth_roles(token) is not None)
+        return bool(await self.get_user_auth_roles(token) is not None)
 
-    def is_admin(self, token: str) -> bool:
+    async def is_admin(self, token: str) -> bool:
         """
         A token is authorized if is valid and the user has an admin role
         :return: True if the token is valid, False otherwise
         :raises: HTTPException if the token is invalid or the auth service is down
         """
-        return self.get_user_auth_roles(token).is_admin
+        return (await self.get_user_auth_roles(token)).is_admin
 
-    def get_user_auth_roles(self, token: str) -> UserAuthRoles:
+    async def get_user_auth_roles(self, token: str) -> UserAuthRoles:
         """
         Get the user auth roles for the given token. If the token is not cached, it will be validated and cached.
         :param token:  The token to get the user auth roles for
         :return: The user auth roles for the given token
         :raises: HTTPException if the token is invalid, expired, or the auth service is down or the auth URL is incorrect
         """
-        key = token
-        user_auth_roles = self.valid_tokens.get(key=key, default=None)
-        if not user_auth_roles:
-            user_auth_roles = self._validate_token(token)
-            self.valid_tokens.set(key=token, value=user_auth_roles)
+        user_auth_roles = self.valid_tokens.get(key=token, default=None)
+        if user_auth_roles:
+            remaining_ttl = self.valid_tokens.get_ttl(token)
+            if remaining_ttl is not None and remaining_ttl < self.refresh_ahead_seconds:
+                self._validate_once(token)
+            return user_auth_roles
+
+        rejected = self.invalid_tokens.get(key=token, default=None)
+        if rejected:
+            raise HTTPException(status_code=rejected.status_code, detail=rejected.detail)
+
+        # Shielded so a cancelled request does not cancel the lookup other requests are waiting on
+        return await asyncio.shield(self._validate_once(token))
+
+    def _validate_once(self, token: str) -> asyncio.Task:
+        """Start validating the token, unless it is already being validated, and return the validation task"""
+        loop = asyncio.get_running_loop()
+        task = self._in_flight.get(token)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._validate_and_cache(token))
+            self._in_flight[token] = task
+            task.add_done_callback(functools.partial(self._validation_done, token))
+        return task
+
+    def _validation_done(self, token: str, task: asyncio.Task):
+        if self._in_flight.get(token) is task:
+            del self._in_flight[token]
+        # Background revalidations have no caller to raise to
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug(f"Token validation failed: {task.exception()}")
+
+    async def _validate_and_cache(self, token: str) -> UserAuthRoles:
+        try:
+            user_auth_roles = await self._validate_token(token)
+        except HTTPException as e:
+            # Only the auth service rejecting the token is remembered, not it being down or misconfigured
+            if 400 <= e.status_code < 500 and e.status_code != 404:
+                self.valid_tokens.delete(token)
+                self.invalid_tokens.set(key=token, value=e)
+            raise
+        self.valid_tokens.set(key=token, value=user_auth_roles)
         return user_auth_roles
 
-    def _validate_token(self, token: str) -> UserAuthRoles:
+    async def _validate_token(self, token: str) -> UserAuthRoles:
         """
         Will either return a UserAuthRoles object or throw an exception because the token is invalid, expired,
         or the auth service is down or the auth URL is incorrect
@@ -78,8 +140,7 @@ class CachedAuthClient:
         :return: A UserAuthRoles object representing the user and their auth roles
         :raises: HTTPException if the token is invalid, expired, or the auth service is down or the auth URL is incorrect
         """
-        # TODO Try catch validate errors, auth service URL is bad, etc
-        username, roles = self.validate_and_get_username_auth_roles(token)
+        username, roles = await self.validate_and_get_username_auth_roles(token)
         return UserAuthRoles(
             username=username,
             user_roles=roles,
@@ -87,7 +148,18 @@ class CachedAuthClient:
             token=token,
         )
 
-    def validate_and_get_username_auth_roles(self, token: str) -> tuple[str, list[str]]:
+    def _get_session(self) -> aiohttp.ClientSession:
+        """The pooled session of the running event loop (the loop changes between TestClient sessions)"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session_loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+            )
+        return self._session
+
+    async def validate_and_get_username_auth_roles(self, token: str) -> tuple[str, list[str]]:
         """
         This calls out the auth service to validate the token and get the username and auth roles
         :param token: The token to validate
@@ -95,18 +167,24 @@ class CachedAuthClient:
         :raises: HTTPException if the token is invalid, expired, or the auth service is down or the auth URL is incorrect
         """
         try:
-            response = requests.get(url=self.auth_url, headers={"Authorization": token})
+            async with self._get_session().get(url=self.auth_url, headers={"Authorization": token}) as response:
+                status = response.status
+                content = await response.json(content_type=None)
         except Exception:
             raise HTTPException(status_code=500, detail="Auth service is down or bad request")
-        if response.status_code == 200:
-            resonse = response.json()
-            if "customroles" not in response.json():
+        if status == 200:
+            if "customroles" not in content:
                 raise HTTPException(
                     status_code=404,
                     detail="Auth URL not configured correctly, no custom roles found (use /me)",
                 )
-            return resonse["user"], resonse["customroles"]
-        elif response.status_code == 404:
+            return content["user"], content["customroles"]
+        elif status == 404:
             raise HTTPException(status_code=404, detail="Auth URL not configured correctly")
         else:
-            raise HTTPException(status_code=response.status_code, detail=response.json()["error"])
+            raise HTTPException(status_code=status, detail=content["error"])
+
+    async def close(self):
+        """Close the connection pool, if it belongs to the running event loop"""
+        if self._session is not None and not self._session.closed and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
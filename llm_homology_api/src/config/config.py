@@ -11,12 +11,66 @@ class LLMHomologyApiSettings(BaseSettings):
     MAX_PROTEINS_PER_REQUEST: int = 500  # The maximum number of protein sequences allowed in a single request
 
     MAX_REQUEST_SIZE: int = 2805000  # Not yet implemented
+
+    BATCH_MAX_SIZE: int = 32  # The maximum number of queries, across requests, embedded and searched together
+    BATCH_MAX_WAIT_MS: float = 5.0  # How long to wait for more queries before running a partially filled batch
+    EMBED_TOKEN_BUDGET: int = 32768  # Padded tokens per GPU forward pass, learned at runtime; 0 for one pass per batch
+    EMBED_MAX_TOKEN_BUDGET: int = 131072  # The largest GPU token budget learned
+    EMBED_CPU_TOKEN_BUDGET: int = 1024  # Padded tokens per CPU forward pass, only lowered: larger passes are slower
+    MEMORY_LIMIT_BYTES: int = 0  # The resident set size forward passes keep a worker under, 0 for no limit
+    INFERENCE_WORKERS: int = 1  # The number of threads running model inference and index search
+    INFERENCE_MAX_QUEUED_QUERIES: int = 2000  # Queries allowed to wait for inference before /similarity returns 429
+    INFERENCE_RETRY_AFTER_SECONDS: int = 5  # The Retry-After sent with a 429 when the inference queue is full
+    USER_QUOTA_RESIDUES_PER_SECOND: float = 0  # The residues (plus hits) a user may search per second, 0 for no quota
+    USER_QUOTA_BURST_RESIDUES: int = 2500000  # The most residues a user may spend at once, a full request by default
+    HIT_COST_RESIDUES: float = 1.0  # The residues a requested hit costs, in user quotas and fair queueing
+    ADMIN_SCHEDULING_WEIGHT: float = 4.0  # The fair queueing share and quota rate of admins, relative to other users
+    STRICT_CALLER_AUTH: bool = False  # Refuse /similarity requests with an invalid token rather than run them anonymous
+    EMBEDDING_MODEL_NAME: str = "facebook/esm2_t33_650M_UR50D"  # The ESM-2 checkpoint used to embed queries
+    EMBEDDER_ENGINE: str = "torch"  # torch (GPU when available), or the CPU engines int8 (quantized) and onnx
+    LOCAL_MODEL_DIR: str = "local_models"  # Where the CPU engines keep the checkpoint and its ONNX export
+    MODEL_MMAP: bool = True  # Map the CPU torch engine weights from their safetensors file, shared by the workers
+    EMBEDDING_CACHE_MAX_BYTES: int = 268435456  # The total size of cached query embeddings (256 MiB)
+    LONG_SEQUENCE_WINDOW: int = 1022  # Longer sequences are embedded as overlapping windows (ESM-2 context); 0 disables
+    LONG_SEQUENCE_OVERLAP: int = 256  # The number of residues shared by consecutive windows of a long sequence
+    COMPRESSION_ENCODINGS: list = ["zstd", "br", "gzip"]  # Response encodings offered, preferred first, if installed
+    COMPRESSION_MIN_BYTES: int = 4096  # Smaller responses are sent uncompressed
+    MAX_DECOMPRESSED_REQUEST_BYTES: int = 268435456  # Compressed request bodies may decompress to at most 256 MiB
+    STREAM_CHUNK_SIZE: int = 32  # The number of queries searched and written at a time by /similarity/stream
+    SIMILARITY_LOG_MAX_ENTRIES: int = 10000  # The number of request summaries kept in memory for /logs/similarity
+    LOG_FILE: str = "nohup.out"  # The log file served by /logs
+    JOBS_DIR: str = "jobs"  # Where bulk jobs keep their input, state and gzipped results; unfinished jobs resume
+    JOBS_WORKERS: int = 1  # The number of bulk jobs run at once by each server process
+    JOBS_CHUNK_SIZE: int = 1000  # The sequences of a bulk job searched and written to a result chunk at a time
+    JOBS_MAX_SEQUENCES: int = 1000000  # The most sequences a bulk job may hold
+    JOBS_INPUT_DIR: str = ""  # The server directory bulk jobs may reference FASTA files in, empty to only take uploads
+    BACKGROUND_LOADING: bool = True  # Load the model and index once the server accepts connections, see /ready
+    WARMUP_QUERIES: int = 8  # Queries searched once loaded, before /ready reports ready; 0 skips the warmup
+    WARMUP_LENGTH: int = 300  # The residues of each warmup query
+
     VERSION: str
     ROOT_PATH: str
     AUTH_URL: str
     ADMIN_ROLES: list = ["LLMHomologyAdmin"]
     VCS_REF: str
     MODEL_DIR: str
+    HIT_STORE_DIR: str = ""  # The memory-mapped hit store, built from MODEL_DIR if missing (default MODEL_DIR.hitstore)
+    SEQUENCE_INDEX_DIR: str = ""  # The exact sequences of the database, see build_index (default MODEL_DIR.sequences)
+    REUSE_DATABASE_EMBEDDINGS: bool = True  # Queries found in the sequence index reuse their stored embedding
+    INDEX_ENGINE: str = "flat"  # flat (the exact index of MODEL_DIR), or the approximate ivf, ivfpq and hnsw indexes
+    FLAT_INDEX_PATH: str = ""  # The exact index searched without a SimilaritySearch (default MODEL_DIR.index)
+    INDEX_MMAP: bool = True  # Map index files instead of reading them, so the workers share them in the page cache
+    INDEX_DIR: str = ""  # Where approximate indexes are built on first use (default MODEL_DIR.indexes)
+    INDEX_NLIST: int = 0  # The number of ivf and ivfpq inverted lists, 0 for 4 * sqrt(number of rows)
+    INDEX_PQ_M: int = 64  # The number of ivfpq sub-quantizers, must divide the embedding size
+    INDEX_PQ_NBITS: int = 8  # The bits per ivfpq sub-quantizer code
+    INDEX_HNSW_M: int = 32  # The number of hnsw graph neighbours per vector
+    INDEX_NPROBE: int = 16  # The ivf and ivfpq inverted lists scanned when a request does not set nprobe
+    INDEX_MAX_NPROBE: int = 256  # The largest nprobe a request may set
+    INDEX_EF_SEARCH: int = 64  # The hnsw candidate list size when a request does not set ef_search
+    INDEX_MAX_EF_SEARCH: int = 512  # The largest ef_search a request may set
+    RANGE_SEARCH_MAX_HITS: int = 10000  # The most hits a range search returns per query, whatever max_hits
+    INDEX_SHARDS: str = ""  # A JSON manifest of database shards searched by one process each, instead of MODEL_DIR
 
     class Config:
         extra = "forbid"
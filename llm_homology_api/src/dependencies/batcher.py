@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from dependencies.fairness import Caller, FairQueue, residue_cost
+from dependencies.index_engines import SearchParams, SimilaritySearchIndex, range_search
+from dependencies.inference_executor import InferenceExecutor
+from dependencies.metrics import BATCH_SIZE, SEQUENCE_INDEX_LOOKUPS, STAGE_SECONDS
+from dependencies.windowing import embed_windowed
+
+
+@dataclass
+class _QueryItem:
+    sequence: str
+    top_k: int
+    future: asyncio.Future
+    embedding: np.ndarray | None = None
+    params: SearchParams = SearchParams()
+    background: bool = False
+    queued_at: float = field(default_factory=time.perf_counter)
+
+
+class MicroBatcher:
+    """
+    Collects queries from concurrent requests and runs them through a single embed + search call.
+
+    Each query of a request is queued individually. The worker drains up to max_batch_size queries, waiting at most
+    max_wait_ms for more queries to arrive, embeds the queries that do not already carry an embedding in one forward
+    pass, runs one search over the whole batch with the largest top_k requested, and hands every query its own slice
+    of the results. Queries asking for different search knobs (nprobe, ef_search, a range search threshold) share the
+    forward pass but are searched in one call per distinct setting. Sequences longer than window_size are embedded as
+    overlapping windows in the same forward pass. Sequences found in the database reuse its stored embedding instead.
+    At most one batch per inference thread is in flight; queries arriving meanwhile fill up the next batch.
+    Interactive queries are taken in weighted fair queueing order across callers, each query costing its residues and
+    hits, so a caller queueing thousands of long sequences delays the few queries of another by at most about one
+    batch instead of its whole backlog.
+    Background queries (bulk jobs) only fill the room interactive queries leave in a batch, so an interactive query
+    never waits behind more than the batches already in flight.
+    """
+
+    def __init__(
+        self,
+        ss,
+        executor: InferenceExecutor,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        window_size: int = 0,
+        window_overlap: int = 0,
+        embed=None,
+        index=None,
+        stored_embeddings=None,
+        hit_cost: float = 1.0,
+    ):
+        """
+        Initialize the MicroBatcher
+        :param ss: The SimilaritySearch object used for embedding and searching, None when embed and index are given
+        :param executor: The InferenceExecutor the batches run on
+        :param max_batch_size: The maximum number of queries to embed and search together
+        :param max_wait_ms: How long to wait for more queries before running a partially filled batch
+        :param window_size: The longest sequence embedded in one piece, 0 to never split sequences
+        :param window_overlap: The number of residues shared by consecutive windows of a long sequence
+        :param embed: Returns the (N, D) pooled embeddings of a list of sequences, defaults to ss.get_pooled_embeddings
+        :param index: The index the queries are searched in, defaults to the exact index of ss
+        :param stored_embeddings: Returns the stored embedding of each sequence of a list found in the database and
+            None for the others, e.g. SequenceIndex.embeddings; None to embed every sequence
+        :param hit_cost: The residues a requested hit costs in fair queueing, see residue_cost
+        """
+        self.ss = ss
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.window_size = window_size
+        self.window_overlap = window_overlap
+        self.embed = embed if embed is not None else ss.get_pooled_embeddings
+        self.index = index if index is not None else SimilaritySearchIndex(ss)
+        self.stored_embeddings = stored_embeddings
+        self.hit_cost = hit_cost
+        self._pending = FairQueue()
+        self._background = deque()
+        self._loop = None
+        self._worker = None
+        self._not_empty = None
+        self._batch_full = None
+        self._slots = None
+        self._in_flight = set()
+
+    def _ensure_worker(self):
+        """Start the worker task on the running event loop (the loop changes between TestClient sessions)"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._pending.retain(lambda item: item.future.get_loop() is loop)
+            self._background = deque(item for item in self._background if item.future.get_loop() is loop)
+            self._not_empty = asyncio.Event()
+            self._batch_full = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.executor.max_workers)
+            self._worker = loop.create_task(self._run())
+            self._signal()
+
+    def _signal(self):
+        if self._pending or self._background:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+        if len(self._pending) + len(self._background) >= self.max_batch_size:
+            self._batch_full.set()
+        else:
+            self._batch_full.clear()
+
+    async def search(
+        self,
+        sequences: list[str],
+        top_k: int,
+        embeddings: list[np.ndarray | None] | None = None,
+        params: SearchParams = SearchParams(),
+        background: bool = False,
+        caller: Caller = Caller(),
+    ) -> tuple[list[np.ndarray], list[np.ndarray], np.ndarray]:
+        """
+        Queue the sequences for the next batches and wait for their results.
+        :param sequences: The protein sequences to embed and search
+        :param top_k: The number of hits to return for each sequence
+        :param embeddings: Already known embeddings of the sequences (None where unknown), these skip the model
+        :param params: The search knobs, as returned by index.search_params
+        :param background: Queue the sequences behind every interactive query, for bulk jobs
+        :param caller: The caller the interactive queries are fairly queued for
+        :return: A tuple of per-query hit scores, per-query hit indices and the (N, D) query embeddings
+        """
+        if not sequences:
+            return [], [], np.empty((0, 0), dtype=np.float32)
+        if embeddings is None:
+            embeddings = [None] * len(sequences)
+        self._ensure_worker()
+        items = [
+            _QueryItem(sequence, top_k, self._loop.create_future(), embedding, params, background)
+            for sequence, embedding in zip(sequences, embeddings)
+        ]
+        if background:
+            self._background.extend(items)
+        else:
+            for item in items:
+                cost = residue_cost(len(item.sequence), item.top_k, self.hit_cost)
+                self._pending.push(item, caller.name, cost, caller.weight)
+        self._signal()
+        results = await asyncio.gather(*(item.future for item in items))
+        scores, indices, embeddings = zip(*results)
+        return list(scores), list(indices), np.stack(embeddings)
+
+    def _next_batch(self) -> list[_QueryItem]:
+        batch = []
+        for pop, pending in ((self._pending.pop, self._pending), (self._background.popleft, self._background)):
+            while pending and len(batch) < self.max_batch_size:
+                item = pop()
+                if not item.future.done():  # Skip queries whose request was cancelled
+                    batch.append(item)
+        self._signal()
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._not_empty.wait()
+            if not self._batch_full.is_set():
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+            await self._slots.acquire()
+            batch = self._next_batch()
+            if not batch:
+                self._slots.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, batch: list[_QueryItem]):
+        started_at = time.perf_counter()
+        for item in batch:
+            if not item.background:  # Bulk jobs wait by design, their queueing would drown that of requests
+                STAGE_SECONDS.labels(stage="queue").observe(started_at - item.queued_at)
+        BATCH_SIZE.observe(len(batch))
+        try:
+            results = await self.executor.run(self._search_batch, batch)
+        except Exception as e:
+            logging.exception(f"Batched search of {len(batch)} queries failed")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for item, result in zip(batch, results):
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def _embed_batch(self, batch: list[_QueryItem]) -> np.ndarray:
+        """
+        Embed the queries of the batch that do not carry an embedding yet, each distinct sequence once, unless the
+        sequence is in the database
+        """
+        missing = list(dict.fromkeys(item.sequence for item in batch if item.embedding is None))
+        embedded = {}
+        if missing and self.stored_embeddings is not None:
+            with STAGE_SECONDS.labels(stage="sequence_lookup").time():
+                stored = self.stored_embeddings(missing)
+            embedded = {sequence: embedding for sequence, embedding in zip(missing, stored) if embedding is not None}
+            SEQUENCE_INDEX_LOOKUPS.labels(result="hit").inc(len(embedded))
+            SEQUENCE_INDEX_LOOKUPS.labels(result="miss").inc(len(missing) - len(embedded))
+            missing = [sequence for sequence in missing if sequence not in embedded]
+        if missing:
+            with STAGE_SECONDS.labels(stage="embed").time():
+                embeddings = embed_windowed(self.embed, missing, self.window_size, self.window_overlap)
+            embedded.update(zip(missing, embeddings))
+        if embedded:
+            for item in batch:
+                if item.embedding is None:
+                    item.embedding = embedded[item.sequence]
+        return np.stack([item.embedding for item in batch]).astype(np.float32, copy=False)
+
+    def _search_batch(self, batch: list[_QueryItem]) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Run one search per distinct search setting of the batch and split the results back out per query"""
+        query_embeddings = self._embed_batch(batch)
+        groups = {}
+        for position, item in enumerate(batch):
+            groups.setdefault(item.params, []).append(position)
+        results = [None] * len(batch)
+        for params, positions in groups.items():
+            top_k = max(batch[position].top_k for position in positions)
+            with STAGE_SECONDS.labels(stage="search").time():
+                if params.threshold is None:
+                    total_scores, total_indices = self.index.search(query_embeddings[positions], top_k, params)
+                else:
+                    total_scores, total_indices = range_search(self.index, query_embeddings[positions], top_k, params)
+            for position, scores, indices in zip(positions, total_scores, total_indices):
+                item_top_k = batch[position].top_k
+                results[position] = (
+                    np.asarray(scores)[:item_top_k],
+                    np.asarray(indices)[:item_top_k],
+                    query_embeddings[position],
+                )
+        return results
+
+    def shutdown(self):
+        if self._worker is not None:
+            self._worker.cancel()
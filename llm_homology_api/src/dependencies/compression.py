@@ -0,0 +1,279 @@
+import zlib
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, responses are then compressed with the other encodings
+    zstandard = None
+try:
+    import brotli
+except ImportError:  # brotli is optional, as zstandard
+    brotli = None
+
+DECOMPRESSION_ERRORS = (
+    (zlib.error, ValueError)
+    + ((zstandard.ZstdError,) if zstandard is not None else ())
+    + ((brotli.error,) if brotli is not None else ())
+)
+# Levels chosen with scripts/benchmarks/bench_compression.py on /similarity responses with JSON embeddings: higher
+# levels cost 2 to 10 times the CPU for 10 to 20% fewer bytes, and base64 and int8 embeddings barely shrink at any level
+LEVELS = {"zstd": 3, "br": 1, "gzip": 1}
+# Chunks smaller than this are compressed on the event loop, the hop to a thread would cost more than compressing
+INLINE_BYTES = 16384
+# Zstandard and brotli input is decompressed in pieces of this size, each checked against the size limit
+DECOMPRESS_PIECE_BYTES = 1024
+
+
+def installed_encodings(encodings) -> list[str]:
+    """The encodings of a list whose compressor is installed, in the same order"""
+    installed = {"gzip": True, "zstd": zstandard is not None, "br": brotli is not None}
+    return [encoding for encoding in encodings if installed.get(encoding)]
+
+
+def negotiate_encoding(accept_encoding: str, encodings: list[str]) -> str | None:
+    """
+    Choose the encoding of a response
+    :param accept_encoding: The Accept-Encoding header of the request, e.g. "gzip;q=0.8, zstd, br"
+    :param encodings: The encodings the server offers, most preferred first
+    :return: The encoding the client weighs highest, the server preference breaking ties, or None for identity
+    """
+    weights = {}
+    for coding in accept_encoding.split(","):
+        name, *parameters = (part.strip() for part in coding.split(";"))
+        weight = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights[name.lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class StreamCompressor:
+    """Compresses a response body chunk by chunk, each chunk flushed so a streaming client can decode it on arrival"""
+
+    def __init__(self, encoding: str, level: int | None = None):
+        """
+        Initialize the StreamCompressor
+        :param encoding: gzip, zstd or br
+        :param level: The compression level (brotli quality), defaults to that of LEVELS
+        """
+        level = LEVELS[encoding] if level is None else level
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            raise ValueError(f"Unsupported encoding {encoding}")
+
+    def compress(self, data: bytes, final: bool = False) -> bytes:
+        """
+        Compress the next chunk of the body
+        :param data: The chunk
+        :param final: Whether it is the last chunk, which ends the compressed stream
+        :return: The compressed bytes that decode to every chunk so far
+        """
+        if self.encoding == "br":
+            return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+        if final:
+            return self._compressor.compress(data) + self._compressor.flush()
+        flush_mode = zlib.Z_SYNC_FLUSH if self.encoding == "gzip" else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self._compressor.compress(data) + self._compressor.flush(flush_mode)
+
+
+class StreamDecompressor:
+    """Decompresses a request body chunk by chunk, refusing bodies that decompress beyond a size limit"""
+
+    def __init__(self, encoding: str, max_bytes: int):
+        """
+        Initialize the StreamDecompressor
+        :param encoding: gzip, zstd or br
+        :param max_bytes: The largest decompressed body. Gzip bodies are cut off at the limit, zstandard and brotli
+            bodies at most the expansion of DECOMPRESS_PIECE_BYTES of input beyond it
+        """
+        self.encoding = encoding
+        self.room = max_bytes
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(47)  # A gzip or zlib header
+        elif encoding == "zstd" and zstandard is not None:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == "br" and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+        else:
+            raise ValueError(f"Unsupported encoding {encoding}")
+
+    def _take(self, data: bytes) -> bytes:
+        self.room -= len(data)
+        if self.room < 0:
+            raise HTTPException(status_code=413, detail="The decompressed request body is too large")
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress the next chunk of the body"""
+        try:
+            if self.encoding == "gzip":
+                return self._take(self._decompressor.decompress(data, self.room + 1))
+            pieces = []
+            for start in range(0, len(data), DECOMPRESS_PIECE_BYTES):
+                piece = data[start : start + DECOMPRESS_PIECE_BYTES]
+                decompress = self._decompressor.process if self.encoding == "br" else self._decompressor.decompress
+                pieces.append(self._take(decompress(piece)))
+            return b"".join(pieces)
+        except DECOMPRESSION_ERRORS as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {self.encoding} request body: {e}")
+
+    def finish(self):
+        """Check the body ended with a complete compressed stream"""
+        if self.encoding == "br":
+            finished = self._decompressor.is_finished()
+        else:
+            finished = self._decompressor.eof
+        if not finished:
+            raise HTTPException(status_code=400, detail=f"Truncated {self.encoding} request body")
+
+
+async def _off_loop(function, data: bytes, *args):
+    """Run a compression step in the thread pool unless the data is small"""
+    if len(data) < INLINE_BYTES:
+        return function(data, *args)
+    return await run_in_threadpool(function, data, *args)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with the encoding negotiated from Accept-Encoding (zstd, br or gzip), and
+    decompressing request bodies sent with a Content-Encoding.
+
+    Unlike Starlette's GZipMiddleware, compression runs in the thread pool, so a multi-megabyte response with
+    embeddings does not stall the event loop. A response whose whole body is smaller than min_bytes, that already has
+    a Content-Encoding or whose media type is excluded (the gzip files of bulk jobs) is sent as it is. Streamed
+    responses (/similarity/stream) are compressed chunk by chunk, each chunk flushed so the client decodes every line
+    as it arrives.
+    """
+
+    def __init__(
+        self,
+        app,
+        encodings=("zstd", "br", "gzip"),
+        min_bytes: int = 4096,
+        max_decompressed_bytes: int = 268435456,
+        excluded_media_types=("application/gzip",),
+    ):
+        """
+        Initialize the CompressionMiddleware
+        :param app: The ASGI app
+        :param encodings: The response encodings offered, most preferred first; those not installed are left out
+        :param min_bytes: Smaller responses are not compressed
+        :param max_decompressed_bytes: Compressed request bodies decompressing to more are refused with a 413
+        :param excluded_media_types: Media types never compressed, e.g. those already compressed
+        """
+        self.app = app
+        self.encodings = installed_encodings(encodings)
+        self.min_bytes = min_bytes
+        self.max_decompressed_bytes = max_decompressed_bytes
+        self.excluded_media_types = tuple(excluded_media_types)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            try:
+                decompressor = StreamDecompressor(content_encoding, self.max_decompressed_bytes)
+            except ValueError:
+                response = PlainTextResponse(f"Unsupported Content-Encoding {content_encoding}", status_code=415)
+                await response(scope, receive, send)
+                return
+            scope = dict(scope)
+            # The app sees the decompressed body, whose length is unknown until it is read
+            scope["headers"] = [
+                (name, value)
+                for name, value in scope["headers"]
+                if name not in (b"content-encoding", b"content-length")
+            ]
+            receive = self._decompressing_receive(receive, decompressor)
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+        else:
+            await self.app(scope, receive, _CompressingSender(send, encoding, self).send)
+
+    @staticmethod
+    def _decompressing_receive(receive, decompressor: StreamDecompressor):
+        async def decompressing_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                message = dict(message)
+                message["body"] = await _off_loop(decompressor.decompress, message.get("body", b""))
+                if not message.get("more_body", False):
+                    decompressor.finish()
+            return message
+
+        return decompressing_receive
+
+    def compressible(self, headers: MutableHeaders) -> bool:
+        return "content-encoding" not in headers and not headers.get("content-type", "").startswith(
+            self.excluded_media_types
+        )
+
+
+class _CompressingSender:
+    """Holds the start of a response until its first body chunk shows whether and how to compress it"""
+
+    def __init__(self, send, encoding: str, middleware: CompressionMiddleware):
+        self._send = send
+        self.encoding = encoding
+        self.middleware = middleware
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start["headers"])
+            if not self.middleware.compressible(headers) or (not more_body and len(body) < self.middleware.min_bytes):
+                self.passthrough = True
+                await self._send(self.start)
+                await self._send(message)
+                return
+            self.compressor = StreamCompressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            self.start["headers"] = headers.raw
+            if more_body:
+                del headers["Content-Length"]
+                await self._send(self.start)
+            else:
+                body = await _off_loop(self.compressor.compress, body, True)
+                headers["Content-Length"] = str(len(body))
+                await self._send(self.start)
+                await self._send({"type": "http.response.body", "body": body})
+                return
+        compressed = await _off_loop(self.compressor.compress, body, not more_body)
+        await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
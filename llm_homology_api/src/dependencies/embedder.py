@@ -1,15 +1,64 @@
+import json
+import logging
 import os
+import numpy as np
 import torch
-from transformers import EsmForMaskedLM, EsmTokenizer
+from transformers import EsmForMaskedLM, EsmModel, EsmTokenizer
+
+from dependencies.metrics import STAGE_SECONDS
+
+SAFETENSORS_DTYPES = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+                      'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+                      'BOOL': torch.bool}
+
+
+def mmap_safetensors(path):
+    """
+    Open the tensors of a safetensors file as copy-on-write memory maps of the file instead of reading them.
+    The pages are read on first use and shared through the page cache by every process mapping the file, for as long
+    as they are not written to.
+    :return: The tensors by name
+    """
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size))
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size)
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        start, end = info['data_offsets']
+        tensors[name] = torch.from_numpy(data[start:end]).view(SAFETENSORS_DTYPES[info['dtype']]).reshape(info['shape'])
+    return tensors
+
 
 class Esm2Embedder:
-    """Embedder for the ESM-2 model"""
+    """
+    Embedder for the ESM-2 model
+
+    In lean mode only the encoder is loaded, without the masked LM head, and embed_pooled returns the mean-pooled
+    final layer computed on the device, so neither the hidden states of every layer nor the logits are materialized.
+
+    The engine selects how the model runs:
+    - torch: the PyTorch model, on the GPU when there is one
+    - int8: the PyTorch model on the CPU with its linear layers dynamically quantized to int8
+    - onnx: the encoder exported once to ONNX and run by ONNX Runtime on the CPU (requires onnxruntime)
+
+    With mmap_weights, the float32 weights of the torch engine on the CPU are memory maps of the safetensors file of
+    the checkpoint, so every server process embedding with the same checkpoint shares one copy of them.
+    """
+
+    ENGINES = ('torch', 'int8', 'onnx')
 
-    def __init__(self, local_model_dir='local_models', model_name='facebook/esm2_t33_650M_UR50D', half_precision: bool = True, eval_mode: bool = True, device: str = None):
+    def __init__(self, local_model_dir='local_models', model_name='facebook/esm2_t33_650M_UR50D', half_precision: bool = True, eval_mode: bool = True, device: str = None, lean: bool = False, engine: str = 'torch', mmap_weights: bool = False):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {self.ENGINES}")
         self.local_model_dir = local_model_dir
         self.model_name = model_name
         self.half_precision = half_precision
         self.eval_mode = eval_mode
+        self.lean = lean
+        self.engine = engine
 
         model_cache_dir = os.path.join(local_model_dir, f"models--{model_name.replace('/', '--')}")
         snapshot_exists = self.check_snapshot_exists(model_cache_dir)
@@ -17,17 +66,35 @@ class Esm2Embedder:
         model_source = model_cache_dir if snapshot_exists else model_name
 
         tokenizer = EsmTokenizer.from_pretrained(model_source, cache_dir=local_model_dir)
-        model = EsmForMaskedLM.from_pretrained(model_source, cache_dir=local_model_dir)
+        if lean:
+            model = EsmModel.from_pretrained(model_source, cache_dir=local_model_dir, add_pooling_layer=False)
+        else:
+            model = EsmForMaskedLM.from_pretrained(model_source, cache_dir=local_model_dir)
 
-        if not snapshot_exists:
+        # The encoder alone is not saved, the local copy must stay loadable with the LM head
+        if not snapshot_exists and not lean:
             self.save_model_locally(model, tokenizer, model_cache_dir)
 
         model.eval() if eval_mode else model.train()
-        model.half() if half_precision else model.float()
 
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        # The int8 and ONNX engines are CPU engines
+        device = 'cuda' if torch.cuda.is_available() and engine == 'torch' else 'cpu'
+        # fp16 matmuls are slow or unsupported on the CPU, so half precision is only used on the GPU
+        if half_precision and device == 'cpu':
+            logging.warning(f"Running {model_name} in float32 on the CPU, half precision is only used on the GPU")
+        model.half() if half_precision and device == 'cuda' else model.float()
+
         device = torch.device(device)
         model.to(device)
+        if mmap_weights and engine == 'torch' and device.type == 'cpu':
+            self.map_weights(model, model_source)
+
+        self.onnx_session = None
+        if engine == 'int8':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        elif engine == 'onnx':
+            self.onnx_session = self.load_onnx_session(model, tokenizer, model_cache_dir)
+            model = None
 
         self.tokenizer = tokenizer
         self.model = model
@@ -44,17 +111,89 @@ class Esm2Embedder:
                         return True
         return False
 
+    def map_weights(self, model, model_source):
+        """
+        Swap the weights of the model for memory maps of its safetensors file, see mmap_safetensors.
+        Only the tensors stored with the dtype and shape of the model are swapped, the others keep their own copy.
+        """
+        from transformers.utils import cached_file
+
+        try:
+            path = cached_file(model_source, 'model.safetensors', cache_dir=self.local_model_dir)
+        except OSError:
+            logging.warning(f"{self.model_name} has no safetensors file, its weights are not mapped")
+            return
+        state_dict = model.state_dict()
+        prefix = f'{model.base_model_prefix}.'
+        mapped = {}
+        for name, tensor in mmap_safetensors(path).items():
+            # The encoder of a lean model is stored under the prefix of the masked LM checkpoint
+            if name not in state_dict and name.startswith(prefix):
+                name = name[len(prefix):]
+            if name in state_dict and state_dict[name].shape == tensor.shape and state_dict[name].dtype == tensor.dtype:
+                mapped[name] = tensor
+        model.load_state_dict(mapped, strict=False, assign=True)
+        logging.info(f"Mapped {len(mapped)} of {len(state_dict)} tensors of {self.model_name} from {path}")
+
     def save_model_locally(self, model, tokenizer, model_cache_dir):
         os.makedirs(model_cache_dir, exist_ok=True)
         model.save_pretrained(model_cache_dir)
         tokenizer.save_pretrained(model_cache_dir)
 
+    def load_onnx_session(self, model, tokenizer, model_cache_dir):
+        """Export the encoder to ONNX next to the local model, unless already exported, and open it on the CPU"""
+        import onnxruntime
+
+        onnx_path = os.path.join(model_cache_dir, 'onnx', 'encoder.onnx')
+        if not os.path.exists(onnx_path):
+            os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+            encoder = model if self.lean else model.esm
+            example = tokenizer(['MKTAYIAKQR', 'MK'], return_tensors='pt', padding=True)
+            dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                            'last_hidden_state': {0: 'batch', 1: 'sequence'}}
+            tmp_path = f"{onnx_path}.tmp-{os.getpid()}"
+            with torch.no_grad():
+                torch.onnx.export(encoder, (example['input_ids'], example['attention_mask']), tmp_path,
+                                  input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                                  dynamic_axes=dynamic_axes, opset_version=17)
+            os.replace(tmp_path, onnx_path)
+        return onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+
+    def last_hidden_state(self, batch_encoding):
+        """Run the encoder and return only its final layer"""
+        if self.onnx_session is not None:
+            inputs = {name: batch_encoding[name].cpu().numpy() for name in ('input_ids', 'attention_mask')}
+            return torch.from_numpy(self.onnx_session.run(['last_hidden_state'], inputs)[0])
+        encoder = self.model if self.lean else self.model.esm
+        return encoder(**batch_encoding).last_hidden_state
+
     def embed(self, sequences):
         """Embed protein sequences using the ESM-2 model."""
         batch_encoding = self.tokenizer(sequences, return_tensors='pt', padding=True, truncation=True)
         batch_encoding = {k: v.to(self.device) for k, v in batch_encoding.items()}
 
         with torch.no_grad():
+            if self.lean or self.onnx_session is not None:
+                return self.last_hidden_state(batch_encoding)
             outputs = self.model(**batch_encoding, output_hidden_states=True)
 
         return outputs.hidden_states[-1]
+
+    def embed_pooled(self, sequences):
+        """
+        Embed protein sequences and mean-pool the residues of each sequence on the device.
+        Only the final layer is returned by the encoder and the BOS, EOS and padding tokens are left out of the mean.
+        :return: An (N, D) float32 numpy array
+        """
+        with STAGE_SECONDS.labels(stage='tokenization').time():
+            batch_encoding = self.tokenizer(sequences, return_tensors='pt', padding=True, truncation=True, return_special_tokens_mask=True)
+            special_tokens_mask = batch_encoding.pop('special_tokens_mask')
+            batch_encoding = {k: v.to(self.device) for k, v in batch_encoding.items()}
+            residue_mask = batch_encoding['attention_mask'] * (1 - special_tokens_mask.to(self.device))
+
+        with STAGE_SECONDS.labels(stage='model_forward').time(), torch.inference_mode():
+            hidden_states = self.last_hidden_state(batch_encoding)
+            mask = residue_mask.unsqueeze(-1).to(hidden_states.dtype)
+            pooled = (hidden_states * mask).sum(dim=1, dtype=torch.float32) / mask.sum(dim=1, dtype=torch.float32).clamp(min=1)
+            # Copying to the host waits for the device, so it is timed with the forward pass
+            return pooled.cpu().numpy()
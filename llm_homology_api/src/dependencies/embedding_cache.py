@@ -0,0 +1,81 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dependencies.metrics import EMBEDDING_CACHE_BYTES
+
+
+def normalize_sequence(sequence: str) -> str:
+    """Strip whitespace and upper-case a protein sequence so equivalent inputs share a cache entry"""
+    return "".join(sequence.split()).upper()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of query embeddings keyed by a hash of the model name and the normalized sequence.
+    Entries are evicted by their total size in bytes rather than by their count, so long and short
+    embeddings from different models share one memory budget.
+    """
+
+    def __init__(self, max_bytes: int, model_name: str):
+        """
+        Initialize the EmbeddingCache
+        :param max_bytes: The total size of the cached embeddings before the least recently used are evicted
+        :param model_name: The embedding model, part of every key so a model change never serves stale vectors
+        """
+        self.max_bytes = max_bytes
+        self.model_name = model_name
+        self._entries = OrderedDict()  # type: OrderedDict[bytes, np.ndarray]
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def key(self, sequence: str) -> bytes:
+        content = f"{self.model_name}\0{normalize_sequence(sequence)}".encode()
+        return hashlib.blake2b(content, digest_size=16).digest()
+
+    def get(self, key: bytes) -> np.ndarray | None:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return embedding
+
+    def put(self, key: bytes, embedding: np.ndarray):
+        # Copy so a cached row never keeps the whole batch matrix it was sliced from alive
+        embedding = np.array(embedding, copy=True)
+        embedding.setflags(write=False)
+        if embedding.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = embedding
+            self._bytes += embedding.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._evictions += 1
+            EMBEDDING_CACHE_BYTES.set(self._bytes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "model_name": self.model_name,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,175 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Caller:
+    """Who a similarity request is scheduled and charged for"""
+
+    name: str = "anonymous"  # The flow of the caller, e.g. "user:jdoe" or "anonymous:10.0.0.1"
+    weight: float = 1.0  # The share of the caller in fair queueing and the refill rate of its quota
+
+
+def residue_cost(residues: int, hits: int, hit_cost: float) -> float:
+    """
+    The cost of searching queries, in residues
+    :param residues: The residues embedded
+    :param hits: The hits requested (queries times max_hits)
+    :param hit_cost: The residues a hit costs to search, gather and encode
+    """
+    return residues + hit_cost * hits
+
+
+class QuotaExceededError(Exception):
+    """Raised when a request costs more than the quota of its caller holds"""
+
+    def __init__(self, caller: str, cost: float, available: float, retry_after: int):
+        self.caller = caller
+        self.cost = cost
+        self.available = available
+        self.retry_after = retry_after
+        super().__init__(
+            f"The residue quota of {caller} is used up ({max(available, 0):.0f} residues left, "
+            f"{cost:.0f} requested). Retry after {retry_after} seconds."
+        )
+
+
+class TokenBucket:
+    """Residues a caller may spend, refilled at a constant rate up to the burst"""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class UserQuotas:
+    """
+    Per caller token buckets of residues, so one caller cannot take the whole service for long.
+
+    Each request is charged its residue_cost when admitted. A request is admitted as long as the bucket of its caller
+    holds its cost, or the whole burst for a request costing more than the burst, and the bucket may then go into
+    debt: the largest request is still served, and its caller waits for the debt to be refilled before the next one.
+    The bucket of a caller refills at weight times the rate.
+    """
+
+    def __init__(
+        self,
+        residues_per_second: float = 0,
+        burst_residues: float = 2500000,
+        hit_cost: float = 1.0,
+        max_callers: int = 10000,
+    ):
+        """
+        Initialize the UserQuotas
+        :param residues_per_second: The refill rate of the bucket of a caller of weight 1, 0 for no quotas
+        :param burst_residues: The size of a bucket, the most a caller may spend at once
+        :param hit_cost: The residues a requested hit costs, see residue_cost
+        :param max_callers: Beyond this many buckets, the full ones are forgotten (a new bucket starts full)
+        """
+        self.residues_per_second = residues_per_second
+        self.burst_residues = burst_residues
+        self.hit_cost = hit_cost
+        self.max_callers = max_callers
+        self._buckets = {}  # type: dict[str, TokenBucket]
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.residues_per_second > 0
+
+    def charge(self, caller: Caller, residues: int, hits: int):
+        """
+        Charge a request to the bucket of its caller
+        :param caller: The caller of the request
+        :param residues: The residues of the query sequences
+        :param hits: The hits requested
+        :raises: QuotaExceededError if the bucket does not hold the cost of the request
+        """
+        if not self.enabled:
+            return
+        cost = residue_cost(residues, hits, self.hit_cost)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(caller.name)
+            if bucket is None:
+                if len(self._buckets) >= self.max_callers:
+                    self._forget_full_buckets(now)
+                bucket = self._buckets[caller.name] = TokenBucket(
+                    self.residues_per_second * caller.weight, self.burst_residues, now
+                )
+            bucket.refill(now)
+            needed = min(cost, bucket.burst)
+            if bucket.tokens < needed:
+                self._rejected += 1
+                raise QuotaExceededError(
+                    caller.name, cost, bucket.tokens, retry_after=math.ceil((needed - bucket.tokens) / bucket.rate)
+                )
+            bucket.tokens -= cost
+
+    def _forget_full_buckets(self, now: float):
+        for name, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[name]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "residues_per_second": self.residues_per_second,
+                "burst_residues": self.burst_residues,
+                "callers": len(self._buckets),
+                "rejected_requests": self._rejected,
+            }
+
+
+class FairQueue:
+    """
+    Queued items of several flows, served in weighted fair queueing order (self-clocked fair queueing).
+
+    Each item is tagged with a virtual finish time: the later of the virtual time and the finish tag of the previous
+    item of its flow, plus its cost divided by the weight of its flow. Items are served by increasing finish tag, and
+    the virtual time advances to the finish tag of each item served. A flow with a deep backlog has finish tags far
+    ahead, so the first items of a flow that was idle are served next whatever the backlog of the others, and flows
+    with queued work share the service in proportion to their weights. Items of a flow keep their order.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._finish = {}  # type: dict[str, float]
+        self._virtual_time = 0.0
+        self._order = itertools.count()
+
+    def push(self, item, flow: str, cost: float, weight: float = 1.0):
+        start = max(self._virtual_time, self._finish.get(flow, 0.0))
+        finish = start + cost / weight
+        self._finish[flow] = finish
+        heapq.heappush(self._heap, (finish, next(self._order), item))
+        if len(self._finish) > 2 * len(self._heap) + 64:
+            # An idle flow starts at the virtual time anyway
+            self._finish = {name: tag for name, tag in self._finish.items() if tag > self._virtual_time}
+
+    def pop(self):
+        finish, _, item = heapq.heappop(self._heap)
+        self._virtual_time = finish
+        if not self._heap:
+            self._finish.clear()
+        return item
+
+    def retain(self, predicate):
+        """Drop the items for which predicate is false"""
+        self._heap = [entry for entry in self._heap if predicate(entry[2])]
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return len(self._heap)
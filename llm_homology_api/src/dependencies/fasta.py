@@ -0,0 +1,54 @@
+import gzip
+from pathlib import Path
+from typing import Iterator
+
+
+def read_fasta(path: str | Path) -> Iterator[tuple[str, str]]:
+    """
+    Stream the records of a FASTA file, plain or gzip compressed, one at a time
+    :param path: The FASTA file
+    :return: An iterator of (header, sequence) tuples, the header without its leading ">" and the sequence joined
+        across lines without whitespace
+    """
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt") as f:
+        yield from parse_fasta(f)
+
+
+def parse_fasta(lines) -> Iterator[tuple[str, str]]:
+    """
+    Parse FASTA records from an iterable of lines
+    :param lines: The lines, e.g. an open text file
+    :return: An iterator of (header, sequence) tuples, see read_fasta
+    """
+    header = None
+    sequence = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(">"):
+            if header is not None:
+                yield header, "".join(sequence)
+            header = line[1:].strip()
+            sequence = []
+        elif line and header is not None:
+            sequence.append("".join(line.split()))
+    if header is not None:
+        yield header, "".join(sequence)
+
+
+def iter_chunks(records, chunk_size: int) -> Iterator[tuple[list[str], list[str]]]:
+    """
+    Group FASTA records into consecutive chunks
+    :param records: (header, sequence) tuples, e.g. from read_fasta
+    :param chunk_size: The number of records per chunk, the last chunk may hold fewer
+    :return: An iterator of (headers, sequences) lists
+    """
+    headers, sequences = [], []
+    for header, sequence in records:
+        headers.append(header)
+        sequences.append(sequence)
+        if len(headers) == chunk_size:
+            yield headers, sequences
+            headers, sequences = [], []
+    if headers:
+        yield headers, sequences
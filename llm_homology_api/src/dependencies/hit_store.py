@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+
+class HitStore:
+    """
+    Columnar, memory-mapped copy of the database embeddings and tags used to look up search hits.
+
+    The store directory holds:
+    - embeddings.npy: an (N, D) matrix of the database embeddings
+    - tag_offsets.npy: N + 1 int64 offsets, tag i is tag_bytes[tag_offsets[i]:tag_offsets[i + 1]]
+    - tag_bytes.bin: the UTF-8 encoded tags, back to back
+    - hit_store.json: the number of rows, the embedding size and dtype, and the dataset it was built from
+
+    Every file is opened with mmap, so lookups are a single fancy-index gather over all hits of a batch
+    and the OS page cache holding the data is shared by every worker process on the machine.
+    """
+
+    EMBEDDINGS_FILE = "embeddings.npy"
+    TAG_OFFSETS_FILE = "tag_offsets.npy"
+    TAG_BYTES_FILE = "tag_bytes.bin"
+    MANIFEST_FILE = "hit_store.json"
+
+    def __init__(self, store_dir: str | Path):
+        """
+        Open an existing hit store
+        :param store_dir: The directory written by HitStore.write or HitStore.build
+        """
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir / self.MANIFEST_FILE) as f:
+            self.manifest = json.load(f)
+        self.embeddings = np.load(self.store_dir / self.EMBEDDINGS_FILE, mmap_mode="r")
+        self.tag_offsets = np.load(self.store_dir / self.TAG_OFFSETS_FILE, mmap_mode="r")
+        tag_bytes_path = self.store_dir / self.TAG_BYTES_FILE
+        if tag_bytes_path.stat().st_size:
+            self.tag_bytes = np.memmap(tag_bytes_path, dtype=np.uint8, mode="r")
+        else:
+            self.tag_bytes = np.empty(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.tag_offsets) - 1
+
+    def get_embeddings(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Gather the embeddings of the given rows
+        :param indices: The database rows to gather
+        :return: An (len(indices), D) array
+        """
+        return self.embeddings[np.asarray(indices, dtype=np.int64)]
+
+    def get_tags(self, indices: np.ndarray) -> list[str]:
+        """
+        Gather the tags of the given rows with one read of the tag bytes
+        :param indices: The database rows to gather
+        :return: The tags, in the order of indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.tag_offsets[indices]
+        lengths = self.tag_offsets[indices + 1] - starts
+        ends = np.cumsum(lengths)
+        # Byte positions of every requested tag laid out back to back
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+        blob = self.tag_bytes[positions].tobytes()
+        return [blob[end - length : end].decode("utf-8") for end, length in zip(ends.tolist(), lengths.tolist())]
+
+    @classmethod
+    def write(
+        cls,
+        store_dir: str | Path,
+        chunks: Iterable[tuple[list[str], np.ndarray]],
+        num_rows: int,
+        dim: int,
+        dtype=np.float32,
+        source: str = "",
+    ) -> "HitStore":
+        """
+        Write a hit store from chunks of rows. The store is written next to store_dir and renamed into place,
+        so concurrent writers (e.g. several workers starting at once) never expose a partial store.
+        :param store_dir: The directory to create
+        :param chunks: (tags, embeddings) chunks of consecutive database rows
+        :param num_rows: The total number of rows in the chunks
+        :param dim: The embedding size
+        :param dtype: The dtype the embeddings are stored in
+        :param source: A description of where the rows came from, recorded in the manifest
+        :return: The opened HitStore
+        """
+        store_dir = Path(store_dir)
+        tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        embeddings = np.lib.format.open_memmap(
+            tmp_dir / cls.EMBEDDINGS_FILE, mode="w+", dtype=np.dtype(dtype), shape=(num_rows, dim)
+        )
+        tag_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        row = 0
+        with open(tmp_dir / cls.TAG_BYTES_FILE, "wb") as tag_bytes:
+            for tags, chunk_embeddings in chunks:
+                encoded = [tag.encode("utf-8") for tag in tags]
+                embeddings[row : row + len(encoded)] = chunk_embeddings
+                tag_offsets[row + 1 : row + len(encoded) + 1] = tag_offsets[row] + np.cumsum(
+                    [len(tag) for tag in encoded]
+                )
+                tag_bytes.write(b"".join(encoded))
+                row += len(encoded)
+        if row != num_rows:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ValueError(f"Expected {num_rows} rows but the chunks held {row}")
+        embeddings.flush()
+        del embeddings
+        np.save(tmp_dir / cls.TAG_OFFSETS_FILE, tag_offsets)
+        with open(tmp_dir / cls.MANIFEST_FILE, "w") as f:
+            json.dump({"num_rows": num_rows, "dim": dim, "dtype": np.dtype(dtype).name, "source": source}, f)
+
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            if not (store_dir / cls.MANIFEST_FILE).exists():
+                raise
+            # Another process finished building the same store first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return cls(store_dir)
+
+    @classmethod
+    def build(cls, dataset_dir: str | Path, store_dir: str | Path, chunk_size: int = 65536) -> "HitStore":
+        """
+        Build a hit store from the tags and embeddings columns of a SimilaritySearch dataset directory
+        :param dataset_dir: The Hugging Face dataset directory the SimilaritySearch is loaded from
+        :param store_dir: The directory to create
+        :param chunk_size: The number of rows read from the dataset at a time
+        :return: The opened HitStore
+        """
+        from datasets import load_from_disk
+
+        dataset = load_from_disk(str(dataset_dir)).with_format("numpy")
+        num_rows = len(dataset)
+        first = np.asarray(dataset[0]["embeddings"])
+        logging.info(f"Building hit store {store_dir} from {num_rows} rows of {dataset_dir}")
+
+        def chunks():
+            for start in range(0, num_rows, chunk_size):
+                rows = dataset[start : start + chunk_size]
+                yield [str(tag) for tag in rows["tags"]], np.stack(rows["embeddings"])
+
+        return cls.write(
+            store_dir, chunks(), num_rows=num_rows, dim=len(first), dtype=first.dtype, source=str(dataset_dir)
+        )
+
+    @classmethod
+    def open_or_build(cls, dataset_dir: str | Path, store_dir: str | Path) -> "HitStore":
+        if (Path(store_dir) / cls.MANIFEST_FILE).exists():
+            return cls(store_dir)
+        return cls.build(dataset_dir, store_dir)
@@ -0,0 +1,337 @@
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from dependencies.hit_store import HitStore
+
+INDEX_ENGINES = ("flat", "ivf", "ivfpq", "hnsw")
+
+
+class SearchParams(NamedTuple):
+    """The per-request search knobs, after defaults and server limits are applied. Hashable, to group queries by."""
+
+    nprobe: int | None = None
+    ef_search: int | None = None
+    threshold: float | None = None  # Range search: every hit scoring at least threshold, up to top_k, see range_search
+
+
+def _clamp(value: int | None, default: int, maximum: int) -> int:
+    return default if value is None else max(1, min(value, maximum))
+
+
+def clamp_search_params(
+    engine: str,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+    default_nprobe: int = 16,
+    max_nprobe: int = 256,
+    default_ef_search: int = 64,
+    max_ef_search: int = 512,
+) -> SearchParams:
+    """
+    The knobs of a request, defaulted and clamped to the server limits. Knobs the engine does not have are dropped
+    so they do not split batches.
+    :param engine: The index engine, see INDEX_ENGINES
+    :param nprobe: The number of inverted lists to scan (ivf, ivfpq)
+    :param ef_search: The HNSW candidate list size (hnsw)
+    """
+    if engine in ("ivf", "ivfpq"):
+        return SearchParams(nprobe=_clamp(nprobe, default_nprobe, max_nprobe))
+    if engine == "hnsw":
+        return SearchParams(ef_search=_clamp(ef_search, default_ef_search, max_ef_search))
+    return SearchParams()
+
+
+def range_search(
+    index, query_embeddings: np.ndarray, top_k: int, params: SearchParams, initial_k: int = 16, growth: int = 4
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """
+    Find the hits of every query scoring at least params.threshold, at most top_k of them. The index is searched for
+    the initial_k best hits first; the queries whose last hit still passes the threshold may have more and are
+    searched again for growth times as many, until top_k. Few queries need the larger searches when the threshold is
+    selective, and the buffers never exceed top_k hits per query however permissive it is, which a faiss range search
+    over the whole database could not guarantee.
+    :param index: The index, see SimilaritySearchIndex.search
+    :param query_embeddings: The (N, D) query embeddings
+    :param top_k: The most hits returned per query
+    :param params: The search knobs, with the threshold
+    :return: Per-query hit scores and hit indices, best first, of varying lengths
+    """
+    total_scores = [np.empty(0, dtype=np.float32)] * len(query_embeddings)
+    total_indices = [np.empty(0, dtype=np.int64)] * len(query_embeddings)
+    pending = np.arange(len(query_embeddings))
+    k = min(initial_k, top_k)
+    while len(pending):
+        found_scores, found_indices = index.search(query_embeddings[pending], k, params)
+        saturated = []
+        for position, scores, indices in zip(pending.tolist(), found_scores, found_indices):
+            scores, indices = np.asarray(scores), np.asarray(indices)
+            keep = (scores >= params.threshold) & (indices >= 0)
+            if k < top_k and len(scores) == k and keep[-1]:
+                saturated.append(position)
+            else:
+                total_scores[position], total_indices[position] = scores[keep], indices[keep]
+        pending = np.array(saturated, dtype=np.int64)
+        k = min(k * growth, top_k)
+    return total_scores, total_indices
+
+
+def read_faiss_index(index_path: str | Path, mmap: bool = False):
+    """
+    Read a faiss index file
+    :param index_path: The index file
+    :param mmap: Map the vectors and inverted lists of the file instead of reading them: they are paged in from the
+        page cache when searched, and every process opening the file shares one copy of them. faiss 1.9 and later map
+        flat, ivf and hnsw vectors; older versions only the inverted lists of ivf indexes.
+    """
+    import faiss
+
+    if not mmap:
+        return faiss.read_index(str(index_path))
+    return faiss.read_index(str(index_path), getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP))
+
+
+class SimilaritySearchIndex:
+    """The exact flat index the SimilaritySearch loads with the dataset"""
+
+    engine = "flat"
+
+    def __init__(self, ss):
+        """
+        Initialize the SimilaritySearchIndex
+        :param ss: The SimilaritySearch object holding the index
+        """
+        self.ss = ss
+
+    def search_params(self, nprobe: int | None = None, ef_search: int | None = None) -> SearchParams:
+        """Exact search has no knobs, the requested ones are ignored"""
+        return SearchParams()
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int, params: SearchParams = SearchParams()
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Search the index
+        :param query_embeddings: The (N, D) query embeddings
+        :param top_k: The number of hits to return for each query
+        :param params: The search knobs returned by search_params
+        :return: Per-query hit scores and hit indices, best first
+        """
+        search_results, _ = self.ss.search(query_embedding=query_embeddings, top_k=top_k)
+        return search_results.total_scores, search_results.total_indices
+
+
+class FaissIndex:
+    """
+    An approximate index built from the embeddings of the hit store, traded against the exact flat index for lower
+    latency (ivf, hnsw) or memory (ivfpq):
+    - ivf: inverted lists over nlist k-means clusters, nprobe of which are scanned per query
+    - ivfpq: the same inverted lists holding product-quantized vectors, pq_m codes of pq_nbits bits each
+    - hnsw: a graph with hnsw_m neighbours per node, searched with a candidate list of ef_search entries
+
+    The index file is stored with a JSON sidecar recording how it was built. Like the flat index, hits are ranked
+    by inner product; when the database embeddings are unit vectors, queries are normalized as well so scores
+    remain cosine similarities.
+    """
+
+    def __init__(
+        self,
+        index,
+        manifest: dict,
+        default_nprobe: int = 16,
+        max_nprobe: int = 256,
+        default_ef_search: int = 64,
+        max_ef_search: int = 512,
+    ):
+        """
+        Initialize the FaissIndex
+        :param index: The faiss index
+        :param manifest: How the index was built, see FaissIndex.build
+        :param default_nprobe: The number of inverted lists scanned when the request does not choose
+        :param max_nprobe: The largest nprobe a request may choose
+        :param default_ef_search: The HNSW candidate list size when the request does not choose
+        :param max_ef_search: The largest ef_search a request may choose
+        """
+        self.index = index
+        self.manifest = manifest
+        self.engine = manifest["engine"]
+        self.default_nprobe = default_nprobe
+        self.max_nprobe = max_nprobe
+        self.default_ef_search = default_ef_search
+        self.max_ef_search = max_ef_search
+
+    @staticmethod
+    def factory_string(engine: str, num_rows: int, nlist: int = 0, pq_m: int = 64, pq_nbits: int = 8, hnsw_m: int = 32):
+        """
+        The faiss index_factory description of an engine
+        :param nlist: The number of inverted lists, 0 for 4 * sqrt(num_rows) (at least 39 training rows per list)
+        """
+        if engine == "hnsw":
+            return f"HNSW{hnsw_m},Flat"
+        if not nlist:
+            nlist = max(1, min(int(4 * math.sqrt(num_rows)), num_rows // 39))
+        if engine == "ivf":
+            return f"IVF{nlist},Flat"
+        if engine == "ivfpq":
+            return f"IVF{nlist},PQ{pq_m}x{pq_nbits}"
+        raise ValueError(f"Unknown index engine {engine}, expected one of {INDEX_ENGINES[1:]}")
+
+    @classmethod
+    def build(
+        cls,
+        hit_store: HitStore,
+        index_path: str | Path,
+        engine: str,
+        nlist: int = 0,
+        pq_m: int = 64,
+        pq_nbits: int = 8,
+        hnsw_m: int = 32,
+        train_size: int = 100000,
+        chunk_size: int = 65536,
+        **kwargs,
+    ) -> "FaissIndex":
+        """
+        Build an index from the embeddings of a hit store and write it to index_path. The rows of the index are the
+        rows of the hit store. Vectors are added in chunks read from the memory-mapped store.
+        :param hit_store: The hit store holding the database embeddings
+        :param index_path: Where to write the index
+        :param engine: One of ivf, ivfpq or hnsw
+        :param train_size: The number of rows sampled to train the inverted lists and the quantizer
+        :param chunk_size: The number of rows added at a time
+        :param kwargs: The search limits passed to FaissIndex
+        :return: The FaissIndex
+        """
+        import faiss
+
+        index_path = Path(index_path)
+        num_rows, dim = hit_store.embeddings.shape
+        description = cls.factory_string(engine, num_rows, nlist, pq_m, pq_nbits, hnsw_m)
+        logging.info(f"Building {engine} index {index_path} ({description}) from {num_rows} rows")
+
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(num_rows, size=min(train_size, num_rows), replace=False))
+        sample = np.ascontiguousarray(hit_store.get_embeddings(sample_rows), dtype=np.float32)
+        normalize = bool(np.allclose(np.linalg.norm(sample, axis=1), 1, atol=1e-3))
+
+        index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            if normalize:
+                faiss.normalize_L2(sample)
+            index.train(sample)
+        for start in range(0, num_rows, chunk_size):
+            # A copy, the store is mapped read-only and normalize_L2 works in place
+            chunk = np.array(hit_store.embeddings[start : start + chunk_size], dtype=np.float32, order="C")
+            if normalize:
+                faiss.normalize_L2(chunk)
+            index.add(chunk)
+
+        manifest = {
+            "engine": engine,
+            "factory": description,
+            "metric": "inner_product",
+            "normalize_queries": normalize,
+            "num_rows": num_rows,
+            "dim": dim,
+            "source": str(hit_store.store_dir),
+        }
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the final path and renamed into place, like the hit store
+        tmp_path = index_path.with_name(f"{index_path.name}.tmp-{os.getpid()}")
+        faiss.write_index(index, str(tmp_path))
+        with open(f"{tmp_path}.json", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{tmp_path}.json", f"{index_path}.json")
+        os.replace(tmp_path, index_path)
+        return cls(index, manifest, **kwargs)
+
+    @classmethod
+    def open_or_build(
+        cls, hit_store: HitStore, index_dir: str | Path, engine: str, mmap: bool = False, **kwargs
+    ) -> "FaissIndex":
+        """
+        Open the index of an engine from index_dir, building it from the hit store on first use. The file is named
+        after the faiss description, so changing the build settings builds a new index.
+        :param mmap: Map the index file, see read_faiss_index. A freshly built index is reopened mapped.
+        :param kwargs: The build settings and search limits, see FaissIndex.build
+        """
+        build_settings = {key: kwargs[key] for key in ("nlist", "pq_m", "pq_nbits", "hnsw_m") if key in kwargs}
+        description = cls.factory_string(engine, len(hit_store), **build_settings)
+        index_path = Path(index_dir) / f"{description.replace(',', '_')}.faiss"
+        search_limits = {key: value for key, value in kwargs.items() if key.endswith(("nprobe", "ef_search"))}
+        if index_path.exists():
+            return cls.open(index_path, mmap=mmap, **search_limits)
+        index = cls.build(hit_store, index_path, engine, **kwargs)
+        if mmap:
+            return cls.open(index_path, mmap=True, **search_limits)
+        return index
+
+    @classmethod
+    def open(cls, index_path: str | Path, mmap: bool = False, **kwargs) -> "FaissIndex":
+        """
+        Open an index written by FaissIndex.build
+        :param index_path: The index file
+        :param mmap: Map the index file, see read_faiss_index
+        :param kwargs: The search limits passed to FaissIndex
+        """
+        with open(f"{index_path}.json") as f:
+            manifest = json.load(f)
+        return cls(read_faiss_index(index_path, mmap), manifest, **kwargs)
+
+    @classmethod
+    def open_flat(
+        cls, index_path: str | Path, mmap: bool = False, normalize_queries: bool | None = None, **kwargs
+    ) -> "FaissIndex":
+        """
+        Open the exact index written with a dataset (see build_index), to search it without a SimilaritySearch
+        :param index_path: The index file
+        :param mmap: Map the index file, see read_faiss_index
+        :param normalize_queries: Whether the database holds unit vectors, the normalized flag of the build
+            manifest. None to tell from a sample of the stored vectors, as FaissIndex.build does.
+        :param kwargs: The search limits passed to FaissIndex, unused by exact search
+        """
+        index = read_faiss_index(index_path, mmap)
+        if normalize_queries is None:
+            sample = index.reconstruct_n(0, min(index.ntotal, 1000))
+            normalize_queries = bool(len(sample)) and bool(np.allclose(np.linalg.norm(sample, axis=1), 1, atol=1e-3))
+        # Queries are normalized like the approximate indexes do, so a threshold means the same on every engine
+        manifest = {"engine": "flat", "normalize_queries": normalize_queries}
+        return cls(index, manifest, **kwargs)
+
+    def search_params(self, nprobe: int | None = None, ef_search: int | None = None) -> SearchParams:
+        """The knobs of a request, see clamp_search_params"""
+        return clamp_search_params(
+            self.engine,
+            nprobe,
+            ef_search,
+            self.default_nprobe,
+            self.max_nprobe,
+            self.default_ef_search,
+            self.max_ef_search,
+        )
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int, params: SearchParams = SearchParams()
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Search the index, see SimilaritySearchIndex.search
+        """
+        import faiss
+
+        queries = np.array(query_embeddings, dtype=np.float32, order="C")
+        if self.manifest["normalize_queries"]:
+            faiss.normalize_L2(queries)
+        # The knobs are passed with each search rather than set on the shared index, so searches run concurrently
+        search_parameters = None
+        if self.engine in ("ivf", "ivfpq"):
+            search_parameters = faiss.SearchParametersIVF(nprobe=params.nprobe or self.default_nprobe)
+        elif self.engine == "hnsw":
+            search_parameters = faiss.SearchParametersHNSW(
+                efSearch=max(params.ef_search or self.default_ef_search, top_k)
+            )
+        scores, indices = self.index.search(queries, top_k, params=search_parameters)
+        return list(scores), list(indices)
@@ -0,0 +1,88 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from dependencies.metrics import QUEUED_QUERIES
+
+
+class InferenceQueueFullError(Exception):
+    """Raised when admitting a request would exceed the inference queue capacity"""
+
+    def __init__(self, queued: int, requested: int, capacity: int, retry_after: int):
+        self.queued = queued
+        self.requested = requested
+        self.capacity = capacity
+        self.retry_after = retry_after
+        super().__init__(
+            f"Inference queue is full ({queued} of {capacity} queries queued, {requested} requested). "
+            f"Retry after {retry_after} seconds."
+        )
+
+
+class InferenceExecutor:
+    """
+    Dedicated thread pool for model inference and index search, kept off the event loop.
+
+    Requests are admitted by their number of queries. Once max_queued_queries are waiting or running,
+    new requests are rejected immediately instead of queueing up unbounded latency.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queued_queries: int = 2000, retry_after_seconds: int = 5):
+        """
+        Initialize the InferenceExecutor
+        :param max_workers: The number of threads running inference
+        :param max_queued_queries: The maximum number of queries admitted at once
+        :param retry_after_seconds: The Retry-After value suggested to rejected clients
+        """
+        self.max_workers = max_workers
+        self.max_queued_queries = max_queued_queries
+        self.retry_after_seconds = retry_after_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._queued = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, num_queries: int):
+        """
+        Reserve room for num_queries in the queue for the duration of the block.
+        A request larger than the whole queue is still admitted when nothing else is queued.
+        :param num_queries: The number of queries the request will submit
+        :raises: InferenceQueueFullError if the queue cannot take the request
+        """
+        with self._lock:
+            if self._queued and self._queued + num_queries > self.max_queued_queries:
+                self._rejected += 1
+                raise InferenceQueueFullError(
+                    queued=self._queued,
+                    requested=num_queries,
+                    capacity=self.max_queued_queries,
+                    retry_after=self.retry_after_seconds,
+                )
+            self._queued += num_queries
+        QUEUED_QUERIES.inc(num_queries)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._queued -= num_queries
+            QUEUED_QUERIES.dec(num_queries)
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking function on the inference threads and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued_queries": self._queued,
+                "max_queued_queries": self.max_queued_queries,
+                "rejected_requests": self._rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,274 @@
+import asyncio
+import dataclasses
+import fcntl
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from dependencies.fasta import iter_chunks, read_fasta
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+@dataclass
+class Job:
+    job_id: str
+    input_path: str
+    num_sequences: int
+    parameters: dict
+    status: str = QUEUED
+    processed: int = 0
+    chunks: int = 0
+    error: str | None = None
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+
+    def status_dict(self) -> dict:
+        """The job as reported to clients"""
+        progress = self.processed / self.num_sequences if self.num_sequences else 1.0
+        return {key: value for key, value in dataclasses.asdict(self).items() if key != "input_path"} | {
+            "progress": progress
+        }
+
+
+class JobManager:
+    """
+    Runs bulk similarity jobs over FASTA files too large for one request.
+
+    Every job lives in its own directory of jobs_dir:
+    - input.fasta or input.fasta.gz: the uploaded FASTA file, unless the job references a file on the server
+    - job.json: the Job, rewritten after every chunk
+    - results/chunk_00000.ndjson.gz, ...: the QueryProtein lines of each chunk of chunk_size sequences, gzipped
+
+    The sequences are searched chunk by chunk with search_chunk, and each chunk is persisted before the next one
+    starts. A job interrupted by a restart resumes at its first unwritten chunk. The job being run is locked with
+    flock, so server processes sharing jobs_dir never run the same job twice.
+    """
+
+    JOB_FILE = "job.json"
+    LOCK_FILE = "job.lock"
+    RESULTS_DIR = "results"
+    # Job directories without a job.json older than this are uploads interrupted by a restart
+    STALE_UPLOAD_SECONDS = 24 * 3600
+
+    def __init__(self, jobs_dir: str | Path, search_chunk, workers: int = 1, chunk_size: int = 1000):
+        """
+        Initialize the JobManager
+        :param jobs_dir: Where the jobs are kept
+        :param search_chunk: An async function of (job parameters, headers, sequences) returning the NDJSON lines of
+            the chunk
+        :param workers: The number of jobs run at once
+        :param chunk_size: The number of sequences searched and written at a time
+        """
+        self.jobs_dir = Path(jobs_dir)
+        self.search_chunk = search_chunk
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._loop = None
+        self._queue = None
+        self._tasks = []
+
+    def _job_dir(self, job_id: str) -> Path:
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            raise KeyError(job_id)
+        return self.jobs_dir / job_id
+
+    def chunk_path(self, job_id: str, chunk: int) -> Path:
+        return self._job_dir(job_id) / self.RESULTS_DIR / f"chunk_{chunk:05d}.ndjson.gz"
+
+    def get(self, job_id: str) -> Job | None:
+        """Read the current state of a job, as written by whichever process runs it"""
+        try:
+            with open(self._job_dir(job_id) / self.JOB_FILE) as f:
+                return Job(**json.load(f))
+        except (KeyError, FileNotFoundError):
+            return None
+
+    def list(self) -> list[Job]:
+        """Every submitted job, oldest first"""
+        if not self.jobs_dir.is_dir():
+            return []
+        jobs = (self.get(job_dir.name) for job_dir in self.jobs_dir.iterdir() if job_dir.is_dir())
+        return sorted((job for job in jobs if job is not None), key=lambda job: job.created)
+
+    def _write(self, job: Job):
+        job_dir = self._job_dir(job.job_id)
+        tmp_path = job_dir / f"{self.JOB_FILE}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(dataclasses.asdict(job), f)
+        os.replace(tmp_path, job_dir / self.JOB_FILE)
+
+    def create(self) -> tuple[str, Path]:
+        """Create the directory of a new job, to receive its input before it is submitted"""
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        (job_dir / self.RESULTS_DIR).mkdir(parents=True)
+        return job_id, job_dir
+
+    def discard(self, job_id: str):
+        """Remove a job that could not be submitted"""
+        shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+
+    def submit(self, job_id: str, input_path: str | Path, num_sequences: int, parameters: dict) -> Job:
+        """
+        Queue a created job
+        :param job_id: The id returned by create
+        :param input_path: The FASTA file of the job
+        :param num_sequences: The number of sequences in the FASTA file
+        :param parameters: The search parameters passed to search_chunk
+        :return: The queued Job
+        """
+        self._ensure_workers()
+        job = Job(job_id, str(input_path), num_sequences, parameters)
+        self._write(job)
+        self._queue.put_nowait(job_id)
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job and remove it with its results. A job run by another process is marked cancelled and removed by
+        that process after its current chunk.
+        :return: False if there is no such job
+        """
+        job = self.get(job_id)
+        if job is None:
+            return False
+        with self._locked(job_id) as locked:
+            if locked:
+                self.discard(job_id)
+                return True
+        job.status = CANCELLED
+        self._write(job)
+        return True
+
+    def _locked(self, job_id: str):
+        return _JobLock(self._job_dir(job_id) / self.LOCK_FILE)
+
+    async def start(self):
+        """Resume the unfinished jobs, e.g. on server startup"""
+        self._ensure_workers()
+
+    async def stop(self):
+        """Stop running jobs, they resume with their first unwritten chunk on the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _ensure_workers(self):
+        """Start the workers on the running event loop and queue the unfinished jobs found in jobs_dir"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and any(not task.done() for task in self._tasks):
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._remove_stale_uploads()
+        for job in self.list():
+            if job.status in (QUEUED, RUNNING):
+                self._queue.put_nowait(job.job_id)
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    def _remove_stale_uploads(self):
+        if not self.jobs_dir.is_dir():
+            return
+        for job_dir in self.jobs_dir.iterdir():
+            if job_dir.is_dir() and not (job_dir / self.JOB_FILE).exists():
+                if time.time() - job_dir.stat().st_mtime > self.STALE_UPLOAD_SECONDS:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception:
+                logging.exception(f"Bulk job {job_id} could not be run")
+
+    async def _run(self, job_id: str):
+        with self._locked(job_id) as locked:
+            job = self.get(job_id)
+            # Another process runs the job, or it was finished or removed meanwhile
+            if not locked or job is None or job.status not in (QUEUED, RUNNING):
+                return
+            job.status = RUNNING
+            self._write(job)
+            logging.info(f"Running bulk job {job_id} from sequence {job.processed} of {job.num_sequences}")
+            try:
+                await self._run_chunks(job)
+            except Exception as e:
+                logging.exception(f"Bulk job {job_id} failed")
+                job.status = FAILED
+                job.error = str(e)
+            if job.status == CANCELLED or self.get(job_id).status == CANCELLED:
+                self.discard(job_id)
+                return
+            if job.status == RUNNING:
+                job.status = DONE
+            job.updated = time.time()
+            self._write(job)
+
+    async def _run_chunks(self, job: Job):
+        records = read_fasta(job.input_path)
+        # Resume after the chunks written before a restart
+        chunks = itertools.islice(iter_chunks(records, self.chunk_size), job.chunks, None)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                headers, sequences = chunk
+                lines = await self.search_chunk(job.parameters, headers, sequences)
+                await asyncio.to_thread(self._write_chunk, job.job_id, job.chunks, lines)
+                if self.get(job.job_id).status == CANCELLED:
+                    job.status = CANCELLED
+                    return
+                job.chunks += 1
+                job.processed += len(headers)
+                job.updated = time.time()
+                self._write(job)
+        finally:
+            records.close()
+
+    def _write_chunk(self, job_id: str, chunk: int, lines: bytes):
+        path = self.chunk_path(job_id, chunk)
+        tmp_path = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            f.write(gzip.compress(lines, compresslevel=6))
+        os.replace(tmp_path, path)
+
+
+class _JobLock:
+    """An exclusive, non-blocking flock on the lock file of a job, held by at most one process"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self) -> bool:
+        try:
+            self._file = open(self.path, "a")
+        except FileNotFoundError:  # The job was removed
+            return False
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,71 @@
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+
+def tail_lines(path: str, n: int, block_size: int = 65536) -> list[str]:
+    """
+    Read the last n lines of a file by reading blocks backwards from its end, so the cost depends on the size of
+    the lines returned rather than on the size of the file
+    :param path: The file to read
+    :param n: The number of lines to return
+    :param block_size: The number of bytes read at a time
+    :return: Up to n lines, oldest first, without their line endings
+    """
+    if n <= 0:
+        return []
+    blocks = []
+    newlines = 0
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        # One newline more than n guarantees the first of the n lines is complete
+        while position > 0 and newlines <= n:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size)
+            blocks.append(block)
+            newlines += block.count(b"\n")
+    lines = b"".join(reversed(blocks)).splitlines()
+    return [line.decode("utf-8", errors="replace") for line in lines[-n:]]
+
+
+class SimilarityLog:
+    """
+    Bounded in-memory ring buffer of the summaries of the latest similarity requests handled by this process.
+    Once max_entries are held, recording a request drops the oldest one.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        """
+        Initialize the SimilarityLog
+        :param max_entries: The number of request summaries kept
+        """
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def record(self, summary: dict):
+        """
+        Record the summary of a similarity request
+        :param summary: The summary returned with the response
+        """
+        entry = {
+            "type": "similarity_process_info",
+            "timestamp": time.time(),
+            "sequences": summary["num_sequences"],
+            "length": summary["total_sequence_length"],
+            "hits": summary["response_size"],
+            "execution_time": summary["execution_time"],
+        }
+        with self._lock:
+            self._entries.append(entry)
+
+    def last(self, n: int) -> list[dict]:
+        """The latest n entries, oldest first"""
+        if n <= 0:
+            return []
+        with self._lock:
+            # Only the n entries returned are copied, a deque iterates backwards from its end
+            return list(itertools.islice(reversed(self._entries), n))[::-1]
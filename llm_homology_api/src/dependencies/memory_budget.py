@@ -0,0 +1,200 @@
+import gc
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+
+from dependencies.metrics import EMBED_PASS_SPLITS, EMBED_TOKEN_BUDGET
+from dependencies.windowing import length_sorted_batches
+
+
+def padded_tokens(sequences: list[str]) -> int:
+    """The tokens of a forward pass over the sequences: each padded to the longest, plus its BOS and EOS tokens"""
+    return len(sequences) * (max(map(len, sequences)) + 2) if sequences else 0
+
+
+def is_out_of_memory(error: Exception) -> bool:
+    """Whether an error of a forward pass is the device or the host running out of memory"""
+    if isinstance(error, MemoryError) or type(error).__name__ == "OutOfMemoryError":  # torch.cuda.OutOfMemoryError
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def release_memory():
+    """Free what a failed forward pass left behind, including the blocks cached by the CUDA allocator"""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def current_rss() -> int | None:
+    """The resident set size of the process in bytes, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the process (Linux 4.0+), so peak_rss measures what follows"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int | None:
+    """The peak resident set size of the process in bytes since it started or since reset_peak_rss"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class BudgetedEmbedder:
+    """
+    Embeds the sequences of a batch in forward passes bounded by a budget of padded tokens rather than by a count, the
+    activation memory of a pass growing with its padded tokens.
+
+    The sequences are sorted by length and packed into passes of at most token_budget padded tokens, so a batch of
+    short sequences runs in one pass while long ones are spread over several. A pass that runs out of memory (CUDA,
+    or the host allocator) is split in halves that are retried, and the budget is lowered to half the tokens of the
+    pass that failed. The budget then grows by a quarter after grow_after passes in a row were limited by it, up to
+    max_token_budget but never to the size of a pass that failed: it settles on the largest budget that is safe.
+
+    With memory_limit_bytes, the process (the host side on a GPU) also keeps its resident set size under the limit: the
+    peak RSS of each pass is measured to learn the activation bytes per token, and a pass that would not fit in the
+    room left under the limit is split before it runs. A single sequence runs whatever its size; windowing bounds the
+    tokens of one input.
+    """
+
+    def __init__(
+        self,
+        embed,
+        token_budget: int = 32768,
+        max_token_budget: int = 131072,
+        memory_limit_bytes: int = 0,
+        grow_after: int = 32,
+    ):
+        """
+        Initialize the BudgetedEmbedder
+        :param embed: Returns the (N, D) pooled embeddings of a list of sequences, e.g. Esm2Embedder.embed_pooled
+        :param token_budget: The padded tokens of a pass to start with
+        :param max_token_budget: The largest budget the embedder grows to
+        :param memory_limit_bytes: The resident set size of the process passes are kept under, 0 for no limit
+        :param grow_after: The passes in a row limited by the budget before it grows
+        """
+        self.embed = embed
+        self.token_budget = token_budget
+        self.max_token_budget = max(max_token_budget, token_budget)
+        self.memory_limit_bytes = memory_limit_bytes
+        self.grow_after = grow_after
+        self.failed_tokens = None  # The fewest tokens of a pass that ran out of memory
+        self.bytes_per_token = None  # The most activation bytes per token a pass was measured with
+        self._limited_passes = 0
+        self._lock = threading.Lock()
+        if memory_limit_bytes and current_rss() is None:
+            logging.warning("The resident set size of the process cannot be read, memory_limit_bytes is ignored")
+            self.memory_limit_bytes = 0
+        EMBED_TOKEN_BUDGET.set(self.token_budget)
+
+    def __call__(self, sequences: list[str]) -> np.ndarray:
+        """
+        Embed sequences in passes of at most token_budget padded tokens
+        :return: The (len(sequences), D) float32 embeddings, in the order of sequences
+        """
+        if not sequences:
+            return np.asarray(self.embed(sequences), dtype=np.float32)
+        passes = length_sorted_batches(sequences, self.token_budget)
+        embeddings = None
+        for positions in passes:
+            pass_embeddings = self._embed_pass([sequences[position] for position in positions])
+            if embeddings is None:
+                embeddings = np.empty((len(sequences), pass_embeddings.shape[1]), dtype=np.float32)
+            embeddings[positions] = pass_embeddings
+            # A pass cut short by the budget, rather than by the end of the batch, asks for a larger budget
+            self._passed(budget_limited=len(passes) > 1)
+        return embeddings
+
+    def _embed_pass(self, sequences: list[str]) -> np.ndarray:
+        tokens = padded_tokens(sequences)
+        if len(sequences) > 1 and not self._fits_memory_limit(tokens):
+            EMBED_PASS_SPLITS.labels(reason="memory_limit").inc()
+            return self._embed_halves(sequences)
+        measure = self.memory_limit_bytes and reset_peak_rss()
+        rss_before = current_rss() if measure else None
+        try:
+            embeddings = np.asarray(self.embed(sequences), dtype=np.float32)
+        except Exception as e:
+            if not is_out_of_memory(e) or len(sequences) == 1:
+                raise
+            release_memory()
+            self._ran_out_of_memory(tokens)
+            logging.warning(f"A pass of {tokens} tokens ran out of memory, the token budget is now {self.token_budget}")
+            EMBED_PASS_SPLITS.labels(reason="out_of_memory").inc()
+            return self._embed_halves(sequences)
+        if rss_before is not None:
+            peak = peak_rss()
+            if peak is not None:
+                self._measured(tokens, peak - rss_before)
+        return embeddings
+
+    def _embed_halves(self, sequences: list[str]) -> np.ndarray:
+        half = len(sequences) // 2
+        return np.concatenate([self._embed_pass(sequences[:half]), self._embed_pass(sequences[half:])])
+
+    def _fits_memory_limit(self, tokens: int) -> bool:
+        if not self.memory_limit_bytes or self.bytes_per_token is None:
+            return True
+        room = self.memory_limit_bytes - (current_rss() or 0)
+        return tokens * self.bytes_per_token <= room
+
+    def _measured(self, tokens: int, activation_bytes: int):
+        with self._lock:
+            bytes_per_token = max(activation_bytes, 0) / tokens
+            # The largest measured, decaying slowly so one noisy pass does not shrink every later one for good
+            previous = self.bytes_per_token or 0.0
+            self.bytes_per_token = max(bytes_per_token, previous * 0.99)
+
+    def _ran_out_of_memory(self, tokens: int):
+        with self._lock:
+            self.failed_tokens = tokens if self.failed_tokens is None else min(self.failed_tokens, tokens)
+            self.token_budget = max(min(self.token_budget, tokens // 2), 1)
+            self._limited_passes = 0
+            EMBED_TOKEN_BUDGET.set(self.token_budget)
+
+    def _passed(self, budget_limited: bool):
+        with self._lock:
+            if not budget_limited:
+                return
+            self._limited_passes += 1
+            if self._limited_passes < self.grow_after:
+                return
+            self._limited_passes = 0
+            ceiling = self.max_token_budget
+            if self.failed_tokens is not None:
+                ceiling = min(ceiling, self.failed_tokens - 1)
+            if self.token_budget < ceiling:
+                self.token_budget = min(ceiling, self.token_budget + max(self.token_budget // 4, 1))
+                EMBED_TOKEN_BUDGET.set(self.token_budget)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "token_budget": self.token_budget,
+                "max_token_budget": self.max_token_budget,
+                "failed_tokens": self.failed_tokens,
+                "bytes_per_token": self.bytes_per_token,
+                "memory_limit_bytes": self.memory_limit_bytes,
+            }
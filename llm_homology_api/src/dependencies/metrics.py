@@ -0,0 +1,112 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    disable_created_metrics,
+    generate_latest,
+    multiprocess,
+)
+
+# The _created series only repeat when each worker started
+disable_created_metrics()
+
+PROMETHEUS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def multiprocess_dir() -> str | None:
+    """
+    The directory the metrics of every worker are written to, when the server runs several uvicorn workers.
+    PROMETHEUS_MULTIPROC_DIR must be set, to an empty directory, before the workers start.
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or None
+
+
+def render_metrics() -> bytes:
+    """The metrics in the Prometheus text format: those of every worker in multiprocess mode, of this one otherwise"""
+    path = multiprocess_dir()
+    if path is None:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid: int | None = None):
+    """Drop the live gauges of a worker that exits, in multiprocess mode"""
+    path = multiprocess_dir()
+    if path is not None:
+        multiprocess.mark_process_dead(os.getpid() if pid is None else pid, path)
+
+
+# The stages of a /similarity request. Embedding and search run once per batch of queries from concurrent requests.
+# Tokenization and model_forward are only recorded when queries are embedded by Esm2Embedder (EMBEDDER_ENGINE int8 or
+# onnx, or INDEX_SHARDS): the protein_search embedder of the default torch engine does both in one call
+STAGE_SECONDS = Histogram(
+    "llm_homology_stage_seconds",
+    "Time spent in each stage of a similarity request (validation, queue, sequence_lookup, embed, tokenization and "
+    "model_forward when not embedded by the default torch engine, search, hit_gather, response_build, serialization)",
+    labelnames=("stage",),
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "llm_homology_request_seconds", "Time to handle a similarity request once validated", buckets=LATENCY_BUCKETS
+)
+BATCH_SIZE = Histogram(
+    "llm_homology_batch_size",
+    "The number of queries embedded and searched together",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+QUERIES = Counter("llm_homology_queries_total", "Query sequences received")
+RESIDUES = Counter("llm_homology_residues_total", "Residues of the query sequences received")
+HITS = Counter("llm_homology_hits_total", "Hits returned after pruning")
+EMBEDDING_CACHE_LOOKUPS = Counter(
+    "llm_homology_embedding_cache_lookups_total", "Query embedding cache lookups", labelnames=("result",)
+)
+SEQUENCE_INDEX_LOOKUPS = Counter(
+    "llm_homology_sequence_index_lookups_total",
+    "Queries looked up in the database sequences before embedding",
+    labelnames=("result",),
+)
+JOB_QUERIES = Counter("llm_homology_job_queries_total", "Query sequences of bulk jobs searched")
+REJECTED_REQUESTS = Counter(
+    "llm_homology_rejected_requests_total",
+    "Requests rejected with a 429, because the inference queue was full (queue) or the user quota used up (quota)",
+    labelnames=("reason",),
+)
+EMBED_PASS_SPLITS = Counter(
+    "llm_homology_embed_pass_splits_total",
+    "Forward passes split in halves, because they ran out of memory (out_of_memory) or would exceed the memory limit "
+    "(memory_limit)",
+    labelnames=("reason",),
+)
+# In multiprocess mode the gauges of the live workers are summed, but each worker learns its own token budget
+EMBED_TOKEN_BUDGET = Gauge(
+    "llm_homology_embed_token_budget",
+    "The padded tokens a forward pass may hold at most",
+    multiprocess_mode="liveall",
+)
+QUEUED_QUERIES = Gauge(
+    "llm_homology_inference_queued_queries", "Queries admitted and not yet answered", multiprocess_mode="livesum"
+)
+EMBEDDING_CACHE_BYTES = Gauge(
+    "llm_homology_embedding_cache_bytes", "Bytes held by the query embedding cache", multiprocess_mode="livesum"
+)
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware stamping each request with the time it was received, before its body is read and validated"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
@@ -12,7 +12,7 @@ from config import get_settings
 ALPHANUMERIC_PATTERN = r"^[a-zA-Z0-9]+$"
 
 
-def is_authorized(
+async def is_authorized(
     request: Request,
     authorization: str = Header(
         None,
@@ -42,7 +42,7 @@ def is_authorized(
         )
     try:
         ac = request.app.state.auth_client  # type: CachedAuthClient
-        return ac.is_authorized(token=authorization if authorization else kbase_session)
+        return await ac.is_authorized(token=authorization if authorization else kbase_session)
     except HTTPException as e:
         if e.status_code == 401:
             raise e
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from dependencies.embedding_cache import normalize_sequence
+from dependencies.hit_store import HitStore
+
+
+def sequence_digests(sequences: list[str]) -> np.ndarray:
+    """
+    The 64-bit BLAKE2b digest of each protein sequence, as a uint64 array. The sequences are normalized first, so
+    the database and the queries are hashed alike whatever their case and whitespace.
+    """
+    return np.fromiter(
+        (
+            int.from_bytes(hashlib.blake2b(normalize_sequence(s).encode(), digest_size=8).digest(), "little")
+            for s in sequences
+        ),
+        dtype=np.uint64,
+        count=len(sequences),
+    )
+
+
+class SequenceIndex:
+    """
+    The exact sequences of a database, mapped to their rows, so queries already in the database reuse the embedding
+    stored in the hit store instead of going through the model.
+
+    A store directory holds:
+    - digests.npy: the uint64 digest of every database sequence, sorted, searched with a binary search
+    - rows.npy: the database row of each digest
+    - norms.npy: the norm of the embedding of each database row before it was stored as a unit vector (1 when it was
+      stored as pooled), so the embedding of a query is restored as the model returned it up to the stored precision
+    - sequence_index.json: the model and the windows the database was embedded with
+
+    The files are memory-mapped like the hit store. Two sequences share a digest with a probability of about
+    rows / 2^64 per query, negligible next to the stored precision of the embeddings.
+    """
+
+    DIGESTS_FILE = "digests.npy"
+    ROWS_FILE = "rows.npy"
+    NORMS_FILE = "norms.npy"
+    MANIFEST_FILE = "sequence_index.json"
+
+    def __init__(self, index_dir: str | Path, hit_store: HitStore, max_length: int | None = None):
+        """
+        Open an existing sequence index
+        :param index_dir: The directory written by SequenceIndex.write
+        :param hit_store: The hit store of the database, holding the stored embeddings
+        :param max_length: Longer queries are never matched, e.g. when the service splits them into other windows
+            than the database was embedded with
+        """
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / self.MANIFEST_FILE) as f:
+            self.manifest = json.load(f)
+        self.digests = np.load(self.index_dir / self.DIGESTS_FILE, mmap_mode="r")
+        self.rows = np.load(self.index_dir / self.ROWS_FILE, mmap_mode="r")
+        self.norms = np.load(self.index_dir / self.NORMS_FILE, mmap_mode="r")
+        self.hit_store = hit_store
+        self.max_length = max_length
+        if len(self.norms) != len(hit_store):
+            raise ValueError(f"{index_dir} indexes {len(self.norms)} rows but the hit store holds {len(hit_store)}")
+
+    @classmethod
+    def open(
+        cls, index_dir: str | Path, hit_store: HitStore, model_name: str, window_size: int = 0, window_overlap: int = 0
+    ) -> "SequenceIndex | None":
+        """
+        Open the sequence index of a database if its embeddings are those the service would compute
+        :param index_dir: The directory written by SequenceIndex.write
+        :param hit_store: The hit store of the database
+        :param model_name: The checkpoint queries are embedded with
+        :param window_size: The window long queries are split into, see embed_windowed
+        :param window_overlap: The number of residues shared by consecutive windows
+        :return: The SequenceIndex, or None when it is missing or was built with another model
+        """
+        if not (Path(index_dir) / cls.MANIFEST_FILE).exists():
+            logging.info(f"No sequence index in {index_dir}, every query is embedded")
+            return None
+        with open(Path(index_dir) / cls.MANIFEST_FILE) as f:
+            manifest = json.load(f)
+        # build_index names the embedder after the checkpoint and its engine, e.g. "facebook/esm2_t6_8M_UR50D (int8)"
+        if manifest["embedder"] != model_name and not manifest["embedder"].startswith(f"{model_name} ("):
+            logging.warning(f"{index_dir} was embedded by {manifest['embedder']}, not {model_name}; not using it")
+            return None
+        max_length = None
+        if (manifest["window_size"], manifest["window_overlap"]) != (window_size, window_overlap):
+            # Only sequences embedded in one piece by both are embedded alike
+            max_length = min(size for size in (manifest["window_size"], window_size, 2**31) if size)
+        return cls(index_dir, hit_store, max_length=max_length)
+
+    def lookup(self, sequences: list[str]) -> np.ndarray:
+        """
+        Find the database row of each sequence
+        :param sequences: The protein sequences
+        :return: The row of each sequence, -1 for the sequences not in the database
+        """
+        if not sequences or not len(self.digests):
+            return np.full(len(sequences), -1, dtype=np.int64)
+        digests = sequence_digests(sequences)
+        positions = np.minimum(np.searchsorted(self.digests, digests), len(self.digests) - 1)
+        rows = np.where(self.digests[positions] == digests, self.rows[positions], -1)
+        if self.max_length is not None:
+            rows[[len(sequence) > self.max_length for sequence in sequences]] = -1
+        return rows
+
+    def embeddings(self, sequences: list[str]) -> list[np.ndarray | None]:
+        """
+        The stored embedding of each sequence of the database
+        :param sequences: The protein sequences
+        :return: The float32 embedding of each sequence, None for the sequences not in the database
+        """
+        rows = self.lookup(sequences)
+        found = np.flatnonzero(rows >= 0)
+        result = [None] * len(sequences)
+        if len(found):
+            found_rows = rows[found]
+            stored = self.hit_store.get_embeddings(found_rows).astype(np.float32) * self.norms[found_rows][:, None]
+            for position, embedding in zip(found.tolist(), stored):
+                result[position] = embedding
+        return result
+
+    @classmethod
+    def write(
+        cls, index_dir: str | Path, chunks: Iterable[tuple[np.ndarray, np.ndarray]], num_rows: int, **manifest
+    ) -> Path:
+        """
+        Write a sequence index, next to index_dir first and renamed into place like the hit store
+        :param index_dir: The directory to create
+        :param chunks: (digests, norms) chunks of consecutive database rows, see sequence_digests
+        :param num_rows: The total number of rows in the chunks
+        :param manifest: How the database was embedded: model, window_size and window_overlap
+        :return: index_dir
+        """
+        index_dir = Path(index_dir)
+        tmp_dir = index_dir.with_name(f"{index_dir.name}.tmp-{os.getpid()}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        digests = np.empty(num_rows, dtype=np.uint64)
+        norms = np.empty(num_rows, dtype=np.float32)
+        row = 0
+        for chunk_digests, chunk_norms in chunks:
+            digests[row : row + len(chunk_digests)] = chunk_digests
+            norms[row : row + len(chunk_digests)] = chunk_norms
+            row += len(chunk_digests)
+        if row != num_rows:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ValueError(f"Expected {num_rows} rows but the chunks held {row}")
+        # Stable, so a sequence present several times maps to its first row
+        order = np.argsort(digests, kind="stable")
+        np.save(tmp_dir / cls.DIGESTS_FILE, digests[order])
+        np.save(tmp_dir / cls.ROWS_FILE, order.astype(np.int64))
+        np.save(tmp_dir / cls.NORMS_FILE, norms)
+        with open(tmp_dir / cls.MANIFEST_FILE, "w") as f:
+            json.dump({"num_rows": num_rows} | manifest, f)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.rename(tmp_dir, index_dir)
+        return index_dir
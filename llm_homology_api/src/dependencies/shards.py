@@ -0,0 +1,256 @@
+import json
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from dependencies.hit_store import HitStore
+from dependencies.index_engines import FaissIndex, SearchParams, clamp_search_params
+from dependencies.sequence_index import SequenceIndex
+
+# The index of the current shard process, set by _open_shard
+_shard_index = None
+
+
+def read_shard_manifest(manifest_path: str | Path) -> list[dict]:
+    """
+    Read the build manifests of the shards of a database
+    :param manifest_path: A JSON file {"shards": [...]} listing the <output>.manifest.json written by build_index for
+        each shard, in row order. Relative paths are relative to the manifest.
+    :return: The build manifest of each shard
+    """
+    manifest_path = Path(manifest_path)
+    with open(manifest_path) as f:
+        shard_paths = json.load(f)["shards"]
+    if not shard_paths:
+        raise ValueError(f"{manifest_path} lists no shards")
+    shards = []
+    for shard_path in shard_paths:
+        with open(manifest_path.parent / shard_path) as f:
+            shards.append(json.load(f))
+    return shards
+
+
+def open_shard_index(shard: dict, engine: str, **kwargs) -> FaissIndex:
+    """
+    Open the index of a shard
+    :param shard: The build manifest of the shard
+    :param engine: flat for the exact index written with the dataset, or an approximate engine built on first use
+    :param kwargs: The build settings, search limits and mmap, see FaissIndex.open_or_build
+    """
+    if engine == "flat":
+        search_limits = {key: value for key, value in kwargs.items() if key.endswith(("nprobe", "ef_search"))}
+        return FaissIndex.open_flat(
+            shard["flat_index"],
+            mmap=kwargs.get("mmap", False),
+            normalize_queries=shard.get("normalized"),
+            **search_limits,
+        )
+    return FaissIndex.open_or_build(HitStore(shard["hit_store"]), shard["index_dir"], engine, **kwargs)
+
+
+def _open_shard(shard: dict, engine: str, kwargs: dict):
+    global _shard_index
+    _shard_index = open_shard_index(shard, engine, **kwargs)
+
+
+def _shard_rows() -> int:
+    return _shard_index.index.ntotal
+
+
+def _search_shard(query_embeddings: np.ndarray, top_k: int, params: SearchParams) -> tuple[np.ndarray, np.ndarray]:
+    scores, indices = _shard_index.search(query_embeddings, top_k, params)
+    return np.stack(scores), np.stack(indices)
+
+
+class ProcessShard:
+    """
+    A shard searched by its own process, standing in for a remote shard node: the shard index only lives in the
+    memory of that process, and queries and results cross the process boundary by value.
+    """
+
+    def __init__(self, shard: dict, engine: str, **kwargs):
+        """
+        Start the shard process, which opens the shard index in the background
+        :param shard: The build manifest of the shard
+        :param engine: The index engine, see open_shard_index
+        :param kwargs: The build settings and search limits, see FaissIndex.build
+        """
+        self.name = shard["dataset"]
+        # Spawned rather than forked, the server process holds threads and possibly the model
+        self._executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_open_shard,
+            initargs=(shard, engine, kwargs),
+        )
+        self._ready = self._executor.submit(_shard_rows)
+
+    @property
+    def num_rows(self) -> int:
+        """The rows of the shard, once the shard process has opened its index"""
+        return self._ready.result()
+
+    def submit(self, query_embeddings: np.ndarray, top_k: int, params: SearchParams) -> Future:
+        """Search the shard, the future resolves to (N, top_k) scores and shard rows"""
+        return self._executor.submit(_search_shard, query_embeddings, top_k, params)
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+def merge_top_k(
+    results: list[tuple[np.ndarray, np.ndarray]], offsets: list[int], top_k: int
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """
+    Merge the per-shard hits of every query into its top_k hits of the whole database
+    :param results: The (N, k) scores and shard rows found by each shard, -1 where a shard had fewer than k hits
+    :param offsets: The database row of the first row of each shard
+    :param top_k: The number of hits to keep for each query
+    :return: Per-query hit scores and database rows, best first, padded with -1 like a single index
+    """
+    scores = np.concatenate([shard_scores for shard_scores, _ in results], axis=1)
+    indices = np.concatenate(
+        [np.where(rows >= 0, rows + offset, -1) for (_, rows), offset in zip(results, offsets)], axis=1
+    )
+    scores = np.where(indices >= 0, scores, -np.inf)
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+    return list(np.take_along_axis(scores, order, axis=1)), list(np.take_along_axis(indices, order, axis=1))
+
+
+class ShardedIndex:
+    """
+    A database split into shards, each searched in parallel by its own process. The top_k hits of every shard are
+    merged into the top_k hits of the database, whose rows are the shard rows offset by the rows of the shards before
+    it, the rows of the ShardedHitStore. The threshold is applied to the merged hits, as for a single index.
+    """
+
+    def __init__(self, shards: list, engine: str, **kwargs):
+        """
+        Initialize the ShardedIndex
+        :param shards: Objects with num_rows, submit and close, e.g. ProcessShard, in database row order
+        :param engine: The index engine of every shard
+        :param kwargs: The search limits, see FaissIndex
+        """
+        self.shards = shards
+        self.engine = engine
+        self.search_limits = kwargs
+        self.offsets = np.concatenate([[0], np.cumsum([shard.num_rows for shard in shards])[:-1]]).tolist()
+
+    @classmethod
+    def open(cls, manifest_path: str | Path, engine: str = "flat", **kwargs) -> "ShardedIndex":
+        """
+        Start one process per shard of a shard manifest, see read_shard_manifest
+        :param engine: The index engine of every shard, see open_shard_index
+        :param kwargs: The build settings and search limits, see FaissIndex.build
+        """
+        shards = []
+        for shard in read_shard_manifest(manifest_path):
+            logging.info(f"Opening the {engine} index of shard {shard['dataset']}")
+            shards.append(ProcessShard(shard, engine, **kwargs))
+        search_limits = {key: value for key, value in kwargs.items() if key.endswith(("nprobe", "ef_search"))}
+        return cls(shards, engine, **search_limits)
+
+    def search_params(self, nprobe: int | None = None, ef_search: int | None = None) -> SearchParams:
+        """The knobs of a request, see clamp_search_params"""
+        return clamp_search_params(self.engine, nprobe, ef_search, **self.search_limits)
+
+    def search(
+        self, query_embeddings: np.ndarray, top_k: int, params: SearchParams = SearchParams()
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        Search every shard at once and merge their hits, see SimilaritySearchIndex.search
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        futures = [shard.submit(queries, top_k, params) for shard in self.shards]
+        return merge_top_k([future.result() for future in futures], self.offsets, top_k)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+class ShardedHitStore:
+    """The hit stores of the shards of a database, looked up by database row like a single HitStore"""
+
+    def __init__(self, hit_stores: list[HitStore]):
+        """
+        Initialize the ShardedHitStore
+        :param hit_stores: The hit store of each shard, in database row order
+        """
+        self.hit_stores = hit_stores
+        self.offsets = np.cumsum([0] + [len(hit_store) for hit_store in hit_stores])
+
+    @classmethod
+    def open(cls, manifest_path: str | Path) -> "ShardedHitStore":
+        """Open the hit stores of the shards of a shard manifest, see read_shard_manifest"""
+        return cls([HitStore(shard["hit_store"]) for shard in read_shard_manifest(manifest_path)])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def _split(self, indices: np.ndarray):
+        """The positions and shard rows of the requested rows of each shard"""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_of_row = np.searchsorted(self.offsets, indices, side="right") - 1
+        for shard, hit_store in enumerate(self.hit_stores):
+            positions = np.flatnonzero(shard_of_row == shard)
+            if len(positions):
+                yield hit_store, positions, indices[positions] - self.offsets[shard]
+
+    def get_embeddings(self, indices: np.ndarray) -> np.ndarray:
+        """See HitStore.get_embeddings"""
+        first = self.hit_stores[0].embeddings
+        embeddings = np.empty((len(indices), first.shape[1]), dtype=first.dtype)
+        for hit_store, positions, rows in self._split(indices):
+            embeddings[positions] = hit_store.get_embeddings(rows)
+        return embeddings
+
+    def get_tags(self, indices: np.ndarray) -> list[str]:
+        """See HitStore.get_tags"""
+        tags = [""] * len(indices)
+        for hit_store, positions, rows in self._split(indices):
+            for position, tag in zip(positions.tolist(), hit_store.get_tags(rows)):
+                tags[position] = tag
+        return tags
+
+
+class ShardedSequenceIndex:
+    """The sequence indexes of the shards of a database, a sequence reuses the embedding of the first shard holding it"""
+
+    def __init__(self, sequence_indexes: list[SequenceIndex]):
+        """
+        Initialize the ShardedSequenceIndex
+        :param sequence_indexes: The sequence index of each shard that has one, with the hit store of the shard
+        """
+        self.sequence_indexes = sequence_indexes
+
+    @classmethod
+    def open(cls, manifest_path: str | Path, hit_store: ShardedHitStore, model_name: str, **kwargs):
+        """
+        Open the sequence indexes of the shards of a shard manifest, see read_shard_manifest
+        :param hit_store: The hit stores of the shards
+        :param model_name: The checkpoint queries are embedded with
+        :param kwargs: The windows of the service, see SequenceIndex.open
+        :return: The ShardedSequenceIndex, or None when no shard has a usable sequence index
+        """
+        sequence_indexes = []
+        for shard, shard_hit_store in zip(read_shard_manifest(manifest_path), hit_store.hit_stores):
+            if shard.get("sequence_index"):
+                sequence_index = SequenceIndex.open(shard["sequence_index"], shard_hit_store, model_name, **kwargs)
+                if sequence_index is not None:
+                    sequence_indexes.append(sequence_index)
+        return cls(sequence_indexes) if sequence_indexes else None
+
+    def embeddings(self, sequences: list[str]) -> list[np.ndarray | None]:
+        """See SequenceIndex.embeddings"""
+        result = [None] * len(sequences)
+        for sequence_index in self.sequence_indexes:
+            missing = [position for position, embedding in enumerate(result) if embedding is None]
+            if not missing:
+                break
+            for position, embedding in zip(missing, sequence_index.embeddings([sequences[i] for i in missing])):
+                result[position] = embedding
+        return result
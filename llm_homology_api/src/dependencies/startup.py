@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+LOADING = "loading"
+WARMING_UP = "warming_up"
+READY = "ready"
+FAILED = "failed"
+
+
+class StartupLoader:
+    """
+    Loads the model and the database once the server accepts connections, instead of before.
+
+    The blocking load runs in a thread, then an async warmup searches a first batch, so the lazy initialization of
+    the model and the pages of the index it touches are not paid for by the first requests. Until both are done,
+    /status answers as usual, /ready reports the stage reached and the routes that search reject requests with a 503.
+    A failed background load is logged and reported by /ready; the server keeps running so the failure can be
+    inspected. A failed foreground load is raised, so the worker fails to start.
+    """
+
+    def __init__(self, load, warmup=None, on_ready=()):
+        """
+        Initialize the StartupLoader
+        :param load: A blocking function loading the model and the database
+        :param warmup: An async function run once loaded, before the loader reports ready
+        :param on_ready: Async functions run once ready, e.g. resuming bulk jobs
+        """
+        self.load = load
+        self.warmup = warmup
+        self.on_ready = list(on_ready)
+        self.status = LOADING
+        self.error = None
+        self.seconds = {}
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == READY
+
+    async def run(self, reraise: bool = False):
+        """
+        Load, warm up, then run the on_ready functions
+        :param reraise: Raise the error of a failed load or warmup once it is recorded, instead of only reporting it
+        """
+        try:
+            start = time.perf_counter()
+            await asyncio.to_thread(self.load)
+            self.seconds[LOADING] = time.perf_counter() - start
+            if self.warmup is not None:
+                self.status = WARMING_UP
+                start = time.perf_counter()
+                await self.warmup()
+                self.seconds[WARMING_UP] = time.perf_counter() - start
+        except Exception as e:
+            logging.exception("Loading the model and the database failed")
+            self.status = FAILED
+            self.error = str(e)
+            if reraise:
+                raise
+            return
+        self.status = READY
+        logging.info(f"Ready after {sum(self.seconds.values()):.1f}s ({self.seconds})")
+        for function in self.on_ready:
+            await function()
+
+    async def start(self):
+        """Run the loader in the background on the running event loop, e.g. from a startup handler"""
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run_in_foreground(self):
+        """Run the loader to completion, e.g. from a startup handler, raising the error of a failed load"""
+        await self.run(reraise=True)
+
+    async def stop(self):
+        """Stop waiting for the loader; a load in progress finishes in its thread"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def status_dict(self) -> dict:
+        """The progress of the loader as reported by /ready"""
+        return {"status": self.status, "seconds": self.seconds, "error": self.error}
@@ -0,0 +1,88 @@
+from typing import Callable
+
+import numpy as np
+
+
+def window_spans(length: int, window_size: int, overlap: int) -> list[tuple[int, int]]:
+    """
+    Split a sequence into overlapping windows of at most window_size residues
+    :param length: The number of residues in the sequence
+    :param window_size: The largest window embedded at once, 0 to never split
+    :param overlap: The number of residues shared by consecutive windows
+    :return: The (start, end) spans of the windows, the last one ends at length
+    """
+    if window_size <= 0 or length <= window_size:
+        return [(0, length)]
+    stride = max(window_size - overlap, 1)
+    starts = list(range(0, length - window_size, stride)) + [length - window_size]
+    return [(start, start + window_size) for start in starts]
+
+
+def window_weights(length: int, spans: list[tuple[int, int]]) -> np.ndarray:
+    """
+    Weight each window by the residues it covers, sharing residues in an overlap equally between its windows.
+    The weights sum to length, so the weighted mean of the window means is the mean over residues whenever the
+    windows agree on the embeddings of the residues they share.
+    """
+    coverage = np.zeros(length, dtype=np.float64)
+    for start, end in spans:
+        coverage[start:end] += 1
+    share = 1 / np.maximum(coverage, 1)
+    return np.array([share[start:end].sum() for start, end in spans])
+
+
+def embed_windowed(
+    embed: Callable[[list[str]], np.ndarray], sequences: list[str], window_size: int, overlap: int
+) -> np.ndarray:
+    """
+    Embed sequences with one call to embed, splitting those longer than window_size into overlapping windows
+    that are embedded alongside the other sequences and averaged back into one vector per sequence.
+    Activation memory per input is bounded by window_size, whatever the length of the sequence.
+    :param embed: Returns the (len(inputs), D) pooled embeddings of a list of sequences
+    :param sequences: The sequences to embed
+    :param window_size: The largest window embedded at once, 0 to embed whole sequences
+    :param overlap: The number of residues shared by consecutive windows
+    :return: The (len(sequences), D) float32 embeddings
+    """
+    windows, owners, weights = [], [], []
+    for i, sequence in enumerate(sequences):
+        spans = window_spans(len(sequence), window_size, overlap)
+        windows.extend(sequence[start:end] for start, end in spans)
+        owners.extend([i] * len(spans))
+        span_weights = window_weights(len(sequence), spans)
+        weights.extend(span_weights / max(span_weights.sum(), 1))
+    window_embeddings = np.asarray(embed(windows), dtype=np.float32)
+    if len(windows) == len(sequences):
+        return window_embeddings
+
+    embeddings = np.zeros((len(sequences), window_embeddings.shape[1]), dtype=np.float32)
+    np.add.at(embeddings, np.array(owners), window_embeddings * np.array(weights, dtype=np.float32)[:, np.newaxis])
+    return embeddings
+
+
+def length_sorted_batches(
+    sequences: list[str], max_tokens: int, window_size: int = 0, window_overlap: int = 0
+) -> list[list[int]]:
+    """
+    Group sequences of similar length into batches, so little of each batch is padding
+    :param sequences: The sequences to batch
+    :param max_tokens: The most padded tokens (rows times the longest row, BOS and EOS included) in a batch
+    :param window_size: Longer sequences count as one row per window
+    :param window_overlap: The number of residues shared by consecutive windows
+    :return: The positions of the sequences of each batch, shortest sequences first
+    """
+    batches, batch = [], []
+    rows = longest = 0
+    for position in sorted(range(len(sequences)), key=lambda i: len(sequences[i])):
+        spans = window_spans(len(sequences[position]), window_size, window_overlap)
+        row_length = max(end - start for start, end in spans) + 2
+        if batch and max(longest, row_length) * (rows + len(spans)) > max_tokens:
+            batches.append(batch)
+            batch = []
+            rows = longest = 0
+        batch.append(position)
+        rows += len(spans)
+        longest = max(longest, row_length)
+    if batch:
+        batches.append(batch)
+    return batches
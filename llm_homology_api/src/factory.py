@@ -1,4 +1,6 @@
+import functools
 import json
+from pathlib import Path
 
 from cacheout import LRUCache
 from fastapi import FastAPI
@@ -6,10 +8,30 @@ from fastapi import Request
 
 from clients.CachedAuthClient import CachedAuthClient
 from config.config import LLMHomologyApiSettings
+from dependencies.batcher import MicroBatcher
+from dependencies.compression import CompressionMiddleware
+from dependencies.embedding_cache import EmbeddingCache
+from dependencies.fairness import UserQuotas
+from dependencies.inference_executor import InferenceExecutor
+from dependencies.jobs import JobManager
+from dependencies.logs import SimilarityLog
+from dependencies.metrics import RequestTimingMiddleware, mark_process_dead
+from dependencies.shards import ShardedIndex
+from dependencies.startup import StartupLoader
 from routes.admin import router as cache_router
+from routes.jobs import router as jobs_router, search_job_chunk
+from routes.metrics import router as metrics_router
 from routes.similarity import router as similarity_router
 from routes.status import router as whoami_router
-from ss_factory import setup_similarity_search
+from ss_factory import (
+    setup_budgeted_embedder,
+    setup_cpu_embedder,
+    setup_hit_store,
+    setup_index,
+    setup_sequence_index,
+    setup_shards,
+    setup_similarity_search,
+)
 
 
 def log_request_body_middleware(app: FastAPI):
@@ -58,10 +80,20 @@ def create_app(
         #     "5XX": {"model": models_errors.ServerError}
         # }
     )
-    # app.add_middleware(GZipMiddleware)
     app.include_router(whoami_router, tags=["whoami"])
     app.include_router(similarity_router, tags=["similarity"])
     app.include_router(cache_router, tags=["cache"])
+    app.include_router(metrics_router, tags=["metrics"])
+    app.include_router(jobs_router, tags=["jobs"])
+    # Inside the timing middleware, so decompressing a request body counts as reading it
+    app.add_middleware(
+        CompressionMiddleware,
+        encodings=cfg.COMPRESSION_ENCODINGS,
+        min_bytes=cfg.COMPRESSION_MIN_BYTES,
+        max_decompressed_bytes=cfg.MAX_DECOMPRESSED_REQUEST_BYTES,
+    )
+    # Stamps requests on arrival so the time spent reading and validating their body can be measured
+    app.add_middleware(RequestTimingMiddleware)
 
     # app = log_request_body_middleware(app)
 
@@ -90,8 +122,153 @@ def create_app(
         )
 
     app.state.auth_client = cached_auth_client
+    app.add_event_handler("shutdown", cached_auth_client.close)
     # if os.environ.get("DEBUG", 1) == 1:
     #     app.state.ss = None
     # else:
-    app.state.ss = setup_similarity_search(model_dir)
+    index_settings = dict(
+        nlist=cfg.INDEX_NLIST,
+        pq_m=cfg.INDEX_PQ_M,
+        pq_nbits=cfg.INDEX_PQ_NBITS,
+        hnsw_m=cfg.INDEX_HNSW_M,
+        default_nprobe=cfg.INDEX_NPROBE,
+        max_nprobe=cfg.INDEX_MAX_NPROBE,
+        default_ef_search=cfg.INDEX_EF_SEARCH,
+        max_ef_search=cfg.INDEX_MAX_EF_SEARCH,
+        mmap=cfg.INDEX_MMAP,
+    )
+    app.state.embedding_cache = EmbeddingCache(
+        max_bytes=cfg.EMBEDDING_CACHE_MAX_BYTES,
+        model_name=cfg.EMBEDDING_MODEL_NAME,
+    )
+    app.state.similarity_log = SimilarityLog(max_entries=cfg.SIMILARITY_LOG_MAX_ENTRIES)
+    app.state.inference_executor = InferenceExecutor(
+        max_workers=cfg.INFERENCE_WORKERS,
+        max_queued_queries=cfg.INFERENCE_MAX_QUEUED_QUERIES,
+        retry_after_seconds=cfg.INFERENCE_RETRY_AFTER_SECONDS,
+    )
+    app.state.user_quotas = UserQuotas(
+        residues_per_second=cfg.USER_QUOTA_RESIDUES_PER_SECOND,
+        burst_residues=cfg.USER_QUOTA_BURST_RESIDUES,
+        hit_cost=cfg.HIT_COST_RESIDUES,
+    )
+    app.state.job_manager = JobManager(
+        cfg.JOBS_DIR,
+        functools.partial(search_job_chunk, app.state),
+        workers=cfg.JOBS_WORKERS,
+        chunk_size=cfg.JOBS_CHUNK_SIZE,
+    )
+    app.state.loader = StartupLoader(
+        functools.partial(load_search_state, app.state, cfg, model_dir, index_settings),
+        warmup=functools.partial(warmup_search, app.state, cfg.WARMUP_QUERIES, cfg.WARMUP_LENGTH),
+        # Jobs interrupted by a restart resume in the background once the model is loaded
+        on_ready=[app.state.job_manager.start],
+    )
+    # Without background loading, the server only accepts connections once loaded, as startup handlers are awaited,
+    # and a failed load fails the startup of the worker
+    app.add_event_handler(
+        "startup", app.state.loader.start if cfg.BACKGROUND_LOADING else app.state.loader.run_in_foreground
+    )
+    app.add_event_handler("shutdown", app.state.loader.stop)
+    app.add_event_handler("shutdown", app.state.job_manager.stop)
+    app.add_event_handler("shutdown", functools.partial(close_search_state, app.state))
+    app.add_event_handler("shutdown", mark_process_dead)
     return app
+
+
+def load_search_state(state, cfg: LLMHomologyApiSettings, model_dir: str | None, index_settings: dict):
+    """
+    Load the query embedder and the database, and set up the batcher searching them
+    :param state: The application state the ss, hit_store, index and batcher are set on
+    :param cfg: The settings
+    :param model_dir: The dataset directory, unused with INDEX_SHARDS
+    :param index_settings: The build settings, search limits and mmap of the indexes, see FaissIndex
+    """
+    query_embedder = None
+    if cfg.EMBEDDER_ENGINE != "torch" or cfg.INDEX_SHARDS:
+        # Queries are embedded by the CPU engine.
+        # Shards are built by build_index with the same Esm2Embedder, so their queries always are
+        query_embedder = setup_cpu_embedder(
+            cfg.EMBEDDER_ENGINE, cfg.EMBEDDING_MODEL_NAME, cfg.LOCAL_MODEL_DIR, mmap_weights=cfg.MODEL_MMAP
+        )
+    if cfg.INDEX_SHARDS:
+        # The shards hold the database, the dataset of MODEL_DIR is not loaded
+        state.ss = None
+        state.index, state.hit_store = setup_shards(cfg.INDEX_SHARDS, engine=cfg.INDEX_ENGINE, **index_settings)
+    else:
+        flat_index_path = cfg.FLAT_INDEX_PATH or f"{model_dir}.index"
+        # The SimilaritySearch reads its flat index into memory. It is only needed to embed queries with the
+        # protein_search embedder, or to search a dataset without a flat index file
+        if query_embedder is None or (cfg.INDEX_ENGINE == "flat" and not Path(flat_index_path).exists()):
+            state.ss = setup_similarity_search(
+                model_dir,
+                embedder=query_embedder,
+                pretrained_model_name_or_path=cfg.EMBEDDING_MODEL_NAME,
+                # The passes of the BudgetedEmbedder are bounded by tokens, of at least 4 per sequence, and are not
+                # split again by count
+                batch_size=max(cfg.EMBED_MAX_TOKEN_BUDGET // 4, 1) if cfg.EMBED_TOKEN_BUDGET else 8,
+            )
+        else:
+            state.ss = None
+        state.hit_store = setup_hit_store(model_dir, cfg.HIT_STORE_DIR)
+        state.index = setup_index(
+            state.ss,
+            state.hit_store,
+            engine=cfg.INDEX_ENGINE,
+            ss_dataset_dir=model_dir,
+            index_dir=cfg.INDEX_DIR,
+            flat_index_path=flat_index_path,
+            **index_settings,
+        )
+    sequence_index = None
+    if cfg.REUSE_DATABASE_EMBEDDINGS:
+        sequence_index = setup_sequence_index(
+            state.hit_store,
+            cfg.EMBEDDING_MODEL_NAME,
+            ss_dataset_dir=model_dir,
+            sequence_index_dir=cfg.SEQUENCE_INDEX_DIR,
+            shard_manifest=cfg.INDEX_SHARDS,
+            window_size=cfg.LONG_SEQUENCE_WINDOW,
+            window_overlap=cfg.LONG_SEQUENCE_OVERLAP,
+        )
+    embed = query_embedder.embed_pooled if query_embedder is not None else state.ss.get_pooled_embeddings
+    if cfg.EMBED_TOKEN_BUDGET:
+        embed = setup_budgeted_embedder(
+            embed,
+            engine=cfg.EMBEDDER_ENGINE,
+            token_budget=cfg.EMBED_TOKEN_BUDGET,
+            max_token_budget=cfg.EMBED_MAX_TOKEN_BUDGET,
+            cpu_token_budget=cfg.EMBED_CPU_TOKEN_BUDGET,
+            memory_limit_bytes=cfg.MEMORY_LIMIT_BYTES,
+        )
+    state.batcher = MicroBatcher(
+        state.ss,
+        state.inference_executor,
+        max_batch_size=cfg.BATCH_MAX_SIZE,
+        max_wait_ms=cfg.BATCH_MAX_WAIT_MS,
+        window_size=cfg.LONG_SEQUENCE_WINDOW,
+        window_overlap=cfg.LONG_SEQUENCE_OVERLAP,
+        embed=embed,
+        index=state.index,
+        stored_embeddings=None if sequence_index is None else sequence_index.embeddings,
+        hit_cost=cfg.HIT_COST_RESIDUES,
+    )
+
+
+async def warmup_search(state, num_queries: int, length: int):
+    """
+    Search num_queries synthetic queries of length residues, bypassing the embedding cache, before the server reports
+    ready: the first forward pass initializes the model lazily and the search pages in the index it touches.
+    """
+    if not num_queries:
+        return
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    sequences = [(residues[i % len(residues) :] + residues * length)[:length] for i in range(num_queries)]
+    await state.batcher.search(sequences, top_k=1, params=state.index.search_params())
+
+
+async def close_search_state(state):
+    """Stop the shard processes of a sharded database"""
+    index = getattr(state, "index", None)
+    if isinstance(index, ShardedIndex):
+        index.close()
@@ -1,3 +1,5 @@
+from enum import Enum
+
 from pydantic import BaseModel, constr, Field, conlist
 
 from config import get_settings
@@ -18,7 +20,59 @@ class ProteinSequence(BaseModel):
     )
 
 
-class SimilarityRequest(BaseModel):
+class EmbeddingEncoding(str, Enum):
+    json = "json"  # A JSON list of floats
+    base64_f32 = "base64_f32"  # Base64 of the little-endian float32 vector
+    base64_f16 = "base64_f16"  # Base64 of the little-endian float16 vector
+    int8 = "int8"  # Base64 of the int8 vector, with EmbeddingScale to multiply it back to floats
+
+
+class SearchMode(str, Enum):
+    top_k = "top_k"  # The max_hits best hits, pruned by threshold
+    range = "range"  # Every hit scoring at least threshold, max_hits at most
+
+
+class SearchOptions(BaseModel):
+    """How the queries of a similarity request or a bulk job are searched and their hits returned"""
+
+    threshold: float = Field(
+        default=0.8,
+        description="Similarity threshold for LLM search. This will prune the results of the search.",
+    )
+    max_hits: int = Field(default=3, description="Maximum number of hits to return")
+    search_mode: SearchMode = Field(
+        default=SearchMode.top_k,
+        description="top_k searches for the max_hits best hits and prunes those below the threshold. range returns "
+        "every hit scoring at least the threshold, with max_hits (at most "
+        f"{settings.RANGE_SEARCH_MAX_HITS}) as a cap: a large max_hits then only costs a search that large for the "
+        "queries that have that many hits.",
+    )
+    discard_embeddings: bool = Field(
+        default=True,
+        description="Boolean value to determine whether to discard the embeddings of the queries and hits",
+    )
+    nprobe: int | None = Field(
+        default=None,
+        ge=1,
+        description="The number of inverted lists scanned per query by the ivf and ivfpq index engines, at most "
+        f"{settings.INDEX_MAX_NPROBE} (default {settings.INDEX_NPROBE}). Higher values trade latency for recall. "
+        "Ignored by the other engines.",
+    )
+    ef_search: int | None = Field(
+        default=None,
+        ge=1,
+        description=f"The candidate list size of the hnsw index engine, at most {settings.INDEX_MAX_EF_SEARCH} "
+        f"(default {settings.INDEX_EF_SEARCH}). Higher values trade latency for recall. Ignored by the other engines.",
+    )
+    embedding_encoding: EmbeddingEncoding = Field(
+        default=EmbeddingEncoding.json,
+        description="How embeddings are written when they are not discarded: a JSON list of floats, base64 of the "
+        "little-endian float32 or float16 vector, or base64 of an int8 vector with a per-vector EmbeddingScale. "
+        "Ignored when the response is requested as Arrow IPC (Accept: application/vnd.apache.arrow.stream).",
+    )
+
+
+class SimilarityRequest(SearchOptions):
     sequences: conlist(ProteinSequence, max_length=settings.MAX_PROTEINS_PER_REQUEST) = Field(
         default=[
             ProteinSequence(
@@ -32,12 +86,3 @@ class SimilarityRequest(BaseModel):
         ],
         description="A list of protein sequences.",
     )
-    threshold: float = Field(
-        default=0.8,
-        description="Similarity threshold for LLM search. This will prune the results of the search.",
-    )
-    max_hits: int = Field(default=3, description="Maximum number of hits to return")
-    discard_embeddings: bool = Field(
-        default=True,
-        description="Boolean value to determine whether to discard the embeddings of the queries and hits",
-    )
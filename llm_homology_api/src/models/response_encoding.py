@@ -0,0 +1,232 @@
+import base64
+import json
+
+import numpy as np
+
+from dependencies.metrics import STAGE_SECONDS
+from models.request_models import EmbeddingEncoding
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder writes the same document more slowly
+    orjson = None
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _vectors(embeddings: np.ndarray | None, count: int) -> list:
+    """
+    Rows of an embedding matrix ready for the encoder. Values are widened to float64 so they are written exactly as
+    the Python floats of the Pydantic models were.
+    """
+    if embeddings is None:
+        return [[]] * count
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    return list(embeddings) if orjson is not None else embeddings.tolist()
+
+
+def _base64_rows(rows: np.ndarray) -> list[str]:
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in rows]
+
+
+def encode_embeddings(
+    embeddings: np.ndarray | None, count: int, encoding: EmbeddingEncoding = EmbeddingEncoding.json
+) -> tuple[list, list[float] | None]:
+    """
+    Encode the rows of an embedding matrix
+    :param embeddings: The (count, D) embeddings, or None when they are discarded
+    :param count: The number of rows
+    :param encoding: The encoding requested in the SimilarityRequest
+    :return: The encoded rows and, for int8, the scale of each row
+    """
+    if embeddings is None or encoding == EmbeddingEncoding.json:
+        return _vectors(embeddings, count), None
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if encoding == EmbeddingEncoding.base64_f32:
+        return _base64_rows(embeddings.astype("<f4")), None
+    if encoding == EmbeddingEncoding.base64_f16:
+        return _base64_rows(embeddings.astype("<f2")), None
+    # int8: symmetric per-vector quantization, the largest magnitude of each vector maps to 127
+    max_abs = np.abs(embeddings).max(axis=1) if embeddings.size else np.zeros(count, dtype=np.float32)
+    scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+    quantized = np.clip(np.rint(embeddings / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return _base64_rows(quantized), scales.tolist()
+
+
+def query_protein_content(
+    query_id: str,
+    query_embedding: np.ndarray | None,
+    scores: list[float],
+    tags: list[str],
+    hit_embeddings: np.ndarray | None,
+    encoding: EmbeddingEncoding = EmbeddingEncoding.json,
+) -> dict:
+    """
+    The QueryProtein document of one query
+    :param query_id: The identifier of the query protein
+    :param query_embedding: The embedding of the query, or None to discard it
+    :param scores: The scores of the pruned hits
+    :param tags: The identifiers of the pruned hits
+    :param hit_embeddings: The (len(tags), D) embeddings of the pruned hits, or None to discard them
+    :param encoding: How the embeddings are written
+    """
+    query_embedding = None if query_embedding is None else query_embedding[np.newaxis]
+    (query_value,), query_scale = encode_embeddings(query_embedding, 1, encoding)
+    hit_values, hit_scales = encode_embeddings(hit_embeddings, len(tags), encoding)
+
+    hits = [
+        {"HitID": tag, "Score": score, "Embedding": embedding}
+        for tag, score, embedding in zip(tags, scores, hit_values)
+    ]
+    content = {"QueryId": query_id, "Embedding": query_value, "total_hits": len(tags), "Hits": hits}
+    if query_scale is not None:
+        content["EmbeddingScale"] = query_scale[0]
+        for hit, scale in zip(hits, hit_scales):
+            hit["EmbeddingScale"] = scale
+    return content
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+
+def _query_proteins(
+    query_ids: list[str],
+    query_embeddings: np.ndarray,
+    filtered_scores: list[list[float]],
+    filtered_sequence_tags: list[list[str]],
+    filtered_embeddings: list[np.ndarray | None],
+    discard_embeddings: bool,
+    encoding: EmbeddingEncoding,
+) -> list[dict]:
+    return [
+        query_protein_content(
+            query_id,
+            None if discard_embeddings else query_embeddings[i],
+            filtered_scores[i],
+            filtered_sequence_tags[i],
+            None if discard_embeddings else filtered_embeddings[i],
+            encoding,
+        )
+        for i, query_id in enumerate(query_ids)
+    ]
+
+
+def encode_similarity_response(
+    summary: dict,
+    query_ids: list[str],
+    query_embeddings: np.ndarray,
+    filtered_scores: list[list[float]],
+    filtered_sequence_tags: list[list[str]],
+    filtered_embeddings: list[np.ndarray | None],
+    discard_embeddings: bool,
+    encoding: EmbeddingEncoding = EmbeddingEncoding.json,
+) -> bytes:
+    """
+    Encode a SimilarityResponse straight from the search arrays. This writes the document described by
+    response_models.py without building a HitDetail per hit or having FastAPI validate and encode the models.
+    :param summary: The summary information of the request
+    :param query_ids: The identifiers of the query proteins
+    :param query_embeddings: The (N, D) query embeddings
+    :param filtered_scores: Per-query scores of the pruned hits
+    :param filtered_sequence_tags: Per-query identifiers of the pruned hits
+    :param filtered_embeddings: Per-query embeddings of the pruned hits
+    :param discard_embeddings: Whether to leave the query and hit embeddings out
+    :param encoding: How the embeddings are written
+    :return: The UTF-8 encoded JSON document
+    """
+    with STAGE_SECONDS.labels(stage="response_build").time():
+        proteins = _query_proteins(
+            query_ids,
+            query_embeddings,
+            filtered_scores,
+            filtered_sequence_tags,
+            filtered_embeddings,
+            discard_embeddings,
+            encoding,
+        )
+        summary = {key: float(value) for key, value in summary.items()}
+    with STAGE_SECONDS.labels(stage="serialization").time():
+        return dumps({"summary": summary, "proteins": proteins})
+
+
+def encode_ndjson_proteins(
+    query_ids: list[str],
+    query_embeddings: np.ndarray,
+    filtered_scores: list[list[float]],
+    filtered_sequence_tags: list[list[str]],
+    filtered_embeddings: list[np.ndarray | None],
+    discard_embeddings: bool,
+    encoding: EmbeddingEncoding = EmbeddingEncoding.json,
+) -> bytes:
+    """
+    Encode the QueryProtein documents of a chunk of queries as newline delimited JSON, one line per query.
+    The arguments are those of encode_similarity_response for the queries of the chunk.
+    :return: The UTF-8 encoded lines
+    """
+    with STAGE_SECONDS.labels(stage="response_build").time():
+        proteins = _query_proteins(
+            query_ids,
+            query_embeddings,
+            filtered_scores,
+            filtered_sequence_tags,
+            filtered_embeddings,
+            discard_embeddings,
+            encoding,
+        )
+    with STAGE_SECONDS.labels(stage="serialization").time():
+        return b"".join(dumps(protein) + b"\n" for protein in proteins)
+
+
+def encode_ndjson_summary(summary: dict) -> bytes:
+    """The final line of a newline delimited JSON response"""
+    return dumps({"summary": {key: float(value) for key, value in summary.items()}}) + b"\n"
+
+
+def encode_similarity_arrow(
+    summary: dict,
+    query_ids: list[str],
+    query_embeddings: np.ndarray,
+    filtered_scores: list[list[float]],
+    filtered_sequence_tags: list[list[str]],
+    filtered_embeddings: list[np.ndarray | None],
+    discard_embeddings: bool,
+) -> bytes:
+    """
+    Encode the response as an Arrow IPC stream holding one table. The first N rows are the query proteins, followed
+    by the hits of every query in order. QueryIndex links each row to its query and HitID and Score are null on the
+    query rows. Unless discarded, the Embedding column is a fixed size list over a single contiguous float32 matrix
+    and the summary is stored as JSON in the schema metadata.
+    :return: The Arrow IPC stream
+    """
+    import pyarrow as pa
+
+    num_queries = len(query_ids)
+    hit_counts = [len(tags) for tags in filtered_sequence_tags]
+    query_index = np.concatenate([np.arange(num_queries), np.repeat(np.arange(num_queries), hit_counts)])
+    columns = {
+        "QueryIndex": pa.array(query_index.astype(np.int32)),
+        "QueryId": pa.array([query_ids[i] for i in query_index.tolist()], type=pa.string()),
+        "HitID": pa.array([None] * num_queries + [tag for tags in filtered_sequence_tags for tag in tags], pa.string()),
+        "Score": pa.array(
+            np.concatenate([np.full(num_queries, np.nan, dtype=np.float32)] + [np.float32(s) for s in filtered_scores]),
+            mask=np.arange(len(query_index)) < num_queries,
+        ),
+    }
+    if not discard_embeddings:
+        dim = query_embeddings.shape[1]
+        matrix = np.concatenate(
+            [np.asarray(query_embeddings, dtype=np.float32)]
+            + [np.asarray(embeddings, dtype=np.float32).reshape(-1, dim) for embeddings in filtered_embeddings]
+        )
+        columns["Embedding"] = pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel()), dim)
+
+    summary = {key: float(value) for key, value in summary.items()}
+    table = pa.table(columns, metadata={"summary": json.dumps(summary)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -1,21 +1,31 @@
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Union
 from pydantic import BaseModel, Field
 
 
 class HitDetail(BaseModel):
     HitID: str = Field(..., description="The unique identifier of the homologous sequence.")
     Score: float = Field(..., description="The similarity score of the homologous sequence.")
-    Embedding: Optional[List[float]] = Field(
+    Embedding: Optional[Union[List[float], str]] = Field(
         None,
-        description="The embedding vector associated with the homologous sequence, included based on a flag.",
+        description="The embedding vector associated with the homologous sequence, included based on a flag. "
+        "A base64 string when a binary embedding_encoding is requested.",
+    )
+    EmbeddingScale: Optional[float] = Field(
+        None,
+        description="The scale to multiply an int8 encoded embedding by, only set for embedding_encoding int8.",
     )
 
 
 class QueryProtein(BaseModel):
     QueryId: str = Field(..., description="The identifier of the query protein.")
-    Embedding: Optional[List[float]] = Field(
+    Embedding: Optional[Union[List[float], str]] = Field(
+        None,
+        description="The embedding vector associated with the query protein, included based on a flag. "
+        "A base64 string when a binary embedding_encoding is requested.",
+    )
+    EmbeddingScale: Optional[float] = Field(
         None,
-        description="The embedding vector associated with the query protein, included based on a flag.",
+        description="The scale to multiply an int8 encoded embedding by, only set for embedding_encoding int8.",
     )
     total_hits: int = Field(
         ...,
@@ -1,76 +1,49 @@
-import re
-
 import GPUtil
-import aiofiles
 import torch
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi import HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 
-from routes.similarity import get_cached_embedding, get_cached_tag
+from config import get_settings
+from dependencies.embedding_cache import EmbeddingCache
+from dependencies.logs import SimilarityLog, tail_lines
 
 router = APIRouter()
-
-
-# Regular expression for detailed process information related to similarity requests
-process_info_regex = re.compile(
-    r"INFO:root:Processed similarity request: (?P<sequences>\d+) sequences, Total sequence length: (?P<length>\d+), Response size \(total hits\): (?P<hits>\d+), Execution time: (?P<execution_time>[\d\.]+) seconds"
-)
-
-
-async def parse_log_line(line: str) -> dict | None:
-    # Check for process info related to similarity requests
-    if process_info_match := process_info_regex.match(line):
-        return {"type": "similarity_process_info", **process_info_match.groupdict()}
-    # Skip lines that don't match the above criteria
-    return None
-
-
-async def get_last_n_lines(filename: str, n: int) -> list[dict]:
-    parsed_lines = []
-    async with aiofiles.open(filename, "r", encoding="utf-8") as file:
-        async for line in file:
-            parsed_line = await parse_log_line(line)
-            if parsed_line:  # Only add the line if parse_log_line returns a dict
-                parsed_lines.append(parsed_line)
-                if len(parsed_lines) > n:  # Keep the buffer size to n
-                    parsed_lines.pop(0)
-
-    return parsed_lines
+settings = get_settings()
 
 
 @router.get("/logs/similarity")
 async def read_similarity_logs(
+    request: Request,
     lines: int = Query(
         100,
         alias="lines",
         description="The number of lines to retrieve from the log file related to similarity requests.",
-    )
+    ),
 ):
-    log_entries = await get_last_n_lines("nohup.out", lines)
-    return {"logs": log_entries}
+    """The summaries of the latest similarity requests handled by this worker, oldest first"""
+    similarity_log = request.app.state.similarity_log  # type: SimilarityLog
+    return {"logs": similarity_log.last(lines)}
 
 
 @router.get("/logs")
 async def read_logs(
     lines: int = Query(100, alias="lines", description="The number of lines to retrieve from the log file.")
 ):
-    log_entries = await get_last_n_lines("nohup.out", lines)
+    """The last lines of the log file, read backwards from its end"""
+    try:
+        log_entries = await run_in_threadpool(tail_lines, settings.LOG_FILE, lines)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Log file {settings.LOG_FILE} not found")
     return {"logs": log_entries}
 
 
 @router.get("/cache_status")
-async def cache_status():
+async def cache_status(request: Request):
     """Endpoint to get status of caches."""
-    cache_info = {}
-    for cache_func in [get_cached_embedding, get_cached_tag]:
-        cache_info[cache_func.__name__] = {
-            "hits": cache_func.cache_info().hits,
-            "misses": cache_func.cache_info().misses,
-            "maxsize": cache_func.cache_info().maxsize,
-            "currsize": cache_func.cache_info().currsize,
-        }
-    return cache_info
+    embedding_cache = request.app.state.embedding_cache  # type: EmbeddingCache
+    return {"query_embedding_cache": embedding_cache.stats()}
 
 
 @router.get("/gpu_stats")
@@ -0,0 +1,229 @@
+from pathlib import Path
+from typing import AsyncIterator
+
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from protein_search.search import BatchedSearchResults
+
+from config import get_settings
+from dependencies.embedding_cache import normalize_sequence
+from dependencies.fasta import read_fasta
+from dependencies.jobs import CANCELLED, DONE, Job, JobManager
+from dependencies.metrics import JOB_QUERIES
+from models.request_models import SearchOptions
+from models.response_encoding import encode_ndjson_proteins
+from routes.similarity import get_filtered_annotations, require_ready, search_params, search_top_k
+
+router = APIRouter()
+settings = get_settings()
+
+GZIP_MEDIA_TYPE = "application/gzip"
+UPLOAD_BUFFER_SIZE = 1 << 20
+
+
+async def search_job_chunk(state, parameters: dict, headers: list[str], sequences: list[str]) -> bytes:
+    """
+    Search a chunk of a bulk job and encode it as QueryProtein lines, as /similarity/stream would.
+    The queries are queued behind those of interactive requests, and bypass the embedding cache so a job does not
+    evict the embeddings of interactive clients.
+    @param state: The application state holding the batcher and hit store.
+    @param parameters: The SearchOptions of the job.
+    @param headers: The FASTA headers of the chunk, the QueryId of each line.
+    @param sequences: The protein sequences of the chunk.
+    @return: One line per sequence, in FASTA order.
+    """
+    options = SearchOptions(**parameters)
+    sequences = [normalize_sequence(sequence) for sequence in sequences]
+    # Shortest first, so the batches cut from the chunk hold sequences of similar lengths
+    order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+    scores, indices, embeddings = await state.batcher.search(
+        [sequences[i] for i in order],
+        top_k=search_top_k(options),
+        params=search_params(state, options),
+        background=True,
+    )
+    restore = np.argsort(order).tolist()
+    search_results = BatchedSearchResults(
+        total_scores=[scores[i] for i in restore], total_indices=[indices[i] for i in restore]
+    )
+    filtered_scores, filtered_sequence_tags, filtered_embeddings = await run_in_threadpool(
+        get_filtered_annotations, search_results, options.threshold, options.discard_embeddings, state.hit_store
+    )
+    JOB_QUERIES.inc(len(sequences))
+    return await run_in_threadpool(
+        encode_ndjson_proteins,
+        headers,
+        embeddings[restore],
+        filtered_scores,
+        filtered_sequence_tags,
+        filtered_embeddings,
+        options.discard_embeddings,
+        options.embedding_encoding,
+    )
+
+
+def count_fasta_sequences(path: str | Path) -> int:
+    """
+    Check every record of the FASTA file of a bulk job against the limits of the service.
+    @param path: The FASTA file, plain or gzip compressed.
+    @return: The number of sequences.
+    @raise ValueError: If the file holds no sequences, too many, or a record beyond the limits of a request.
+    """
+    num_sequences = 0
+    for header, sequence in read_fasta(path):
+        num_sequences += 1
+        if num_sequences > settings.JOBS_MAX_SEQUENCES:
+            raise ValueError(f"A job may hold at most {settings.JOBS_MAX_SEQUENCES} sequences")
+        if not 2 <= len(sequence) <= settings.MAX_RESIDUE_COUNT:
+            raise ValueError(
+                f"Sequence {num_sequences} ({header[:50]}) has {len(sequence)} residues, "
+                f"expected 2 to {settings.MAX_RESIDUE_COUNT}"
+            )
+        if len(header) > settings.MAX_RESIDUE_HEADER_LENGTH:
+            raise ValueError(
+                f"The header of sequence {num_sequences} is longer than {settings.MAX_RESIDUE_HEADER_LENGTH} characters"
+            )
+    if not num_sequences:
+        raise ValueError("The FASTA file holds no sequences")
+    return num_sequences
+
+
+def referenced_fasta(fasta_path: str) -> Path:
+    """
+    Resolve a FASTA file referenced by a job to a file of JOBS_INPUT_DIR.
+    @raise HTTPException: If references are disabled, or the file is outside JOBS_INPUT_DIR or missing.
+    """
+    if not settings.JOBS_INPUT_DIR:
+        raise HTTPException(status_code=400, detail="FASTA references are disabled, send the file as the request body")
+    input_dir = Path(settings.JOBS_INPUT_DIR).resolve()
+    path = (input_dir / fasta_path).resolve()
+    if not path.is_relative_to(input_dir):
+        raise HTTPException(status_code=403, detail=f"{fasta_path} is outside of the job input directory")
+    if not path.is_file():
+        raise HTTPException(status_code=400, detail=f"{fasta_path} does not exist in the job input directory")
+    return path
+
+
+async def receive_fasta(request: Request, job_dir: Path) -> Path:
+    """
+    Write the FASTA file sent as the request body to the job directory as it arrives.
+    @return: The written file, input.fasta.gz when the body is gzip compressed and input.fasta otherwise.
+    """
+    chunks = request.stream()
+    first = b""
+    async for chunk in chunks:
+        if chunk:
+            first = chunk
+            break
+    path = job_dir / ("input.fasta.gz" if first[:2] == b"\x1f\x8b" else "input.fasta")
+    with open(path, "wb", buffering=UPLOAD_BUFFER_SIZE) as f:
+        f.write(first)
+        async for chunk in chunks:
+            await run_in_threadpool(f.write, chunk)
+    return path
+
+
+def get_job(request: Request, job_id: str) -> Job:
+    job = request.app.state.job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@router.post("/jobs", status_code=202, dependencies=[Depends(require_ready)])
+async def submit_job(
+    request: Request,
+    options: SearchOptions = Depends(),
+    fasta_path: str | None = Query(
+        None,
+        description="A FASTA file of the server job input directory to search, instead of the request body",
+    ),
+):
+    """
+    Submit a bulk similarity job: every sequence of a FASTA file is searched like the queries of /similarity, with
+    the search options given as query parameters.
+    The FASTA file (plain or gzip compressed) is the request body, or a file referenced by fasta_path. It may hold
+    up to JOBS_MAX_SEQUENCES sequences; headers and sequences have the limits of /similarity.
+    Poll GET /jobs/{job_id} for progress and download the results with GET /jobs/{job_id}/results.
+    Jobs run behind interactive requests and resume after a server restart.
+    """
+    job_manager = request.app.state.job_manager  # type: JobManager
+    job_id, job_dir = job_manager.create()
+    try:
+        input_path = referenced_fasta(fasta_path) if fasta_path else await receive_fasta(request, job_dir)
+        num_sequences = await run_in_threadpool(count_fasta_sequences, input_path)
+    except (ValueError, OSError) as e:
+        job_manager.discard(job_id)
+        raise HTTPException(status_code=400, detail=f"Invalid FASTA file: {e}")
+    except BaseException:
+        job_manager.discard(job_id)
+        raise
+    job = job_manager.submit(job_id, input_path, num_sequences, options.model_dump(mode="json"))
+    return job.status_dict()
+
+
+@router.get("/jobs")
+async def list_jobs(request: Request):
+    """Every bulk job, oldest first"""
+    job_manager = request.app.state.job_manager  # type: JobManager
+    return {"jobs": [job.status_dict() for job in job_manager.list()]}
+
+
+@router.get("/jobs/{job_id}")
+async def job_status(request: Request, job_id: str):
+    """
+    The status (queued, running, done or failed) and progress of a bulk job. Results are written in chunks of
+    processed sequences; the first `chunks` of them can be downloaded while the job runs.
+    """
+    return get_job(request, job_id).status_dict()
+
+
+@router.get("/jobs/{job_id}/results/{chunk}", response_class=FileResponse)
+async def job_result_chunk(request: Request, job_id: str, chunk: int):
+    """
+    A chunk of the results of a bulk job: gzipped newline delimited JSON, one QueryProtein per sequence of the
+    chunk, in FASTA order.
+    """
+    job = get_job(request, job_id)
+    if not 0 <= chunk < job.chunks:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} has {job.chunks} result chunks")
+    return FileResponse(
+        request.app.state.job_manager.chunk_path(job_id, chunk),
+        media_type=GZIP_MEDIA_TYPE,
+        filename=f"{job_id}_{chunk:05d}.ndjson.gz",
+    )
+
+
+@router.get("/jobs/{job_id}/results", response_class=StreamingResponse)
+async def job_results(request: Request, job_id: str):
+    """
+    Every result of a finished bulk job as one gzipped newline delimited JSON file, one QueryProtein per sequence
+    in FASTA order. The chunks are sent back to back as gzip members, which gzip readers decompress as one stream.
+    """
+    job = get_job(request, job_id)
+    if job.status != DONE:
+        raise HTTPException(
+            status_code=409, detail=f"Job {job_id} is {job.status}, download its finished chunks instead"
+        )
+    job_manager = request.app.state.job_manager  # type: JobManager
+
+    async def content() -> AsyncIterator[bytes]:
+        for chunk in range(job.chunks):
+            yield await run_in_threadpool(job_manager.chunk_path(job_id, chunk).read_bytes)
+
+    return StreamingResponse(
+        content(),
+        media_type=GZIP_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{job_id}.ndjson.gz"'},
+    )
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(request: Request, job_id: str):
+    """Cancel a bulk job and remove its input and results"""
+    job_manager = request.app.state.job_manager  # type: JobManager
+    if not job_manager.cancel(job_id):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return {"job_id": job_id, "status": CANCELLED}
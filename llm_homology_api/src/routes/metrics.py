@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+
+from dependencies.metrics import PROMETHEUS_CONTENT_TYPE, render_metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=Response)
+async def metrics():
+    """
+    The stage latency histograms, request counters and gauges in the Prometheus text format.
+    With PROMETHEUS_MULTIPROC_DIR set, those of every uvicorn worker, whichever worker answers; otherwise this worker's.
+    """
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -1,14 +1,40 @@
+import asyncio
 import logging
 import time
+from typing import AsyncIterator
+
+import numpy as np
 import protein_search.search
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Cookie, Depends, Header, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from protein_search.search import BatchedSearchResults
 
 from config import get_settings
-from models.request_models import SimilarityRequest
-from models.response_models import SimilarityResponse, QueryProtein, HitDetail
-
-import functools
+from dependencies.embedding_cache import EmbeddingCache, normalize_sequence
+from dependencies.fairness import Caller, QuotaExceededError
+from dependencies.hit_store import HitStore
+from dependencies.index_engines import SearchParams
+from dependencies.inference_executor import InferenceQueueFullError
+from dependencies.metrics import (
+    EMBEDDING_CACHE_LOOKUPS,
+    HITS,
+    QUERIES,
+    REJECTED_REQUESTS,
+    REQUEST_SECONDS,
+    RESIDUES,
+    STAGE_SECONDS,
+)
+from models.request_models import SearchMode, SearchOptions, SimilarityRequest
+from models.response_encoding import (
+    ARROW_STREAM_MEDIA_TYPE,
+    NDJSON_MEDIA_TYPE,
+    encode_ndjson_proteins,
+    encode_ndjson_summary,
+    encode_similarity_arrow,
+    encode_similarity_response,
+)
+from models.response_models import SimilarityResponse
 
 router = APIRouter()
 settings = get_settings()
@@ -16,173 +42,419 @@ settings = get_settings()
 logging.basicConfig(level=logging.INFO)
 
 
-@functools.lru_cache(maxsize=100000)
-def get_cached_embedding(ss, index):
-    logging.info(f"missed embedding cache for index {index}")
-    return ss.get_sequence_embeddings([index])[0]
-
-
-@functools.lru_cache(maxsize=100000)
-def get_cached_tag(ss, index):
-    logging.info(f"missed tag cache for index {index}")
-    return ss.get_sequence_tags([index])[0]
-
-
-"""
-Optimization: Depending on the size of hit_indices and hit_scores, and how often this function is called,
- you might be iterating multiple times over these lists (once for filtering scores and once for indices). 
- You could consider combining these operations into a single loop to optimize performance, especially if the lists are large.
-
-Error Handling: Consider what should happen if hit_indices and hit_scores have different lengths.
- This could indicate a mismatch in data alignment and might warrant an additional validation check at the start of the function.
-"""
-
-
 def get_filtered_annotations(
-    hit_indices: list[int],
-    hit_scores: list[float],
+    search_results: protein_search.search.BatchedSearchResults,
     threshold: float,
     discard_embeddings: bool,
-    ss: protein_search.search.SimilaritySearch,
-) -> tuple[list[float], list[str], list[list[float]]]:
+    hit_store: HitStore,
+) -> tuple[list[list[float]], list[list[str]], list[np.ndarray | None]]:
     """
-    Get the filtered sequence tags and embeddings based on the similarity threshold and discard_embeddings flag.
-    @param hit_indices: Indices of the hits in the database.
-    @param hit_scores: Similarity scores for the hits.
+    Get the filtered sequence tags and embeddings of every query based on the similarity threshold and
+    discard_embeddings flag. The threshold is applied to the scores of the whole batch at once, each database row
+    that survives is fetched from the hit store once however many queries hit it, and the results are then split
+    back out per query.
+    @param search_results: BatchedSearchResults object containing the search results.
     @param threshold: Similarity threshold for pruning the search results.
     @param discard_embeddings: Determine whether to discard the embeddings of the queries and hits.
-    @param ss: SimilaritySearch object used for searching.
+    @param hit_store: HitStore holding the tags and embeddings of the database.
+    @return: Per-query filtered scores, sequence tags and embeddings (None when discarded).
+    @raise ValueError: If the length of the scores and indices of a query do not match.
+    """
+    lengths = [len(hit_scores) for hit_scores in search_results.total_scores]
+    index_lengths = [len(hit_indices) for hit_indices in search_results.total_indices]
+    if lengths != index_lengths:
+        raise ValueError(f"Length of scores and indices do not match. Got {lengths} and {index_lengths}")
+    num_queries = len(lengths)
+    if not num_queries:
+        return [], [], []
+
+    scores = np.concatenate([np.asarray(hit_scores, dtype=np.float32) for hit_scores in search_results.total_scores])
+    indices = np.concatenate([np.asarray(hit_idx, dtype=np.int64) for hit_idx in search_results.total_indices])
+    queries = np.repeat(np.arange(num_queries), lengths)
+
+    # Keep hits with scores above the threshold; the index pads missing neighbours with -1
+    keep = (scores >= threshold) & (indices >= 0)
+    scores, indices, queries = scores[keep], indices[keep], queries[keep]
+
+    # Retrieve the sequence tags and embeddings of every distinct surviving hit in one gather
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    unique_tags = hit_store.get_tags(unique_indices)
+    tags = [unique_tags[i] for i in inverse.tolist()]
+    embeddings = None if discard_embeddings else hit_store.get_embeddings(unique_indices)[inverse]
+
+    # Hits stay grouped by query in index order, so the per-query counts give the split points
+    bounds = [0] + np.cumsum(np.bincount(queries, minlength=num_queries)).tolist()
+    scores = scores.tolist()
+    filtered_scores, filtered_sequence_tags, filtered_embeddings = [], [], []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        filtered_scores.append(scores[start:end])
+        filtered_sequence_tags.append(tags[start:end])
+        filtered_embeddings.append(None if discard_embeddings else embeddings[start:end])
+
+    return filtered_scores, filtered_sequence_tags, filtered_embeddings
 
+
+async def search_queries(
+    state, query_sequences: list[str], top_k: int, params: SearchParams = SearchParams(), caller: Caller = Caller()
+) -> tuple[list[np.ndarray], list[np.ndarray], np.ndarray]:
+    """
+    Embed and search the queries of one request. The sequences are normalized first, so the model, the sequence
+    index and the cache all see the same string. Identical sequences are searched once and sequences with a cached
+    embedding skip the model; only the remaining cache misses are sent to the embedder.
+    @param state: The application state holding the embedding cache and the batcher.
+    @param query_sequences: The protein sequences of the request.
+    @param top_k: The number of hits to return for each sequence.
+    @param params: The search knobs of the request, see search_params.
+    @param caller: The caller the queries are fairly queued for, see get_caller.
+    @return: Per-query hit scores, per-query hit indices and the (N, D) query embeddings, in request order.
     """
-    # Keep hits with scores above the threshold
-    filtered_indices = [idx for idx, score in zip(hit_indices, hit_scores) if score >= threshold]
-    filtered_scores = [score for score in hit_scores if score >= threshold]
+    cache = state.embedding_cache  # type: EmbeddingCache
+    sequences = [normalize_sequence(sequence) for sequence in query_sequences]
+    keys = [cache.key(sequence) for sequence in sequences]
+    unique_positions = {}
+    for position, key in enumerate(keys):
+        unique_positions.setdefault(key, position)
+    unique_keys = list(unique_positions)
+
+    cached_embeddings = [cache.get(key) for key in unique_keys]
+    cache_misses = sum(embedding is None for embedding in cached_embeddings)
+    EMBEDDING_CACHE_LOOKUPS.labels(result="hit").inc(len(cached_embeddings) - cache_misses)
+    EMBEDDING_CACHE_LOOKUPS.labels(result="miss").inc(cache_misses)
+    scores, indices, embeddings = await state.batcher.search(
+        [sequences[unique_positions[key]] for key in unique_keys],
+        top_k=top_k,
+        embeddings=cached_embeddings,
+        params=params,
+        caller=caller,
+    )
+    for key, embedding, cached_embedding in zip(unique_keys, embeddings, cached_embeddings):
+        if cached_embedding is None:
+            cache.put(key, embedding)
 
-    # Retrieve only filtered sequence tags and embeddings with scores above the threshold:
+    unique_index = {key: i for i, key in enumerate(unique_keys)}
+    order = [unique_index[key] for key in keys]
+    return [scores[i] for i in order], [indices[i] for i in order], embeddings[order]
 
-    filtered_sequence_tags = ss.get_sequence_tags(filtered_indices)
-    # filtered_sequence_tags = [get_cached_tag(ss, idx) for idx in filtered_indices]
 
-    filtered_embeddings = [] if discard_embeddings else ss.get_sequence_embeddings(filtered_indices)
-    # filtered_embeddings = [] if discard_embeddings else [get_cached_embedding(ss, idx) for idx in filtered_indices]
+def search_params(state, similarity_request: SearchOptions) -> SearchParams:
+    """
+    The nprobe and ef_search of a request, defaulted and clamped to the limits of the index engine, and the
+    threshold of a range search.
+    @param state: The application state holding the batcher and its index.
+    @param similarity_request: The SimilarityRequest (or the SearchOptions of a job) to process.
+    @return: The SearchParams the queries of the request are searched with.
+    """
+    params = state.batcher.index.search_params(similarity_request.nprobe, similarity_request.ef_search)
+    if similarity_request.search_mode == SearchMode.range:
+        params = params._replace(threshold=similarity_request.threshold)
+    return params
 
-    if len(filtered_scores) != len(filtered_sequence_tags):
-        raise ValueError(
-            f"Length of filtered scores and sequence tags do not match. Got {len(filtered_scores)} and {len(filtered_sequence_tags)}"
-        )
 
-    if not discard_embeddings:
-        if len(filtered_scores) != len(filtered_embeddings):
-            raise ValueError(
-                f"Length of filtered scores and embeddings do not match. Got {len(filtered_scores)} and {len(filtered_embeddings)}"
-            )
+def search_top_k(similarity_request: SearchOptions) -> int:
+    """
+    The number of hits to search for each query: max_hits, capped at RANGE_SEARCH_MAX_HITS for a range search.
+    @param similarity_request: The SimilarityRequest (or the SearchOptions of a job) to process.
+    """
+    if similarity_request.search_mode == SearchMode.range:
+        return min(similarity_request.max_hits, settings.RANGE_SEARCH_MAX_HITS)
+    return similarity_request.max_hits
 
-        if len(filtered_sequence_tags) != len(filtered_embeddings):
-            raise ValueError(
-                f"Length of filtered sequence tags and embeddings do not match. Got {len(filtered_sequence_tags)} and {len(filtered_embeddings)}"
-            )
 
-    return filtered_scores, filtered_sequence_tags, filtered_embeddings
+def record_request(request: Request, similarity_request: SimilarityRequest):
+    """
+    Record the validation time and the size of a similarity request in the metrics.
+    @param request: The request, stamped with the time it was received by the RequestTimingMiddleware.
+    @param similarity_request: The validated SimilarityRequest.
+    """
+    received_at = getattr(request.state, "received_at", None)
+    if received_at is not None:
+        # Reading the body, parsing and validating it all happen before the route is called
+        STAGE_SECONDS.labels(stage="validation").observe(time.perf_counter() - received_at)
+    QUERIES.inc(len(similarity_request.sequences))
+    RESIDUES.inc(sum(len(query.sequence) for query in similarity_request.sequences))
 
 
-def process_hits(
-    search_results: protein_search.search.BatchedSearchResults,
-    threshold: float,
-    discard_embeddings: bool,
-    ss: protein_search.search.SimilaritySearch,
-) -> list[list[HitDetail]]:
+def summarize_request(
+    state, num_sequences: int, total_sequence_length: int, response_size: int, start_time: float
+) -> dict:
     """
-    Process the search results to prune the hits based on the similarity threshold and discard_embeddings flag.
-    @param search_results: BatchedSearchResults object containing the search results.
-    @param threshold: Similarity threshold for pruning the search results.
-    @param discard_embeddings: Whether to discard the embeddings of the queries and hits.
-    @param ss: SimilaritySearch object used for searching.
-    @return: Pruned hits for each query sequence.
-    @rtype: list[list[HitDetail]]
-    @raise ValueError: If the length of the scores and indices lists in search_results do not match.
+    Build, log and record the summary of a similarity request.
+    @param state: The application state holding the similarity log.
+    @param num_sequences: The number of query sequences.
+    @param total_sequence_length: The total number of residues of the query sequences.
+    @param response_size: The total number of hits returned.
+    @param start_time: When the request started, as returned by time.time().
+    @return: The summary dictionary of the response.
     """
-    pruned_hits = []
+    # Calculate the elapsed time
+    elapsed_time = time.time() - start_time
 
-    for hit_scores, hit_indices in zip(search_results.total_scores, search_results.total_indices):
-        if len(hit_scores) != len(hit_indices):
-            raise ValueError(f"Length of scores and indices do not match. Got {len(hit_scores)} and {len(hit_indices)}")
+    # Prepare the summary dictionary
+    summary_info = {
+        "num_sequences": num_sequences,
+        "total_sequence_length": total_sequence_length,
+        "response_size": response_size,
+        "execution_time": elapsed_time,
+    }
 
-        filtered_scores, filtered_sequence_tags, filtered_embeddings = get_filtered_annotations(
-            hit_indices, hit_scores, threshold, discard_embeddings, ss
-        )
+    # Log the processing information
+    logging.info(
+        f"Processed similarity request: {num_sequences} sequences, "
+        f"Total sequence length: {total_sequence_length}, "
+        f"Response size (total hits): {response_size}, "
+        f"Execution time: {elapsed_time:.2f} seconds"
+    )
+    state.similarity_log.record(summary_info)
+    REQUEST_SECONDS.observe(elapsed_time)
+    HITS.inc(response_size)
+    return summary_info
 
-        pruned_result = []
-        for idx, (score, seq_id) in enumerate(zip(filtered_scores, filtered_sequence_tags)):
-            embedding = [] if discard_embeddings else list(map(float, filtered_embeddings[idx]))
-            pruned_result.append(HitDetail(HitID=seq_id, Score=score, Embedding=embedding))
 
-        pruned_hits.append(pruned_result)
-    return pruned_hits
+def require_ready(request: Request):
+    """
+    Reject requests with a 503 until the model and the database are loaded, see /ready.
+    @param request: The request to a route that searches.
+    @raise HTTPException: If the server is still loading or failed to load.
+    """
+    loader = request.app.state.loader
+    if not loader.ready:
+        raise HTTPException(
+            status_code=503,
+            detail=f"The model and the database are {loader.status.replace('_', ' ')}, see /ready",
+            headers={"Retry-After": str(settings.INFERENCE_RETRY_AFTER_SECONDS)},
+        )
 
 
-@router.post("/similarity", response_model=SimilarityResponse)
-async def calculate_similarity(request: Request, similarity_request: SimilarityRequest):
+async def get_caller(
+    request: Request,
+    authorization: str = Header(None, alias="Authorization", description="KBase auth token"),
+    kbase_session: str = Cookie(None),
+) -> Caller:
+    """
+    The caller a similarity request is fairly queued and charged for: the KBase user of the token, weighted
+    ADMIN_SCHEDULING_WEIGHT for admins, or the client address of a request without a valid token.
+    @param request: The similarity request.
+    @param authorization: The KBase auth token of the Authorization header.
+    @param kbase_session: The KBase auth token of the session cookie, when there is no Authorization header.
+    @raise HTTPException: With STRICT_CALLER_AUTH, if the token is invalid or the auth service is down.
+    """
+    token = authorization or kbase_session
+    anonymous = Caller(f"anonymous:{request.client.host if request.client else ''}")
+    if not token:
+        return anonymous
+    try:
+        user_auth_roles = await request.app.state.auth_client.get_user_auth_roles(token=token)
+    except HTTPException as e:
+        if settings.STRICT_CALLER_AUTH:
+            raise
+        # /similarity does not require a token, a request whose token fails is scheduled as one without
+        logging.info(f"Scheduling a similarity request as anonymous, its token failed: {e.detail}")
+        return anonymous
+    weight = settings.ADMIN_SCHEDULING_WEIGHT if user_auth_roles.is_admin else 1.0
+    return Caller(f"user:{user_auth_roles.username}", weight)
+
+
+def too_many_requests(error: InferenceQueueFullError | QuotaExceededError) -> HTTPException:
+    logging.warning(str(error))
+    REJECTED_REQUESTS.labels(reason="quota" if isinstance(error, QuotaExceededError) else "queue").inc()
+    return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+
+async def stream_similarity(
+    state, similarity_request: SimilarityRequest, chunk_size: int, caller: Caller = Caller()
+) -> AsyncIterator[bytes]:
+    """
+    Search the queries of a request chunk by chunk and yield the QueryProtein lines of each chunk as soon as it is
+    done, followed by a final summary line. Only one chunk is held while it is pruned and written, and the search of
+    the next chunk runs meanwhile, so memory stays proportional to chunk_size rather than to the request.
+    @param state: The application state holding the inference executor, embedding cache, batcher and hit store.
+    @param similarity_request: The SimilarityRequest to process.
+    @param chunk_size: The number of queries searched and written at a time.
+    @param caller: The caller the request is fairly queued for and charged to, see get_caller.
+    @return: An async iterator of newline delimited JSON.
+    @raise InferenceQueueFullError: On the first iteration, if the inference queue cannot take the request.
+    @raise QuotaExceededError: On the first iteration, if the quota of the caller cannot pay for the request.
+    """
+    start_time = time.time()
+    queries = similarity_request.sequences
+    num_sequences = len(queries)
+    total_sequence_length = sum(len(query.sequence) for query in queries)
+    chunks = [queries[start : start + chunk_size] for start in range(0, num_sequences, chunk_size)]
+    response_size = 0
+
+    top_k = search_top_k(similarity_request)
+    params = search_params(state, similarity_request)
+
+    def search_chunk(chunk):
+        sequences = [query.sequence for query in chunk]
+        return asyncio.ensure_future(search_queries(state, sequences, top_k=top_k, params=params, caller=caller))
+
+    with state.inference_executor.admit(num_sequences):
+        state.user_quotas.charge(caller, total_sequence_length, num_sequences * top_k)
+        pending = search_chunk(chunks[0]) if chunks else None
+        try:
+            for i, chunk in enumerate(chunks):
+                total_scores, total_indices, query_embeddings = await pending
+                # Search the next chunk while this one is pruned and written
+                pending = search_chunk(chunks[i + 1]) if i + 1 < len(chunks) else None
+                with STAGE_SECONDS.labels(stage="hit_gather").time():
+                    filtered_scores, filtered_sequence_tags, filtered_embeddings = await run_in_threadpool(
+                        get_filtered_annotations,
+                        BatchedSearchResults(total_scores=total_scores, total_indices=total_indices),
+                        similarity_request.threshold,
+                        similarity_request.discard_embeddings,
+                        state.hit_store,
+                    )
+                response_size += sum(len(tags) for tags in filtered_sequence_tags)
+                yield await run_in_threadpool(
+                    encode_ndjson_proteins,
+                    [query.id for query in chunk],
+                    query_embeddings,
+                    filtered_scores,
+                    filtered_sequence_tags,
+                    filtered_embeddings,
+                    similarity_request.discard_embeddings,
+                    similarity_request.embedding_encoding,
+                )
+        finally:
+            # The client went away mid-stream, drop the queries of the next chunk
+            if pending is not None:
+                pending.cancel()
+
+    summary_info = summarize_request(state, num_sequences, total_sequence_length, response_size, start_time)
+    yield encode_ndjson_summary(summary_info)
+
+
+async def ndjson_response(
+    request: Request, similarity_request: SimilarityRequest, caller: Caller = Caller()
+) -> StreamingResponse:
+    """
+    Stream the response of a similarity request as newline delimited JSON.
+    The first chunk is searched before the response starts, so a full inference queue or a used up quota is still
+    reported as a 429.
+    """
+    lines = stream_similarity(request.app.state, similarity_request, settings.STREAM_CHUNK_SIZE, caller)
+    try:
+        first_lines = await lines.__anext__()
+    except (InferenceQueueFullError, QuotaExceededError) as e:
+        raise too_many_requests(e)
+
+    async def content():
+        yield first_lines
+        async for chunk_lines in lines:
+            yield chunk_lines
+
+    return StreamingResponse(content(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post(
+    "/similarity",
+    response_model=SimilarityResponse,
+    responses={
+        200: {
+            "content": {ARROW_STREAM_MEDIA_TYPE: {}, NDJSON_MEDIA_TYPE: {}},
+            "description": f"A SimilarityResponse, or with Accept: {ARROW_STREAM_MEDIA_TYPE} an Arrow IPC stream "
+            "with one row per query and hit and the embeddings as one contiguous float32 matrix. "
+            f"With Accept: {NDJSON_MEDIA_TYPE} the response is streamed as in /similarity/stream.",
+        }
+    },
+    dependencies=[Depends(require_ready)],
+)
+async def calculate_similarity(
+    request: Request, similarity_request: SimilarityRequest, caller: Caller = Depends(get_caller)
+):
     f"""
     Calculates the similarity between given protein sequences and finds homologous sequences in the database.
     Args:
     - sequences: A list of protein sequences with IDs.
         {settings.MAX_PROTEINS_PER_REQUEST} sequences are allowed in a single request.
-        {settings.MAX_RESIDUE_COUNT} residues are allowed in a single protein sequence. After 1200 characters, 
-        the sequence is truncated.. So maybe we want to reduce the max length
+        {settings.MAX_RESIDUE_COUNT} residues are allowed in a single protein sequence. Sequences longer than
+        {settings.LONG_SEQUENCE_WINDOW} residues are embedded as overlapping windows averaged into one embedding.
         {settings.MAX_RESIDUE_HEADER_LENGTH} characters are allowed in the header of a single protein sequence. 
     - threshold: Similarity threshold (0.0-1.0).
+    - search_mode: top_k for the max_hits best hits above the threshold, range for every hit above the threshold
+        with max_hits as a cap.
+    - nprobe, ef_search: Recall/latency knobs of the approximate index engines, clamped to the server limits.
+    Requests are queued fairly per user (per client address without a token) and, when quotas are enabled, charged
+    their residues plus HIT_COST_RESIDUES per requested hit to the quota of the user.
     Please ensure that your request does not exceed these constraints.
     """
+    record_request(request, similarity_request)
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return await ndjson_response(request, similarity_request, caller)
+
     start_time = time.time()  # Capture the start time
     # Gather initial data about the request
     num_sequences = len(similarity_request.sequences)
     total_sequence_length = sum(len(sequence.sequence) for sequence in similarity_request.sequences)
 
     query_sequences = [sequence.sequence for sequence in similarity_request.sequences]
-    search_results, query_embeddings = request.app.state.ss.search(
-        query_sequences, top_k=similarity_request.max_hits
-    )  # type: BatchedSearchResults, np.ndarray
-
-    pruned_hits = process_hits(
-        search_results,
-        similarity_request.threshold,
-        similarity_request.discard_embeddings,
-        request.app.state.ss,
-    )
-
-    proteins = []
-    for i, query in enumerate(similarity_request.sequences):
-        query_embedding = [] if similarity_request.discard_embeddings else list(map(float, query_embeddings[i]))
-        proteins.append(
-            QueryProtein(
-                QueryId=query.id,
-                Embedding=query_embedding,
-                total_hits=len(pruned_hits[i]),
-                Hits=pruned_hits[i],
+    top_k = search_top_k(similarity_request)
+    # Inference runs on the dedicated executor; reject up front rather than queue unbounded latency
+    try:
+        with request.app.state.inference_executor.admit(num_sequences):
+            request.app.state.user_quotas.charge(caller, total_sequence_length, num_sequences * top_k)
+            # Queries are batched together with those of concurrent requests into one embed + search call
+            total_scores, total_indices, query_embeddings = await search_queries(
+                request.app.state,
+                query_sequences,
+                top_k=top_k,
+                params=search_params(request.app.state, similarity_request),
+                caller=caller,
             )
+    except (InferenceQueueFullError, QuotaExceededError) as e:
+        raise too_many_requests(e)
+    search_results = BatchedSearchResults(total_scores=total_scores, total_indices=total_indices)
+
+    with STAGE_SECONDS.labels(stage="hit_gather").time():
+        filtered_scores, filtered_sequence_tags, filtered_embeddings = await run_in_threadpool(
+            get_filtered_annotations,
+            search_results,
+            similarity_request.threshold,
+            similarity_request.discard_embeddings,
+            request.app.state.hit_store,
         )
 
     # Calculate the size of the response
-    response_size = sum(len(protein.Hits) for protein in proteins)
-
-    # Calculate the elapsed time
-    elapsed_time = time.time() - start_time
-
-    # Prepare the summary dictionary
-    summary_info = {
-        "num_sequences": num_sequences,
-        "total_sequence_length": total_sequence_length,
-        "response_size": response_size,
-        "execution_time": elapsed_time,
-    }
-
-    # Log the processing information
-    logging.info(
-        f"Processed similarity request: {num_sequences} sequences, "
-        f"Total sequence length: {total_sequence_length}, "
-        f"Response size (total hits): {response_size}, "
-        f"Execution time: {elapsed_time:.2f} seconds"
+    response_size = sum(len(tags) for tags in filtered_sequence_tags)
+    summary_info = summarize_request(request.app.state, num_sequences, total_sequence_length, response_size, start_time)
+
+    # Include the summary info and proteins in the response, encoded straight from the arrays
+    response_args = (
+        summary_info,
+        [query.id for query in similarity_request.sequences],
+        query_embeddings,
+        filtered_scores,
+        filtered_sequence_tags,
+        filtered_embeddings,
+        similarity_request.discard_embeddings,
     )
-
-    # Include the summary info and proteins in the response
-    return SimilarityResponse(proteins=proteins, summary=summary_info)
+    if ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", ""):
+        with STAGE_SECONDS.labels(stage="serialization").time():
+            content = await run_in_threadpool(encode_similarity_arrow, *response_args)
+        return Response(content=content, media_type=ARROW_STREAM_MEDIA_TYPE)
+    content = await run_in_threadpool(encode_similarity_response, *response_args, similarity_request.embedding_encoding)
+    return Response(content=content, media_type="application/json")
+
+
+@router.post(
+    "/similarity/stream",
+    responses={
+        200: {
+            "content": {NDJSON_MEDIA_TYPE: {}},
+            "description": "One QueryProtein document per line in request order, followed by a line holding the "
+            "summary of the request.",
+        }
+    },
+    response_class=StreamingResponse,
+    dependencies=[Depends(require_ready)],
+)
+async def stream_similarity_route(
+    request: Request, similarity_request: SimilarityRequest, caller: Caller = Depends(get_caller)
+):
+    """
+    Same search as /similarity, but the queries are processed in chunks and the hits of each query are sent as
+    newline delimited JSON as soon as its chunk is done, so large requests start returning results early.
+    """
+    record_request(request, similarity_request)
+    return await ndjson_response(request, similarity_request, caller)
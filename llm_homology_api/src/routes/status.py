@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Request, Header, Cookie
+from fastapi import APIRouter, Request, Response, Header, Cookie
 
 from llm_homology_api.src.config import get_settings
 
@@ -8,7 +8,7 @@ ALPHANUMERIC_PATTERN = r"^[a-zA-Z0-9]*$"
 
 
 @router.get("/whoami")
-def whoami(
+async def whoami(
     request: Request,
     authorization: str = Header(
         None,
@@ -20,7 +20,8 @@ def whoami(
 ):
     cac = request.app.state.auth_client
 
-    return cac.validate_and_get_username_auth_roles(token=authorization if authorization else kbase_session)
+    user_auth_roles = await cac.get_user_auth_roles(token=authorization if authorization else kbase_session)
+    return user_auth_roles.username, user_auth_roles.user_roles
 
 
 @router.get("/")
@@ -33,3 +34,15 @@ def status():
         "vcs_ref": settings.VCS_REF,
         "auth_url": settings.AUTH_URL,
     }
+
+
+@router.get("/ready")
+def ready(request: Request, response: Response):
+    """
+    Whether the model and the database are loaded and warmed up, for readiness probes: 200 once they are, 503 while
+    they load or if loading failed. /status answers as soon as the server accepts connections.
+    """
+    loader = request.app.state.loader
+    if not loader.ready:
+        response.status_code = 503
+    return loader.status_dict()
@@ -1,8 +1,15 @@
 from pathlib import Path
 
+import torch
 from protein_search.embedders import get_embedder
 from protein_search.search import SimilaritySearch
 
+from dependencies.hit_store import HitStore
+from dependencies.index_engines import FaissIndex, SimilaritySearchIndex
+from dependencies.memory_budget import BudgetedEmbedder
+from dependencies.sequence_index import SequenceIndex
+from dependencies.shards import ShardedHitStore, ShardedIndex, ShardedSequenceIndex
+
 
 def setup_embeddings(
     model_name="esm2",
@@ -31,8 +38,8 @@ def setup_embeddings(
             # The model id to use for generating the embeddings
             # Looks like this downloads from the internet if its not available to local disk
             "pretrained_model_name_or_path": pretrained_model_name_or_path,
-            # Use the model in half precision
-            "half_precision": True,
+            # Use the model in half precision, on the GPU only as fp16 matmuls are slow or unsupported on the CPU
+            "half_precision": torch.cuda.is_available(),
             # Set the model to evaluation mode
             "eval_mode": True,
             # Compile the model for faster inference
@@ -43,7 +50,152 @@ def setup_embeddings(
     )
 
 
-def setup_similarity_search(ss_dataset_dir: str, embedder=None, compile_model=True):
+def setup_cpu_embedder(
+    engine: str, pretrained_model_name_or_path: str, local_model_dir: str = "local_models", mmap_weights: bool = False
+):
+    """
+    Set up an Esm2Embedder running one of the CPU engines
+    :param engine: int8 for dynamic int8 quantization or onnx for ONNX Runtime, see Esm2Embedder
+    :param pretrained_model_name_or_path: The ESM-2 checkpoint
+    :param local_model_dir: Where the checkpoint and its ONNX export are kept
+    :param mmap_weights: Map the weights of the torch engine from the checkpoint file, see Esm2Embedder
+    :return: The Esm2Embedder, queries are embedded with its embed_pooled
+    """
+    from dependencies.embedder import Esm2Embedder
+
+    return Esm2Embedder(
+        local_model_dir=local_model_dir,
+        model_name=pretrained_model_name_or_path,
+        half_precision=False,
+        lean=True,
+        engine=engine,
+        mmap_weights=mmap_weights,
+    )
+
+
+def setup_budgeted_embedder(
+    embed,
+    engine: str = "torch",
+    token_budget: int = 32768,
+    max_token_budget: int = 131072,
+    cpu_token_budget: int = 1024,
+    memory_limit_bytes: int = 0,
+) -> BudgetedEmbedder:
+    """
+    Bound the forward passes of an embedder by padded tokens, see BudgetedEmbedder
+    :param embed: Returns the (N, D) pooled embeddings of a list of sequences
+    :param engine: The engine of the embedder; the torch engine runs on the GPU when there is one, and there the
+        budget grows while passes fit in memory
+    :param token_budget: The padded tokens of a GPU pass to start with
+    :param max_token_budget: The largest budget a GPU pass grows to
+    :param cpu_token_budget: The padded tokens of a CPU pass; on the CPU a pass takes longer per token as it grows
+        (attention over more padding, activations out of the caches), so the budget is only ever lowered
+    :param memory_limit_bytes: The resident set size of the process passes are kept under, 0 for no limit
+    :return: The BudgetedEmbedder, called like embed
+    """
+    if engine != "torch" or not torch.cuda.is_available():
+        token_budget = max_token_budget = cpu_token_budget
+    return BudgetedEmbedder(
+        embed, token_budget=token_budget, max_token_budget=max_token_budget, memory_limit_bytes=memory_limit_bytes
+    )
+
+
+def setup_similarity_search(
+    ss_dataset_dir: str,
+    embedder=None,
+    compile_model=True,
+    pretrained_model_name_or_path="facebook/esm2_t33_650M_UR50D",
+    batch_size: int = 8,
+):
+    """
+    Load the SimilaritySearch of a dataset
+    :param ss_dataset_dir: The dataset directory
+    :param embedder: The embedder of the queries, defaults to the protein_search embedder of the checkpoint
+    :param compile_model: Whether to compile the protein_search embedder
+    :param pretrained_model_name_or_path: The ESM-2 checkpoint
+    :param batch_size: The most sequences get_pooled_embeddings embeds in one forward pass
+    :return: The SimilaritySearch
+    """
     if embedder is None:
-        embedder = setup_embeddings(compile_model=compile_model)
-    return SimilaritySearch(dataset_dir=Path(ss_dataset_dir), embedder=embedder, batch_size=8)
+        embedder = setup_embeddings(
+            pretrained_model_name_or_path=pretrained_model_name_or_path, compile_model=compile_model
+        )
+    return SimilaritySearch(dataset_dir=Path(ss_dataset_dir), embedder=embedder, batch_size=batch_size)
+
+
+def setup_hit_store(ss_dataset_dir: str, hit_store_dir: str | None = None) -> HitStore:
+    """
+    Open the memory-mapped hit store of the dataset, building it from the dataset on first use
+    :param ss_dataset_dir: The dataset directory the SimilaritySearch is loaded from
+    :param hit_store_dir: Where the hit store lives, defaults to <ss_dataset_dir>.hitstore
+    """
+    if not hit_store_dir:
+        hit_store_dir = f"{Path(ss_dataset_dir)}.hitstore"
+    return HitStore.open_or_build(ss_dataset_dir, hit_store_dir)
+
+
+def setup_sequence_index(
+    hit_store: HitStore | ShardedHitStore,
+    model_name: str,
+    ss_dataset_dir: str = "",
+    sequence_index_dir: str = "",
+    shard_manifest: str = "",
+    **kwargs,
+):
+    """
+    Open the exact sequence index written by build_index, so queries already in the database skip the model
+    :param hit_store: The hit store of the database, or of its shards
+    :param model_name: The checkpoint queries are embedded with, the sequence index is only used if it matches
+    :param ss_dataset_dir: The dataset directory the SimilaritySearch is loaded from
+    :param sequence_index_dir: Where the sequence index lives, defaults to <ss_dataset_dir>.sequences
+    :param shard_manifest: The shard manifest of a sharded database, whose shards each have a sequence index
+    :param kwargs: The windows of the service, see SequenceIndex.open
+    :return: The SequenceIndex or ShardedSequenceIndex, None when there is none to use
+    """
+    if shard_manifest:
+        return ShardedSequenceIndex.open(shard_manifest, hit_store, model_name, **kwargs)
+    if not sequence_index_dir:
+        sequence_index_dir = f"{Path(ss_dataset_dir)}.sequences"
+    return SequenceIndex.open(sequence_index_dir, hit_store, model_name, **kwargs)
+
+
+def setup_index(
+    ss,
+    hit_store: HitStore,
+    engine: str = "flat",
+    ss_dataset_dir: str = "",
+    index_dir: str = "",
+    flat_index_path: str = "",
+    mmap: bool = False,
+    **kwargs,
+):
+    """
+    Set up the index queries are searched with
+    :param ss: The SimilaritySearch object, holding the exact flat index, or None to search the flat index file
+    :param hit_store: The hit store approximate indexes are built from, their rows are the rows of the hit store
+    :param engine: flat, ivf, ivfpq or hnsw, see FaissIndex
+    :param ss_dataset_dir: The dataset directory the SimilaritySearch is loaded from
+    :param index_dir: Where approximate indexes live, defaults to <ss_dataset_dir>.indexes
+    :param flat_index_path: The exact index written with the dataset, defaults to <ss_dataset_dir>.index
+    :param mmap: Map the index files instead of reading them, see read_faiss_index
+    :param kwargs: The build settings and search limits of approximate indexes, see FaissIndex.build
+    """
+    if engine == "flat":
+        if ss is not None:
+            return SimilaritySearchIndex(ss)
+        search_limits = {key: value for key, value in kwargs.items() if key.endswith(("nprobe", "ef_search"))}
+        return FaissIndex.open_flat(flat_index_path or f"{Path(ss_dataset_dir)}.index", mmap=mmap, **search_limits)
+    if not index_dir:
+        index_dir = f"{Path(ss_dataset_dir)}.indexes"
+    return FaissIndex.open_or_build(hit_store, index_dir, engine, mmap=mmap, **kwargs)
+
+
+def setup_shards(shard_manifest: str, engine: str = "flat", **kwargs) -> tuple[ShardedIndex, ShardedHitStore]:
+    """
+    Set up the search of a database split into shards, each shard built by build_index
+    :param shard_manifest: The JSON file listing the build manifests of the shards, see read_shard_manifest
+    :param engine: The index engine of every shard, see open_shard_index
+    :param kwargs: The build settings and search limits of the shard indexes, see FaissIndex.build
+    :return: The index searching every shard in its own process and the hit stores of the shards
+    """
+    return ShardedIndex.open(shard_manifest, engine, **kwargs), ShardedHitStore.open(shard_manifest)
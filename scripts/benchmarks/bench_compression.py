@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Measure the bytes on the wire and the CPU cost of compressing typical /similarity responses with each encoding and
+level of the CompressionMiddleware: hits only (discard_embeddings), and hits with their embeddings in each
+embedding_encoding, as one document and as the chunks of /similarity/stream.
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_compression.py --queries 32 --hits 10
+
+Compression and decompression times are the best of --repeats single-threaded runs. zstd and br are measured when
+zstandard and brotli are installed.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+for name, value in {"VERSION": "bench", "ROOT_PATH": "", "AUTH_URL": "", "VCS_REF": "", "MODEL_DIR": ""}.items():
+    os.environ.setdefault(name, value)
+
+from dependencies import compression  # noqa: E402
+from dependencies.compression import StreamCompressor, StreamDecompressor, installed_encodings  # noqa: E402
+from models.request_models import EmbeddingEncoding  # noqa: E402
+from models.response_encoding import encode_ndjson_proteins, encode_similarity_response  # noqa: E402
+
+LEVELS = {"gzip": [1, 4, 6, 9], "zstd": [1, 3, 6, 12], "br": [1, 4, 6, 9]}
+
+
+def responses(queries: int, hits: int, dim: int, stream_chunk_size: int) -> dict:
+    """The bodies of a response of each kind, with random hits and embeddings like those of a float16 hit store"""
+    rng = np.random.default_rng(0)
+    query_ids = [f">query{i:05d}" for i in range(queries)]
+    query_embeddings = rng.standard_normal((queries, dim)).astype(np.float32) * 0.1
+    scores = [np.sort(rng.random(hits, dtype=np.float32))[::-1].tolist() for _ in range(queries)]
+    tags = [[f"sp|P{rng.integers(100000):05d}|PROT_HUMAN" for _ in range(hits)] for _ in range(queries)]
+    hit_embeddings = [(rng.standard_normal((hits, dim)) * 0.1).astype(np.float16).astype(np.float32) for _ in scores]
+    summary = {"num_sequences": queries, "total_sequence_length": 300 * queries, "response_size": 0}
+    summary["execution_time"] = 1
+    kinds = {
+        "hits only": encode_similarity_response(
+            summary, query_ids, query_embeddings, scores, tags, hit_embeddings, True
+        )
+    }
+    for encoding in EmbeddingEncoding:
+        kinds[f"{encoding.value} embeddings"] = encode_similarity_response(
+            summary, query_ids, query_embeddings, scores, tags, hit_embeddings, False, encoding
+        )
+    kinds["json embeddings, streamed"] = [
+        encode_ndjson_proteins(
+            query_ids[start : start + stream_chunk_size],
+            query_embeddings[start : start + stream_chunk_size],
+            scores[start : start + stream_chunk_size],
+            tags[start : start + stream_chunk_size],
+            hit_embeddings[start : start + stream_chunk_size],
+            False,
+        )
+        for start in range(0, queries, stream_chunk_size)
+    ]
+    return kinds
+
+
+def compress(encoding: str, level: int, chunks: list[bytes]) -> bytes:
+    compressor = StreamCompressor(encoding, level)
+    return b"".join(compressor.compress(chunk, final=i == len(chunks) - 1) for i, chunk in enumerate(chunks))
+
+
+def decompress(encoding: str, body: bytes) -> bytes:
+    decompressor = StreamDecompressor(encoding, max_bytes=1 << 40)
+    data = decompressor.decompress(body)
+    decompressor.finish()
+    return data
+
+
+def best_of(repeats: int, function, *args):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=32)
+    parser.add_argument("--hits", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=1280)
+    parser.add_argument("--stream-chunk-size", type=int, default=8, help="Queries per streamed chunk")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--encodings", nargs="+", default=installed_encodings(["gzip", "zstd", "br"]))
+    args = parser.parse_args()
+
+    print(f"{args.queries} queries x {args.hits} hits, {args.dim}-d embeddings; defaults {compression.LEVELS}")
+    print(
+        f"{'response':<28}{'encoding':>9}{'level':>6}{'MB':>9}{'ratio':>7}{'compress ms':>13}{'MB/s':>8}"
+        f"{'decompress ms':>15}"
+    )
+    for kind, body in responses(args.queries, args.hits, args.dim, args.stream_chunk_size).items():
+        chunks = body if isinstance(body, list) else [body]
+        size = sum(map(len, chunks))
+        print(f"{kind:<28}{'identity':>9}{'':>6}{size / 1e6:>9.3f}")
+        for encoding in args.encodings:
+            for level in LEVELS[encoding]:
+                seconds, compressed = best_of(args.repeats, compress, encoding, level, chunks)
+                decompress_seconds, data = best_of(args.repeats, decompress, encoding, compressed)
+                assert data == b"".join(chunks)
+                print(
+                    f"{'':<28}{encoding:>9}{level:>6}{len(compressed) / 1e6:>9.3f}{size / len(compressed):>7.1f}"
+                    f"{seconds * 1000:>13.1f}{size / seconds / 1e6:>8.0f}{decompress_seconds * 1000:>15.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Compare the memory and latency of the Esm2Embedder paths on CPU: the full path (EsmForMaskedLM with every hidden
+state, per-residue output pooled on the host) against the lean path (encoder only, pooled on the device), and the
+throughput of the CPU engines (--engines torch int8 onnx) by sequence length (--lengths 100 300 1000).
+Each checkpoint, engine, length and path runs in its own process so the resident set sizes do not mix.
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_embedder.py
+
+Without access to the Hugging Face hub, --random-init writes randomly initialized models with the architectures of
+the checkpoints to a temporary model directory; memory and latency only depend on the architecture.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+ARCHITECTURES = {
+    "facebook/esm2_t6_8M_UR50D": {"hidden_size": 320, "num_hidden_layers": 6, "intermediate_size": 1280},
+    "facebook/esm2_t30_150M_UR50D": {"hidden_size": 640, "num_hidden_layers": 30, "intermediate_size": 2560},
+    "facebook/esm2_t33_650M_UR50D": {"hidden_size": 1280, "num_hidden_layers": 33, "intermediate_size": 5120},
+}
+ESM_VOCAB = "<cls> <pad> <eos> <unk> L A G V S E R T I D P K Q N F Y M H W C X B U Z O . - <null_1> <mask>".split()
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakRss:
+    """Sample the resident set size in the background and keep the largest value"""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def write_random_model(local_model_dir: str, model_name: str):
+    """Save a randomly initialized model where Esm2Embedder looks for a local snapshot"""
+    from transformers import EsmConfig, EsmForMaskedLM, EsmTokenizer
+
+    model_cache_dir = os.path.join(local_model_dir, f"models--{model_name.replace('/', '--')}")
+    vocab_file = os.path.join(local_model_dir, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(ESM_VOCAB))
+    config = EsmConfig(
+        vocab_size=len(ESM_VOCAB),
+        num_attention_heads=20,
+        max_position_embeddings=1026,
+        position_embedding_type="rotary",
+        token_dropout=True,
+        emb_layer_norm_before=False,
+        layer_norm_eps=1e-5,
+        mask_token_id=ESM_VOCAB.index("<mask>"),
+        pad_token_id=ESM_VOCAB.index("<pad>"),
+        **ARCHITECTURES[model_name],
+    )
+    EsmForMaskedLM(config).save_pretrained(model_cache_dir)
+    EsmTokenizer(vocab_file).save_pretrained(model_cache_dir)
+    os.makedirs(os.path.join(model_cache_dir, "snapshots"), exist_ok=True)
+    os.symlink(model_cache_dir, os.path.join(model_cache_dir, "snapshots", "random"))
+
+
+def host_pooled(embedder, sequences) -> np.ndarray:
+    """The full path: per-residue hidden states leave the model and are mean-pooled on the host"""
+    hidden_states = embedder.embed(sequences).float().cpu().numpy()
+    lengths = [min(len(sequence), hidden_states.shape[1] - 2) for sequence in sequences]
+    return np.stack([hidden_states[i, 1 : length + 1].mean(axis=0) for i, length in enumerate(lengths)])
+
+
+def run_one(args):
+    import torch
+
+    from dependencies.embedder import Esm2Embedder
+
+    torch.set_num_threads(args.threads)
+    rng = np.random.default_rng(0)
+    sequences = ["".join(rng.choice(list(AMINO_ACIDS), args.length)) for _ in range(args.batch_size)]
+
+    baseline = rss_bytes()
+    lean = args.path == "lean"
+    embedder = Esm2Embedder(
+        local_model_dir=args.local_model_dir, model_name=args.model, half_precision=False, lean=lean, engine=args.engine
+    )
+    embed = embedder.embed_pooled if lean else lambda batch: host_pooled(embedder, batch)
+    loaded = rss_bytes()
+
+    embed(sequences)  # warm up
+    timings = []
+    with PeakRss() as peak:
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            pooled = embed(sequences)
+            timings.append(time.perf_counter() - start)
+    print(
+        json.dumps(
+            {
+                "model": args.model,
+                "engine": args.engine,
+                "path": args.path,
+                "shape": list(pooled.shape),
+                "median_s": statistics.median(timings),
+                "model_mb": (loaded - baseline) / 2**20,
+                "inference_peak_mb": (peak.peak - loaded) / 2**20,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        choices=list(ARCHITECTURES),
+        default=["facebook/esm2_t6_8M_UR50D", "facebook/esm2_t33_650M_UR50D"],
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[300])
+    parser.add_argument("--engines", nargs="+", choices=["torch", "int8", "onnx"], default=["torch"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument("--local-model-dir", default="local_models")
+    parser.add_argument("--random-init", action="store_true")
+    parser.add_argument("--path", choices=["full", "lean"], help=argparse.SUPPRESS)
+    parser.add_argument("--model", help=argparse.SUPPRESS)
+    parser.add_argument("--engine", default="torch", help=argparse.SUPPRESS)
+    parser.add_argument("--length", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.path:
+        run_one(args)
+        return
+
+    with tempfile.TemporaryDirectory() as random_model_dir:
+        if args.random_init:
+            args.local_model_dir = random_model_dir
+            for model_name in args.models:
+                write_random_model(random_model_dir, model_name)
+
+        print(f"{args.batch_size} sequences per batch, {args.threads} threads, fp32 on CPU")
+        print(
+            f"{'model':<30} {'engine':<6} {'path':<5} {'length':>6} {'seconds':>8} {'seq/s':>7} "
+            f"{'model MB':>9} {'peak MB':>8}"
+        )
+        for model_name in args.models:
+            for engine in args.engines:
+                # The CPU engines are measured on the lean path they are deployed with
+                for path in ("full", "lean") if engine == "torch" else ("lean",):
+                    for length in args.lengths:
+                        command = [sys.executable, __file__, "--model", model_name, "--engine", engine]
+                        command += ["--path", path, "--length", str(length)]
+                        for name in ("batch_size", "repeats", "threads", "local_model_dir"):
+                            command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+                        result = subprocess.run(command, check=True, capture_output=True, text=True)
+                        result = json.loads(result.stdout.strip().splitlines()[-1])
+                        print(
+                            f"{model_name:<30} {engine:<6} {path:<5} {length:>6} {result['median_s']:>8.3f} "
+                            f"{args.batch_size / result['median_s']:>7.2f} "
+                            f"{result['model_mb']:>9.0f} {result['inference_peak_mb']:>8.0f}"
+                        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Measure the latency of small interactive requests while batch callers keep the MicroBatcher saturated with long
+sequences, with every caller in one first come first served queue (fifo) and with a fair queue per caller (fair).
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_fairness.py --seconds 20
+
+The queries are embedded by the StubEmbedder of bench_load, which holds the inference thread for the time a model
+would take, and searched in a brute force index of --rows random unit vectors. Each of the --batch-callers sends
+requests of --batch-sequences sequences of --batch-length residues back to back; each of the --interactive-callers
+sends a request of one --interactive-length residue sequence every --think-ms. The interactive requests are first
+run alone, as the baseline.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import numpy as np
+
+for name, value in {"VERSION": "bench", "ROOT_PATH": "", "AUTH_URL": "", "VCS_REF": "", "MODEL_DIR": ""}.items():
+    os.environ.setdefault(name, value)
+
+from bench_embedder import AMINO_ACIDS  # noqa: E402
+from bench_load import PERCENTILES, StubEmbedder  # noqa: E402
+from dependencies.batcher import MicroBatcher  # noqa: E402
+from dependencies.fairness import Caller  # noqa: E402
+from dependencies.index_engines import SearchParams  # noqa: E402
+from dependencies.inference_executor import InferenceExecutor  # noqa: E402
+
+
+class BruteForceIndex:
+    """Exact inner product search over random unit vectors"""
+
+    def __init__(self, rows: int, dim: int):
+        database = np.random.default_rng(0).standard_normal((rows, dim)).astype(np.float32)
+        self.database = database / np.linalg.norm(database, axis=1, keepdims=True)
+
+    def search_params(self, nprobe=None, ef_search=None) -> SearchParams:
+        return SearchParams()
+
+    def search(self, query_embeddings, top_k, params=SearchParams()):
+        scores = query_embeddings @ self.database.T
+        order = np.argpartition(-scores, top_k, axis=1)[:, :top_k]
+        return list(np.take_along_axis(scores, order, axis=1)), list(order)
+
+
+def sequences(rng: np.random.Generator, count: int, length: int) -> list[str]:
+    return ["".join(rng.choice(list(AMINO_ACIDS), length)) for _ in range(count)]
+
+
+async def run(args, fair: bool, batch_callers: int) -> dict:
+    batcher = MicroBatcher(
+        None,
+        InferenceExecutor(),
+        max_batch_size=args.batch_size,
+        embed=StubEmbedder(args.dim, args.embed_batch_ms, args.embed_token_us).embed_pooled,
+        index=BruteForceIndex(args.rows, args.dim),
+    )
+    rng = np.random.default_rng(0)
+    deadline = time.perf_counter() + args.seconds
+    latencies, batch_residues = [], [0]
+
+    def caller(name: str) -> Caller:
+        return Caller(name) if fair else Caller("shared")
+
+    async def batch_caller(i: int):
+        while time.perf_counter() < deadline:
+            request = sequences(rng, args.batch_sequences, args.batch_length)
+            await batcher.search(request, top_k=10, caller=caller(f"batch{i}"))
+            batch_residues[0] += args.batch_sequences * args.batch_length
+
+    async def interactive_caller(i: int):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await batcher.search(sequences(rng, 1, args.interactive_length), top_k=10, caller=caller(f"user{i}"))
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(args.think_ms / 1000)
+
+    await asyncio.gather(
+        *(batch_caller(i) for i in range(batch_callers)),
+        *(interactive_caller(i) for i in range(args.interactive_callers)),
+    )
+    batcher.shutdown()
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        **{f"p{p}": float(np.percentile(milliseconds, p)) for p in PERCENTILES},
+        "batch residues/s": batch_residues[0] / args.seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=320)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--embed-batch-ms", type=float, default=1.0, help="Stub model time per batch")
+    parser.add_argument("--embed-token-us", type=float, default=10.0, help="Stub model time per padded token")
+    parser.add_argument("--batch-callers", type=int, default=2)
+    parser.add_argument("--batch-sequences", type=int, default=100)
+    parser.add_argument("--batch-length", type=int, default=1000)
+    parser.add_argument("--interactive-callers", type=int, default=4)
+    parser.add_argument("--interactive-length", type=int, default=300)
+    parser.add_argument("--think-ms", type=float, default=100)
+    args = parser.parse_args()
+
+    print(f"{'queue':<22}{'requests':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'batch residues/s':>18}")
+    for label, fair, batch_callers in (
+        ("interactive alone", True, 0),
+        ("fifo", False, args.batch_callers),
+        ("fair", True, args.batch_callers),
+    ):
+        result = asyncio.run(run(args, fair, batch_callers))
+        print(
+            f"{label:<22}{result['requests']:>9}{result['p50']:>9.0f}{result['p95']:>9.0f}{result['p99']:>9.0f}"
+            f"{result['batch residues/s']:>18.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
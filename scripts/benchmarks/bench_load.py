@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Load test the service end to end: the app of create_app served by uvicorn, with a deterministic stub embedder in
+place of ESM-2 and a synthetic database of --rows random unit vectors, replays a workload at each --concurrency and
+reports the throughput and the latency percentiles of each endpoint, as JSON with --output.
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_load.py \
+    --rows 100000 --requests 400 --concurrency 1 8 32 --output load.json --baseline previous_load.json
+
+The stub embeds a sequence as a random unit vector seeded by its digest, so the same workload gets the same hits on
+every run, and holds the inference thread for --embed-batch-ms plus --embed-token-us per padded token of the batch,
+like a model forward pass releasing the GIL. The database, its flat index and the approximate index of
+--index-engine are written to a temporary directory, and each concurrency level starts a new server process so the
+embedding cache and the metrics start empty. --setting NAME=VALUE passes settings to the server, e.g.
+--setting BATCH_MAX_SIZE=64 to compare batch sizes.
+
+The workload is generated (--requests requests of --sequences-per-request sequences whose lengths are log-normal
+around --median-length, --stream-fraction of them sent to /similarity/stream, --repeat-fraction of the sequences
+repeating earlier ones) or read from --workload, a JSON lines file of /similarity request bodies or of
+{"path": ..., "body": ...} objects. Each of the --concurrency clients sends its next request as soon as the previous
+one is answered. --url runs the workload against a server already running instead.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from bench_embedder import AMINO_ACIDS
+
+PERCENTILES = (50, 95, 99)
+
+
+class StubEmbedder:
+    """Embeds a sequence as a unit vector seeded by its digest, taking the time a model would"""
+
+    def __init__(self, dim: int, batch_ms: float = 1.0, token_us: float = 10.0):
+        self.dim = dim
+        self.batch_seconds = batch_ms / 1000
+        self.token_seconds = token_us / 1e6
+
+    def embed_pooled(self, sequences: list[str]) -> np.ndarray:
+        padded_tokens = len(sequences) * (max(map(len, sequences)) + 2)
+        time.sleep(self.batch_seconds + self.token_seconds * padded_tokens)
+        embeddings = np.stack(
+            [
+                np.random.default_rng(int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "little"))
+                .standard_normal(self.dim)
+                .astype(np.float32)
+                for s in sequences
+            ]
+        )
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def serve(args):
+    """Serve the app with the stub embedder, in the server process"""
+    import uvicorn
+
+    import factory
+
+    # The CPU engine path of load_search_state embeds queries with setup_cpu_embedder, the stub stands in for it
+    stub = StubEmbedder(args.dim, args.embed_batch_ms, args.embed_token_us)
+    factory.setup_cpu_embedder = lambda *_, **__: stub
+    uvicorn.run(factory.create_app(), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def server_environment(args, work_dir: str) -> dict:
+    """The settings of the server process"""
+    environment = {
+        "VERSION": "bench",
+        "ROOT_PATH": "",
+        "AUTH_URL": "",
+        "VCS_REF": "",
+        "MODEL_DIR": os.path.join(work_dir, "database"),
+        "EMBEDDER_ENGINE": "int8",
+        "EMBEDDING_MODEL_NAME": "stub",
+        "INDEX_ENGINE": args.index_engine,
+        "JOBS_DIR": os.path.join(work_dir, "jobs"),
+        "LOG_FILE": os.path.join(work_dir, "server.log"),
+    }
+    for setting in args.setting:
+        name, _, value = setting.partition("=")
+        environment[name] = value
+    return os.environ | environment
+
+
+def start_server(args, work_dir: str) -> subprocess.Popen:
+    command = [sys.executable, __file__, "--serve", "--port", str(args.port), "--dim", str(args.dim)]
+    command += ["--embed-batch-ms", str(args.embed_batch_ms), "--embed-token-us", str(args.embed_token_us)]
+    return subprocess.Popen(command, env=server_environment(args, work_dir))
+
+
+def random_sequence(rng: np.random.Generator, length: int) -> str:
+    return "".join(rng.choice(list(AMINO_ACIDS), length))
+
+
+def generate_workload(args) -> list[dict]:
+    """
+    Generate --requests similarity requests, the same ones for the same arguments
+    :return: The path and body of each request
+    """
+    rng = np.random.default_rng(args.seed)
+    options = {"threshold": args.threshold, "max_hits": args.max_hits, "discard_embeddings": not args.embeddings}
+    sent = []
+    workload = []
+    for request in range(args.requests):
+        sequences = []
+        for query in range(int(rng.choice(args.sequences_per_request))):
+            if sent and rng.random() < args.repeat_fraction:
+                sequence = sent[rng.integers(len(sent))]
+            else:
+                length = int(np.clip(rng.lognormal(np.log(args.median_length), args.length_sigma), 2, args.max_length))
+                sequence = random_sequence(rng, length)
+                sent.append(sequence)
+            sequences.append({"id": f">bench{request:06d}_{query}", "sequence": sequence})
+        path = "/similarity/stream" if rng.random() < args.stream_fraction else "/similarity"
+        workload.append({"path": path, "body": options | {"sequences": sequences}})
+    return workload
+
+
+def read_workload(path: str) -> list[dict]:
+    """Read a JSON lines workload, lines without a path are bodies of /similarity requests"""
+    workload = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                workload.append(request if "path" in request else {"path": "/similarity", "body": request})
+    return workload
+
+
+async def run_workload(url: str, workload: list[dict], concurrency: int, timeout: float) -> tuple[list[dict], float]:
+    """
+    Send the requests of the workload from concurrency clients, each sending its next request once answered
+    :return: The path, status, latency and number of queries of each request, and the seconds the workload took
+    """
+    import httpx
+
+    requests = iter(workload)
+    results = []
+
+    async def client(http: httpx.AsyncClient):
+        for request in requests:
+            start = time.perf_counter()
+            try:
+                response = await http.post(request["path"], json=request["body"])
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            results.append(
+                {
+                    "path": request["path"],
+                    "status": status,
+                    "seconds": time.perf_counter() - start,
+                    "queries": len(request["body"].get("sequences", [])),
+                }
+            )
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        return results, time.perf_counter() - start
+
+
+def summarize(results: list[dict], seconds: float) -> dict:
+    """The throughput and latency percentiles of every request and of each endpoint"""
+
+    def summary(endpoint_results: list[dict]) -> dict:
+        ok = [result for result in endpoint_results if result["status"] == 200]
+        latencies_ms = np.array([result["seconds"] for result in ok]) * 1000
+        statuses = {}
+        for result in endpoint_results:
+            statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+        return {
+            "requests": len(endpoint_results),
+            "errors": len(endpoint_results) - len(ok),
+            "statuses": statuses,
+            "requests_per_second": len(ok) / seconds,
+            "queries_per_second": sum(result["queries"] for result in ok) / seconds,
+            "latency_ms": (
+                {f"p{p}": float(np.percentile(latencies_ms, p)) for p in PERCENTILES}
+                | {"mean": float(latencies_ms.mean()), "max": float(latencies_ms.max())}
+                if len(ok)
+                else {}
+            ),
+        }
+
+    endpoints = sorted({result["path"] for result in results})
+    return {
+        "seconds": seconds,
+        "total": summary(results),
+        "endpoints": {path: summary([r for r in results if r["path"] == path]) for path in endpoints},
+    }
+
+
+def stage_seconds(metrics: str) -> dict:
+    """The total seconds and count of each stage of llm_homology_stage_seconds, from the /metrics text"""
+    stages = {}
+    for line in metrics.splitlines():
+        for suffix, key in (("_sum", "seconds"), ("_count", "count")):
+            prefix = f"llm_homology_stage_seconds{suffix}{{"
+            if line.startswith(prefix):
+                labels, value = line[len(prefix) :].split("} ")
+                stage = labels.split('"')[1]
+                stages.setdefault(stage, {})[key] = float(value)
+    return stages
+
+
+def stage_means(before: dict, after: dict) -> dict:
+    """The mean milliseconds of each stage between two stage_seconds"""
+    means = {}
+    for stage, totals in after.items():
+        count = totals.get("count", 0) - before.get(stage, {}).get("count", 0)
+        if count:
+            means[stage] = 1000 * (totals["seconds"] - before.get(stage, {}).get("seconds", 0)) / count
+    return means
+
+
+async def wait_until_ready(url: str, server: subprocess.Popen | None, timeout: float = 300):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=url) as http:
+        while time.monotonic() < deadline:
+            if server is not None and server.poll() is not None:
+                raise RuntimeError(f"The server exited with {server.returncode}")
+            try:
+                response = await http.get("/ready")
+                if response.status_code == 200:
+                    return
+                if response.json().get("status") == "failed":
+                    raise RuntimeError(f"The server failed to load: {response.json()['error']}")
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"{url} was not ready after {timeout}s")
+
+
+async def scrape_stages(url: str) -> dict:
+    import httpx
+
+    async with httpx.AsyncClient(base_url=url) as http:
+        return stage_seconds((await http.get("/metrics")).text)
+
+
+def run_level(args, url: str, workload: list[dict], concurrency: int, work_dir: str | None) -> dict:
+    """Run the workload at one concurrency, against a new server unless --url is given"""
+    server = start_server(args, work_dir) if work_dir is not None else None
+    try:
+        asyncio.run(wait_until_ready(url, server))
+        before = asyncio.run(scrape_stages(url))
+        results, seconds = asyncio.run(run_workload(url, workload, concurrency, args.timeout))
+        after = asyncio.run(scrape_stages(url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return {"concurrency": concurrency} | summarize(results, seconds) | {"stage_ms": stage_means(before, after)}
+
+
+def git_commit() -> str | None:
+    try:
+        repository = os.path.dirname(os.path.abspath(__file__))
+        command = ["git", "rev-parse", "HEAD"]
+        return subprocess.run(command, cwd=repository, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_level(level: dict, baseline: dict | None):
+    """Print a concurrency level, with the change from the same endpoint and concurrency of the baseline"""
+    for path, endpoint in level["endpoints"].items():
+        latency = endpoint["latency_ms"]
+        line = (
+            f"{level['concurrency']:>11} {path:<20} {endpoint['requests']:>8} {endpoint['errors']:>6} "
+            f"{endpoint['requests_per_second']:>8.1f} {endpoint['queries_per_second']:>9.1f} "
+            + " ".join(f"{latency.get(f'p{p}', float('nan')):>8.1f}" for p in PERCENTILES)
+        )
+        if baseline is not None:
+            previous = baseline["endpoints"].get(path)
+            if previous and previous["latency_ms"] and latency:
+                line += (
+                    f"   vs baseline: rps {endpoint['requests_per_second'] / previous['requests_per_second'] - 1:+.1%}"
+                    f" p50 {latency['p50'] / previous['latency_ms']['p50'] - 1:+.1%}"
+                    f" p99 {latency['p99'] / previous['latency_ms']['p99'] - 1:+.1%}"
+                )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="Database rows")
+    parser.add_argument("--dim", type=int, default=320, help="Embedding size")
+    parser.add_argument("--index-engine", choices=["flat", "ivf", "ivfpq", "hnsw"], default="flat")
+    parser.add_argument("--embed-batch-ms", type=float, default=1.0, help="Stub model time per batch")
+    parser.add_argument("--embed-token-us", type=float, default=10.0, help="Stub model time per padded token")
+    parser.add_argument("--workload", help="A JSON lines workload, instead of a generated one")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--sequences-per-request", type=int, nargs="+", default=[1, 1, 1, 4, 16])
+    parser.add_argument("--median-length", type=int, default=300)
+    parser.add_argument("--length-sigma", type=float, default=0.6, help="Sigma of the log-normal lengths")
+    parser.add_argument("--max-length", type=int, default=5000)
+    parser.add_argument("--stream-fraction", type=float, default=0.0)
+    parser.add_argument("--repeat-fraction", type=float, default=0.0)
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--max-hits", type=int, default=10)
+    parser.add_argument("--embeddings", action="store_true", help="Return the embeddings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--setting", action="append", default=[], help="NAME=VALUE, a setting of the server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="Load test a running server instead")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the JSON results of a previous run")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    workload = read_workload(args.workload) if args.workload else generate_workload(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "arguments": vars(args),
+        "workload": {
+            "requests": len(workload),
+            "queries": sum(len(request["body"].get("sequences", [])) for request in workload),
+            "residues": sum(len(s["sequence"]) for request in workload for s in request["body"].get("sequences", [])),
+        },
+        "levels": [],
+    }
+    print(
+        f"{results['workload']['requests']} requests, {results['workload']['queries']} queries, "
+        f"{results['workload']['residues']} residues"
+    )
+    print(
+        f"{'concurrency':>11} {'endpoint':<20} {'requests':>8} {'errors':>6} {'req/s':>8} {'queries/s':>9} "
+        + " ".join(f"{f'p{p} ms':>8}" for p in PERCENTILES)
+    )
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.url:
+            url, server_dir = args.url, None
+        else:
+            from bench_workers import write_database
+
+            url, server_dir = f"http://127.0.0.1:{args.port}", work_dir
+            write_database(os.path.join(work_dir, "database"), args.rows, args.dim)
+        for concurrency in args.concurrency:
+            level = run_level(args, url, workload, concurrency, server_dir)
+            results["levels"].append(level)
+            print_level(level, None if baseline is None else baseline.get(concurrency))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Time building and encoding a /similarity response: the Pydantic path (a HitDetail per hit, then FastAPI's
+jsonable_encoder + json.dumps) against the direct encoder in models/response_encoding.py.
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_serialization.py
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+for name, value in {"VERSION": "bench", "ROOT_PATH": "", "AUTH_URL": "", "VCS_REF": "", "MODEL_DIR": ""}.items():
+    os.environ.setdefault(name, value)
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from dependencies.hit_store import HitStore  # noqa: E402
+from models import response_encoding  # noqa: E402
+from models.response_models import HitDetail, SimilarityResponse, QueryProtein  # noqa: E402
+from routes.similarity import get_filtered_annotations  # noqa: E402
+
+
+def pydantic_hits(search_results, discard_embeddings, hit_store) -> list[list[HitDetail]]:
+    """The pruned hits of each query as HitDetail models, as /similarity built them before the direct encoder"""
+    pruned_hits = []
+    for scores, tags, embeddings in zip(*get_filtered_annotations(search_results, 0.0, discard_embeddings, hit_store)):
+        embeddings = [[]] * len(scores) if discard_embeddings else embeddings.tolist()
+        pruned_hits.append(
+            [
+                HitDetail(HitID=tag, Score=score, Embedding=embedding)
+                for score, tag, embedding in zip(scores, tags, embeddings)
+            ]
+        )
+    return pruned_hits
+
+
+def pydantic_path(search_results, query_ids, query_embeddings, discard_embeddings, hit_store, summary):
+    pruned_hits = pydantic_hits(search_results, discard_embeddings, hit_store)
+    proteins = [
+        QueryProtein(
+            QueryId=query_id,
+            Embedding=[] if discard_embeddings else list(map(float, query_embeddings[i])),
+            total_hits=len(pruned_hits[i]),
+            Hits=pruned_hits[i],
+        )
+        for i, query_id in enumerate(query_ids)
+    ]
+    content = jsonable_encoder(SimilarityResponse(proteins=proteins, summary=summary))
+    # Encoded the way FastAPI's JSONResponse does
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def direct_path(search_results, query_ids, query_embeddings, discard_embeddings, hit_store, summary):
+    filtered = get_filtered_annotations(search_results, 0.0, discard_embeddings, hit_store)
+    return response_encoding.encode_similarity_response(
+        summary, query_ids, query_embeddings, *filtered, discard_embeddings
+    )
+
+
+def best_of(repeats, fn, *args):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        content = fn(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--hits", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=1280)
+    parser.add_argument("--db-size", type=int, default=100000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tags = [f"P{i:06d}" for i in range(args.db_size)]
+        embeddings = rng.standard_normal((args.db_size, args.dim)).astype(np.float16)
+        hit_store = HitStore.write(f"{tmp_dir}/hit_store", [(tags, embeddings)], args.db_size, args.dim, np.float16)
+
+        search_results = SimpleNamespace(
+            total_scores=[np.sort(rng.random(args.hits, dtype=np.float32))[::-1] for _ in range(args.queries)],
+            total_indices=[rng.integers(0, args.db_size, args.hits) for _ in range(args.queries)],
+        )
+        query_ids = [f"query{i}" for i in range(args.queries)]
+        query_embeddings = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+        summary = {"num_sequences": args.queries, "total_sequence_length": 0, "response_size": 0, "execution_time": 0}
+
+        encoder = "orjson" if response_encoding.orjson is not None else "json"
+        print(f"{args.queries} queries x {args.hits} hits, {args.dim}-d embeddings, direct encoder: {encoder}")
+        print(f"{'embeddings':<12}{'path':<10}{'seconds':>10}{'MB':>10}")
+        for discard_embeddings in (True, False):
+            inputs = (search_results, query_ids, query_embeddings, discard_embeddings, hit_store, summary)
+            for name, path in (("pydantic", pydantic_path), ("direct", direct_path)):
+                seconds, size = best_of(args.repeats, path, *inputs)
+                label = "discarded" if discard_embeddings else "included"
+                print(f"{label:<12}{name:<10}{seconds:>10.3f}{size / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
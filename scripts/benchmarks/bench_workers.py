@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Measure the memory of N server worker processes holding the same model and database, with the index and the model
+weights read into each process (INDEX_MMAP=false MODEL_MMAP=false) or mapped from their files (the default).
+Each worker loads the Esm2Embedder (torch engine, lean, fp32 on the CPU), the flat index and the hit store the way
+the service does, embeds and searches a warmup batch, then waits while its memory is read from
+/proc/<pid>/smaps_rollup:
+- RSS counts every resident page of the process, including the pages it shares with the other workers
+- PSS divides each shared page among the processes mapping it, so the PSS of the workers adds up to the memory
+  they use together
+- private pages are only used by the one process
+
+PYTHONPATH=.:llm_homology_api:llm_homology_api/src python scripts/benchmarks/bench_workers.py --random-init
+
+The database holds --rows random unit vectors of the embedding size of the model. Without access to the Hugging Face
+hub, --random-init writes a randomly initialized model with the architecture of the checkpoint, see bench_embedder.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from bench_embedder import AMINO_ACIDS, ARCHITECTURES, write_random_model
+
+MODES = {"read": False, "mmap": True}
+
+
+def write_database(output: str, rows: int, dim: int):
+    """Write a hit store and its flat index, as build_index does"""
+    from build_index import write_flat_index
+    from dependencies.hit_store import HitStore
+
+    def chunks(chunk_size=65536):
+        rng = np.random.default_rng(0)
+        for start in range(0, rows, chunk_size):
+            embeddings = rng.standard_normal((min(chunk_size, rows - start), dim)).astype(np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+            yield [f"P{row:08d}" for row in range(start, start + len(embeddings))], embeddings
+
+    hit_store = HitStore.write(f"{output}.hitstore", chunks(), num_rows=rows, dim=dim, dtype="float32")
+    write_flat_index(hit_store, f"{output}.index")
+
+
+def smaps_rollup_mb(pid: int) -> dict:
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0]) / 1024
+    return {
+        "rss": fields["Rss"],
+        "pss": fields["Pss"],
+        "private": fields["Private_Clean"] + fields["Private_Dirty"],
+    }
+
+
+def run_worker(args):
+    import torch
+
+    from dependencies.embedder import Esm2Embedder
+    from dependencies.hit_store import HitStore
+    from dependencies.index_engines import FaissIndex
+
+    torch.set_num_threads(1)
+    mmap = MODES[args.mode]
+    embedder = Esm2Embedder(
+        local_model_dir=args.local_model_dir, model_name=args.model, half_precision=False, lean=True, mmap_weights=mmap
+    )
+    index = FaissIndex.open_flat(f"{args.database}.index", mmap=mmap)
+    hit_store = HitStore(f"{args.database}.hitstore")
+
+    rng = np.random.default_rng(0)
+    sequences = ["".join(rng.choice(list(AMINO_ACIDS), 300)) for _ in range(4)]
+    _, indices = index.search(embedder.embed_pooled(sequences), 10)
+    hit_store.get_tags(np.concatenate(indices))
+    print("ready", flush=True)
+    # Hold the memory until the parent has measured it and closes stdin
+    sys.stdin.read()
+
+
+def measure(args, mode: str, workers: int) -> list[dict]:
+    command = [sys.executable, __file__, "--worker", "--mode", mode, "--model", args.model]
+    command += ["--database", args.database, "--local-model-dir", args.local_model_dir]
+    processes = [
+        subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) for _ in range(workers)
+    ]
+    try:
+        for process in processes:
+            if process.stdout.readline().strip() != "ready":
+                raise RuntimeError(f"A {mode} worker failed to start")
+        return [smaps_rollup_mb(process.pid) for process in processes]
+    finally:
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=list(ARCHITECTURES), default="facebook/esm2_t30_150M_UR50D")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--local-model-dir", default="local_models")
+    parser.add_argument("--random-init", action="store_true")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument("--database", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.random_init:
+            args.local_model_dir = work_dir
+            write_random_model(work_dir, args.model)
+        args.database = os.path.join(work_dir, "database")
+        dim = ARCHITECTURES[args.model]["hidden_size"]
+        write_database(args.database, args.rows, dim)
+        print(f"{args.model}, {args.rows} x {dim} float32 flat index ({args.rows * dim * 4 / 2**20:.0f} MB)")
+        print(f"{'mode':<5} {'workers':>7} {'RSS MB':>8} {'PSS MB':>8} {'private MB':>10} {'total PSS MB':>12}")
+        for mode in args.modes:
+            for workers in args.workers:
+                memory = measure(args, mode, workers)
+                print(
+                    f"{mode:<5} {workers:>7} {np.mean([m['rss'] for m in memory]):>8.0f} "
+                    f"{np.mean([m['pss'] for m in memory]):>8.0f} {np.mean([m['private'] for m in memory]):>10.0f} "
+                    f"{sum(m['pss'] for m in memory):>12.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+# Downloads the 8M and 650M checkpoints, so only runs when asked for
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("RUN_INTEGRATION_TESTS"), reason="set RUN_INTEGRATION_TESTS=1 to run the integration tests"
+)
+Esm2Embedder = pytest.importorskip("src.dependencies.embedder").Esm2Embedder
+
+# Per-residue embeddings of the reference checkpoints, see generate_embeddings.py
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data"))
+MODELS = [("facebook/esm2_t33_650M_UR50D", 1280), ("facebook/esm2_t6_8M_UR50D", 320)]
+SEQUENCES = ["MAQNRNSTGYA", "NLYIQWLKDGGPSSGRPPPS"]
+
+
+def cosine(a, b):
+    return (a * b).sum(axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1))
+
+
+@pytest.mark.parametrize("engine", ["int8", "onnx"])
+@pytest.mark.parametrize("model_name, embed_dim", MODELS)
+def test_cpu_engine_accuracy(engine, model_name, embed_dim):
+    if engine == "onnx":
+        pytest.importorskip("onnxruntime")
+    embedder = Esm2Embedder(model_name=model_name, half_precision=False, lean=True, engine=engine)
+
+    for sequence in SEQUENCES:
+        with open(os.path.join(DATA_DIR, f"{sequence}_{embed_dim}.json")) as f:
+            expected = np.array(json.load(f))[0]
+        residues = embedder.embed([sequence]).float().cpu().numpy()[0]
+        pooled = embedder.embed_pooled([sequence])[0]
+
+        assert residues.shape == expected.shape
+        # ONNX Runtime runs the same fp32 graph, int8 quantization moves each residue slightly
+        min_cosine = 0.999 if engine == "onnx" else 0.98
+        assert cosine(residues, expected).min() > min_cosine, f"{engine} residue embeddings of {sequence} drifted"
+        assert cosine(pooled, expected[1:-1].mean(axis=0)) > min_cosine, f"{engine} embedding of {sequence} drifted"
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cacheout import LRUCache
+from fastapi import HTTPException
+
+from src.clients.CachedAuthClient import CachedAuthClient
+
+
+class StandInAuthHandler(BaseHTTPRequestHandler):
+    """Answers like the auth service /me endpoint: "good" and "admin" tokens are valid, anything else is not"""
+
+    protocol_version = "HTTP/1.1"  # Keep connections alive
+
+    def do_GET(self):
+        server = self.server
+        token = self.headers["Authorization"]
+        with server.lock:
+            server.calls.append(token)
+            server.client_ports.add(self.client_address[1])
+        time.sleep(server.delay)
+        if token in ("good", "admin"):
+            status = 200
+            body = {"user": f"{token}_user", "customroles": ["LLMHomologyAdmin"] if token == "admin" else []}
+        else:
+            status = 401
+            body = {"error": {"message": "Invalid token"}}
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def auth_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInAuthHandler)
+    server.calls = []
+    server.client_ports = set()
+    server.lock = threading.Lock()
+    server.delay = 0.0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def auth_client(server, ttl=10, refresh_ahead_seconds=2):
+    return CachedAuthClient(
+        valid_tokens_cache=LRUCache(ttl=ttl),
+        auth_url=f"http://127.0.0.1:{server.server_port}/services/auth/api/V2/me",
+        admin_roles=["LLMHomologyAdmin"],
+        refresh_ahead_seconds=refresh_ahead_seconds,
+    )
+
+
+def test_valid_tokens_are_cached_and_connections_reused(auth_server):
+    client = auth_client(auth_server)
+
+    async def run():
+        try:
+            good = await client.get_user_auth_roles("good")
+            again = await client.get_user_auth_roles("good")
+            is_admin = await client.is_admin("admin")
+            return good, again, is_admin
+        finally:
+            await client.close()
+
+    good, again, is_admin = asyncio.run(run())
+
+    assert good.username == "good_user" and not good.is_admin
+    assert again is good
+    assert is_admin
+    assert auth_server.calls == ["good", "admin"]
+    # Both calls went over one pooled keep-alive connection
+    assert len(auth_server.client_ports) == 1
+
+
+def test_concurrent_misses_share_one_call(auth_server):
+    auth_server.delay = 0.2
+    client = auth_client(auth_server)
+
+    async def run():
+        try:
+            return await asyncio.gather(*(client.get_user_auth_roles("good") for _ in range(20)))
+        finally:
+            await client.close()
+
+    results = asyncio.run(run())
+
+    assert auth_server.calls == ["good"]
+    assert all(result is results[0] for result in results)
+
+
+def test_invalid_tokens_are_negatively_cached(auth_server):
+    client = auth_client(auth_server)
+
+    async def run():
+        errors = []
+        try:
+            for _ in range(3):
+                with pytest.raises(HTTPException) as e:
+                    await client.is_authorized("bad")
+                errors.append(e.value)
+        finally:
+            await client.close()
+        return errors
+
+    errors = asyncio.run(run())
+
+    assert [e.status_code for e in errors] == [401, 401, 401]
+    assert errors[-1].detail == {"message": "Invalid token"}
+    assert auth_server.calls == ["bad"]
+
+
+def test_tokens_close_to_expiry_are_revalidated_in_the_background(auth_server):
+    client = auth_client(auth_server, ttl=1, refresh_ahead_seconds=0.9)
+
+    async def run():
+        try:
+            first = await client.get_user_auth_roles("good")
+            await asyncio.sleep(0.2)
+            auth_server.delay = 0.3
+            # Served from the cache without waiting for the revalidation it starts
+            start = time.perf_counter()
+            stale = await client.get_user_auth_roles("good")
+            served_in = time.perf_counter() - start
+            await asyncio.sleep(0.5)
+            return first, stale, served_in, client.valid_tokens.get_ttl("good")
+        finally:
+            await client.close()
+
+    first, stale, served_in, remaining_ttl = asyncio.run(run())
+
+    assert stale is first
+    assert served_in < 0.1
+    assert auth_server.calls == ["good", "good"]
+    # The revalidation refreshed the cache entry
+    assert remaining_ttl > 0.5
+
+
+def test_auth_service_down():
+    client = CachedAuthClient(auth_url="http://127.0.0.1:9/me", admin_roles=[])
+
+    async def run():
+        try:
+            await client.get_user_auth_roles("good")
+        finally:
+            await client.close()
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(run())
+    assert e.value.status_code == 500
+    # Outages are not remembered as invalid tokens
+    assert client.invalid_tokens.get("good") is None
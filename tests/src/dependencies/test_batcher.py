@@ -0,0 +1,236 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.dependencies.batcher import MicroBatcher
+from src.dependencies.fairness import Caller
+from src.dependencies.index_engines import SearchParams
+from src.dependencies.inference_executor import InferenceExecutor
+
+
+class FakeSimilaritySearch:
+    """Embeds a sequence as [len(sequence)] * 4 and returns hits len, len+1, ... with decreasing scores"""
+
+    def __init__(self, fail=False):
+        self.embedded = []
+        self.calls = []
+        self.fail = fail
+
+    def get_pooled_embeddings(self, sequences):
+        self.embedded.append(list(sequences))
+        return np.array([[len(sequence)] * 4 for sequence in sequences], dtype=np.float32)
+
+    def search(self, query_embedding, top_k):
+        self.calls.append((query_embedding[:, 0].astype(int).tolist(), top_k))
+        if self.fail:
+            raise RuntimeError("search failed")
+        total_scores = [np.linspace(1.0, 0.5, top_k) for _ in query_embedding]
+        total_indices = [np.arange(int(e[0]), int(e[0]) + top_k) for e in query_embedding]
+        return SimpleNamespace(total_scores=total_scores, total_indices=total_indices), query_embedding
+
+
+def test_concurrent_requests_share_one_batch():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_batch_size=32, max_wait_ms=50)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.search(["AA", "AAA"], top_k=2),
+            batcher.search(["AAAA"], top_k=5),
+            batcher.search(["AAAAA", "AAAAAA"], top_k=1),
+        )
+
+    (s1, i1, e1), (s2, i2, e2), (s3, i3, e3) = asyncio.run(run())
+
+    assert len(ss.calls) == 1
+    assert ss.calls[0] == ([2, 3, 4, 5, 6], 5)
+    assert ss.embedded == [["AA", "AAA", "AAAA", "AAAAA", "AAAAAA"]]
+
+    # Every query gets its own top_k slice and its own embedding
+    assert [len(s) for s in s1] == [2, 2] and [len(s) for s in s2] == [5] and [len(s) for s in s3] == [1, 1]
+    assert list(i1[1]) == [3, 4]
+    assert list(i3[0]) == [5]
+    assert e1.shape == (2, 4) and e1[1][0] == 3
+    assert e3[1][0] == 6
+
+
+def test_database_sequences_reuse_their_stored_embedding():
+    ss = FakeSimilaritySearch()
+    stored = {"CCC": np.array([7, 7, 7, 7], dtype=np.float32)}
+    lookups = []
+
+    def stored_embeddings(sequences):
+        lookups.append(list(sequences))
+        return [stored.get(sequence) for sequence in sequences]
+
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_wait_ms=1, stored_embeddings=stored_embeddings)
+
+    _, indices, embeddings = asyncio.run(batcher.search(["AA", "CCC", "AA"], top_k=1))
+
+    assert lookups == [["AA", "CCC"]]
+    assert ss.embedded == [["AA"]]
+    assert embeddings[:, 0].tolist() == [2, 7, 2]
+    assert [int(i[0]) for i in indices] == [2, 7, 2]
+
+
+def test_batches_are_capped_at_max_batch_size():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_batch_size=3, max_wait_ms=1)
+
+    _, indices, embeddings = asyncio.run(batcher.search(["A" * n for n in range(2, 10)], top_k=1))
+
+    assert [len(lengths) for lengths, _ in ss.calls] == [3, 3, 2]
+    assert [int(i[0]) for i in indices] == list(range(2, 10))
+    assert embeddings.shape == (8, 4)
+
+
+def test_known_embeddings_skip_the_model():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_wait_ms=1)
+    cached = np.array([9, 9, 9, 9], dtype=np.float32)
+
+    _, indices, embeddings = asyncio.run(batcher.search(["AA", "CCC", "AA"], top_k=1, embeddings=[None, cached, None]))
+
+    # Only the misses reach the model, and a repeated sequence is embedded once
+    assert ss.embedded == [["AA"]]
+    assert [int(i[0]) for i in indices] == [2, 9, 2]
+    assert embeddings[:, 0].tolist() == [2, 9, 2]
+
+
+def test_search_errors_reach_every_waiting_request():
+    batcher = MicroBatcher(FakeSimilaritySearch(fail=True), InferenceExecutor(), max_batch_size=8, max_wait_ms=1)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.search(["AA"], top_k=1), batcher.search(["CC"], top_k=1), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_empty_request_skips_the_search():
+    ss = FakeSimilaritySearch()
+    scores, indices, embeddings = asyncio.run(MicroBatcher(ss, InferenceExecutor()).search([], top_k=3))
+    assert scores == [] and indices == [] and len(embeddings) == 0
+    assert ss.calls == []
+
+
+def test_batcher_survives_a_new_event_loop():
+    # TestClient runs each request on a fresh event loop
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_wait_ms=1)
+    for _ in range(2):
+        _, _, embeddings = asyncio.run(batcher.search(["AAA"], top_k=1))
+        assert embeddings[0][0] == 3
+    assert len(ss.calls) == 2
+
+
+def test_long_sequences_are_embedded_in_windows():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_wait_ms=1, window_size=4, window_overlap=1)
+
+    _, _, embeddings = asyncio.run(batcher.search(["AA", "A" * 10], top_k=1))
+
+    # The short query and the three windows of the long one share one forward pass
+    assert ss.embedded == [["AA", "AAAA", "AAAA", "AAAA"]]
+    assert embeddings[:, 0].tolist() == [2, 4]
+
+
+def test_queries_with_different_search_knobs_share_the_forward_pass():
+    ss = FakeSimilaritySearch()
+    index = SimpleNamespace(calls=[])
+
+    def search(query_embeddings, top_k, params):
+        index.calls.append((query_embeddings[:, 0].astype(int).tolist(), top_k, params))
+        return [np.ones(top_k)] * len(query_embeddings), [np.arange(top_k)] * len(query_embeddings)
+
+    index.search = search
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_wait_ms=50, index=index)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.search(["AA"], top_k=2, params=SearchParams(nprobe=8)),
+            batcher.search(["AAA"], top_k=1, params=SearchParams(nprobe=64)),
+            batcher.search(["AAAA"], top_k=3, params=SearchParams(nprobe=8)),
+        )
+
+    (s1, _, _), (s2, _, _), (s3, _, _) = asyncio.run(run())
+
+    assert ss.embedded == [["AA", "AAA", "AAAA"]]
+    assert sorted(index.calls) == [([2, 4], 3, SearchParams(nprobe=8)), ([3], 1, SearchParams(nprobe=64))]
+    assert [len(s1[0]), len(s2[0]), len(s3[0])] == [2, 1, 3]
+
+
+def test_background_queries_only_fill_the_room_left_by_interactive_ones():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_batch_size=3, max_wait_ms=20)
+
+    async def run():
+        background = asyncio.ensure_future(batcher.search(["A" * n for n in range(10, 15)], top_k=1, background=True))
+        interactive = asyncio.ensure_future(batcher.search(["CC", "CCC"], top_k=1))
+        return await asyncio.gather(background, interactive)
+
+    (_, background_indices, _), (_, interactive_indices, _) = asyncio.run(run())
+
+    # The interactive queries, queued last, go first
+    assert [lengths for lengths, _ in ss.calls] == [[2, 3, 10], [11, 12, 13], [14]]
+    assert [int(i[0]) for i in background_indices] == list(range(10, 15))
+    assert [int(i[0]) for i in interactive_indices] == [2, 3]
+
+
+def test_a_small_caller_is_not_queued_behind_the_backlog_of_another():
+    ss = FakeSimilaritySearch()
+    batcher = MicroBatcher(ss, InferenceExecutor(), max_batch_size=4, max_wait_ms=20)
+
+    async def run():
+        batch = asyncio.ensure_future(batcher.search(["A" * 50] * 16, top_k=1, caller=Caller("user:batch")))
+        await asyncio.sleep(0)
+        small = asyncio.ensure_future(batcher.search(["CC", "CCC"], top_k=1, caller=Caller("user:small")))
+        return await asyncio.gather(batch, small)
+
+    asyncio.run(run())
+
+    # The first batch of the backlog was already taken, the small caller goes in the next one rather than last
+    assert [lengths for lengths, _ in ss.calls][:2] == [[50, 50, 50, 50], [2, 3, 50, 50]]
+    assert len(ss.calls) == 5
+
+
+class BruteForceIndex:
+    """Exact inner product search over a fixed database, recording the size of every search"""
+
+    def __init__(self, database):
+        self.database = database
+        self.searches = []
+
+    def search(self, query_embeddings, top_k, params=SearchParams()):
+        self.searches.append((len(query_embeddings), top_k))
+        scores = query_embeddings @ self.database.T
+        order = np.argsort(-scores, axis=1)[:, :top_k]
+        return list(np.take_along_axis(scores, order, axis=1)), list(order)
+
+
+def test_range_search_returns_every_hit_above_the_threshold_up_to_top_k():
+    # Database rows score i / 500 * c against a query scaled by c
+    database = np.zeros((500, 4), dtype=np.float32)
+    database[:, 0] = np.arange(500) / 500
+    scales = {2: 0.5, 3: 0.91, 4: 0.95, 5: 1.0, 6: 2.0}
+    index = BruteForceIndex(database)
+    batcher = MicroBatcher(
+        FakeSimilaritySearch(),
+        InferenceExecutor(),
+        max_wait_ms=1,
+        embed=lambda sequences: np.array([[scales[len(s)], 0, 0, 0] for s in sequences], dtype=np.float32),
+        index=index,
+    )
+
+    scores, indices, _ = asyncio.run(
+        batcher.search(["A" * n for n in scales], top_k=100, params=SearchParams(threshold=0.9))
+    )
+
+    assert [len(i) for i in indices] == [0, 5, 26, 50, 100]
+    assert indices[3].tolist() == list(range(499, 449, -1))
+    assert all(np.all(s >= 0.9) for s in scores)
+    # Only the queries whose last hit still passes are searched again, for more hits
+    assert index.searches == [(5, 16), (3, 64), (1, 100)]
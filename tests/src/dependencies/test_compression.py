@@ -0,0 +1,127 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from fastapi.testclient import TestClient
+
+from src.dependencies.compression import (
+    CompressionMiddleware,
+    StreamCompressor,
+    StreamDecompressor,
+    negotiate_encoding,
+)
+
+LARGE = b'{"Embedding":[' + b",".join(b"0.%04d" % i for i in range(5000)) + b"]}"
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, encodings=["gzip"], min_bytes=1024, max_decompressed_bytes=100000)
+
+    @app.get("/large")
+    async def large():
+        return Response(LARGE, media_type="application/json")
+
+    @app.get("/small")
+    async def small():
+        return PlainTextResponse("ok")
+
+    @app.get("/archive")
+    async def archive():
+        return Response(gzip.compress(LARGE), media_type="application/gzip")
+
+    @app.get("/stream")
+    async def stream():
+        async def lines():
+            for i in range(3):
+                yield json.dumps({"line": i}).encode() + b"\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        return Response(await request.body(), media_type="application/octet-stream")
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def test_negotiate_encoding_follows_weights_then_server_preference():
+    offered = ["zstd", "br", "gzip"]
+    assert negotiate_encoding("gzip, deflate, br", offered) == "br"
+    assert negotiate_encoding("gzip;q=1.0, zstd;q=0.5", offered) == "gzip"
+    assert negotiate_encoding("*", offered) == "zstd"
+    assert negotiate_encoding("zstd;q=0, *;q=0.1", offered) == "br"
+    assert negotiate_encoding("identity", offered) is None
+    assert negotiate_encoding("", offered) is None
+
+
+def test_large_responses_are_compressed_and_small_or_compressed_ones_are_not(client):
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == LARGE
+    assert int(response.headers["content-length"]) < len(LARGE) / 2
+
+    assert "content-encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.get("/large", headers={"Accept-Encoding": "identity"}).headers
+    archive = client.get("/archive", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in archive.headers
+    assert gzip.decompress(archive.content) == LARGE
+
+
+def test_streamed_responses_are_flushed_chunk_by_chunk():
+    lines = [json.dumps({"line": i}).encode() + b"\n" for i in range(3)]
+
+    async def lines_app(scope, receive, send):
+        headers = [(b"content-type", b"application/x-ndjson")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for i, line in enumerate(lines):
+            await send({"type": "http.response.body", "body": line, "more_body": i < len(lines) - 1})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(CompressionMiddleware(lines_app, encodings=["gzip"], min_bytes=1024)(scope, None, send))
+
+    assert (b"content-encoding", b"gzip") in sent[0]["headers"]
+    decompressor = StreamDecompressor("gzip", max_bytes=1000)
+    # Each compressed chunk decodes to its line on arrival
+    assert [decompressor.decompress(message["body"]) for message in sent[1:]] == lines
+    decompressor.finish()
+
+
+def test_compressed_request_bodies_are_decompressed_within_the_limit(client):
+    echoed = client.post("/echo", content=gzip.compress(LARGE), headers={"Content-Encoding": "gzip"})
+    assert echoed.status_code == 200 and echoed.content == LARGE
+
+    too_large = client.post("/echo", content=gzip.compress(b"A" * 200000), headers={"Content-Encoding": "gzip"})
+    assert too_large.status_code == 413
+    invalid = client.post("/echo", content=b"not gzip", headers={"Content-Encoding": "gzip"})
+    assert invalid.status_code == 400
+    truncated = client.post("/echo", content=gzip.compress(LARGE)[:-20], headers={"Content-Encoding": "gzip"})
+    assert truncated.status_code == 400
+    assert client.post("/echo", content=b"x", headers={"Content-Encoding": "lz4"}).status_code == 415
+
+
+@pytest.mark.parametrize("encoding", ["zstd", "br"])
+def test_stream_compressors_round_trip(encoding):
+    pytest.importorskip({"zstd": "zstandard", "br": "brotli"}[encoding])
+    compressor = StreamCompressor(encoding)
+    decompressor = StreamDecompressor(encoding, max_bytes=len(LARGE) * 2)
+
+    first = decompressor.decompress(compressor.compress(LARGE[:5000]))
+    rest = decompressor.decompress(compressor.compress(LARGE[5000:], final=True))
+    decompressor.finish()
+
+    # The first chunk is flushed whole, before the stream ends
+    assert first == LARGE[:5000] and first + rest == LARGE
+    with pytest.raises(Exception, match="too large"):
+        StreamDecompressor(encoding, max_bytes=1000).decompress(StreamCompressor(encoding).compress(LARGE, True))
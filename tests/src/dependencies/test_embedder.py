@@ -1,5 +1,6 @@
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import pytest
 import torch
 from src.dependencies.embedder import Esm2Embedder
@@ -7,46 +8,128 @@ from src.dependencies.embedder import Esm2Embedder
 
 @pytest.fixture
 def mock_torch(mocker):
-    mocker.patch('torch.cuda.is_available', return_value=True)
-    mocker.patch('torch.device', return_value='cuda')
+    mocker.patch("torch.cuda.is_available", return_value=True)
+    mocker.patch("torch.device", return_value="cuda")
 
 
 @pytest.fixture
 def embedder(mock_torch, model_name, half_precision, eval_mode, device):
-    with patch('transformers.EsmTokenizer.from_pretrained', return_value=MagicMock()) as mock_tokenizer, \
-            patch('transformers.EsmForMaskedLM.from_pretrained', return_value=MagicMock(spec=torch.nn.Module)) as mock_model:
-        embedder = Esm2Embedder(model_name=model_name, half_precision=half_precision, eval_mode=eval_mode, device=device)
+    with patch("transformers.EsmTokenizer.from_pretrained", return_value=MagicMock()) as mock_tokenizer, patch(
+        "transformers.EsmForMaskedLM.from_pretrained", return_value=MagicMock(spec=torch.nn.Module)
+    ) as mock_model:
+        embedder = Esm2Embedder(
+            model_name=model_name, half_precision=half_precision, eval_mode=eval_mode, device=device
+        )
     return embedder
 
 
-@pytest.mark.parametrize("model_name, half_precision, eval_mode, device", [
-    ('facebook/esm2_t6_8M_UR50D', True, True, 'cuda'),
-    ('facebook/esm2_t6_8M_UR50D', False, True, 'cuda'),
-    ('facebook/esm2_t6_8M_UR50D', True, False, 'cpu'),
-    ('facebook/esm2_t6_8M_UR50D', False, False, 'cpu')
-])
+@pytest.mark.parametrize(
+    "model_name, half_precision, eval_mode, device",
+    [
+        ("facebook/esm2_t6_8M_UR50D", True, True, "cuda"),
+        ("facebook/esm2_t6_8M_UR50D", False, True, "cuda"),
+        ("facebook/esm2_t6_8M_UR50D", True, False, "cpu"),
+        ("facebook/esm2_t6_8M_UR50D", False, False, "cpu"),
+    ],
+)
 def test_initialization(embedder):
     assert isinstance(embedder.model, torch.nn.Module), "Model should be an instance of torch.nn.Module"
-    expected_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    expected_device = "cuda" if torch.cuda.is_available() else "cpu"
     assert str(embedder.device) == expected_device, f"Device should be set to '{expected_device}'"
 
 
-@pytest.mark.parametrize("model_name, half_precision, eval_mode", [
-    ('facebook/esm2_t6_8M_UR50D', True, True),
-    ('facebook/esm2_t6_8M_UR50D', False, True),
-    ('facebook/esm2_t6_8M_UR50D', True, False),
-    ('facebook/esm2_t6_8M_UR50D', False, False)
-])
+@pytest.mark.parametrize(
+    "model_name, half_precision, eval_mode",
+    [
+        ("facebook/esm2_t6_8M_UR50D", True, True),
+        ("facebook/esm2_t6_8M_UR50D", False, True),
+        ("facebook/esm2_t6_8M_UR50D", True, False),
+        ("facebook/esm2_t6_8M_UR50D", False, False),
+    ],
+)
 def test_embedder_initialization(model_name, half_precision, eval_mode):
-    embedder = Esm2Embedder(model_name=model_name, half_precision=half_precision, eval_mode=eval_mode, device='cuda')
+    embedder = Esm2Embedder(model_name=model_name, half_precision=half_precision, eval_mode=eval_mode, device="cuda")
 
     assert embedder.model is not None, "Model should be initialized"
     assert embedder.tokenizer is not None, "Tokenizer should be initialized"
     assert embedder.device is not None, "Device should be set"
-    assert embedder.device == torch.device('cuda'), "Device should be CUDA"
+    assert embedder.device == torch.device("cuda"), "Device should be CUDA"
 
     assert embedder.model.training == (not eval_mode), f"Model training mode should be {not eval_mode}"
     expected_dtype = torch.float16 if half_precision else torch.float32
     assert embedder.model.dtype == expected_dtype, f"Model dtype should be {expected_dtype}"
 
 
+def tiny_esm(tmp_path, lean, engine="torch"):
+    from transformers import EsmConfig, EsmForMaskedLM, EsmModel, EsmTokenizer
+
+    vocab = "<cls> <pad> <eos> <unk> L A G V S E R T I D P K Q N F Y M H W C X B U Z O . - <null_1> <mask>".split()
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(vocab))
+    config = EsmConfig(
+        vocab_size=len(vocab),
+        hidden_size=8,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=16,
+        max_position_embeddings=64,
+        position_embedding_type="rotary",
+        pad_token_id=1,
+        mask_token_id=32,
+    )
+    torch.manual_seed(0)
+    model = EsmModel(config, add_pooling_layer=False) if lean else EsmForMaskedLM(config)
+    with patch("transformers.EsmTokenizer.from_pretrained", return_value=EsmTokenizer(str(vocab_file))), patch(
+        f"transformers.{type(model).__name__}.from_pretrained", return_value=model
+    ), patch.object(Esm2Embedder, "save_model_locally"):
+        return Esm2Embedder(local_model_dir=str(tmp_path), half_precision=False, lean=lean, engine=engine)
+
+
+@pytest.mark.parametrize("lean", [True, False])
+def test_embed_pooled_averages_the_residues(tmp_path, lean):
+    embedder = tiny_esm(tmp_path, lean)
+    sequences = ["MKTAYIAK", "MK"]
+
+    pooled = embedder.embed_pooled(sequences)
+
+    hidden_states = embedder.embed(sequences).float()
+    assert pooled.shape == (2, 8)
+    # BOS, EOS and padding are left out of the mean
+    for i, sequence in enumerate(sequences):
+        expected = hidden_states[i, 1 : len(sequence) + 1].mean(dim=0).numpy()
+        assert pooled[i] == pytest.approx(expected, abs=1e-5)
+
+
+@pytest.mark.parametrize("engine, lean", [("int8", True), ("onnx", True), ("onnx", False)])
+def test_cpu_engines_match_the_torch_engine(tmp_path, engine, lean):
+    if engine == "onnx":
+        pytest.importorskip("onnxruntime")
+    sequences = ["MKTAYIAKQRQISFVKSHFSRQ", "MK", "MKTAYIAK"]
+    expected = tiny_esm(tmp_path, lean).embed_pooled(sequences)
+
+    embedder = tiny_esm(tmp_path, lean, engine)
+    pooled = embedder.embed_pooled(sequences)
+
+    assert embedder.device == torch.device("cpu")
+    cosine = (pooled * expected).sum(axis=1) / (np.linalg.norm(pooled, axis=1) * np.linalg.norm(expected, axis=1))
+    assert cosine.min() > 0.99
+
+
+def test_mapped_weights_are_read_from_the_checkpoint_file(tmp_path):
+    from safetensors.torch import save_file
+
+    sequences = ["MKTAYIAKQRQISFVKSHFSRQ", "MK"]
+    embedder = tiny_esm(tmp_path, lean=True)
+    expected = embedder.embed_pooled(sequences)
+    # Saved under the prefix of the masked LM checkpoint, as the ESM-2 checkpoints are
+    checkpoint = tmp_path / "model.safetensors"
+    save_file({f"esm.{name}": tensor.contiguous() for name, tensor in embedder.model.state_dict().items()}, checkpoint)
+    with torch.no_grad():
+        for parameter in embedder.model.parameters():
+            parameter.zero_()
+
+    embedder.map_weights(embedder.model, str(tmp_path))
+
+    assert embedder.embed_pooled(sequences) == pytest.approx(expected, abs=1e-6)
+    with open("/proc/self/maps") as f:
+        assert str(checkpoint) in f.read()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from src.dependencies.embedding_cache import EmbeddingCache
+
+
+def test_keys_ignore_whitespace_and_case_but_not_the_model():
+    cache = EmbeddingCache(max_bytes=1024, model_name="facebook/esm2_t6_8M_UR50D")
+    other_model = EmbeddingCache(max_bytes=1024, model_name="facebook/esm2_t33_650M_UR50D")
+
+    assert cache.key("MKT AYI\n") == cache.key("mktayi")
+    assert cache.key("MKTAYI") != cache.key("MKTAYV")
+    assert cache.key("MKTAYI") != other_model.key("MKTAYI")
+
+
+def test_get_counts_hits_and_misses():
+    cache = EmbeddingCache(max_bytes=1024, model_name="esm2")
+    key = cache.key("MKTAYI")
+    assert cache.get(key) is None
+
+    cache.put(key, np.ones(4, dtype=np.float32))
+    assert np.array_equal(cache.get(key), np.ones(4))
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, 16)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_put_copies_rows_out_of_the_batch():
+    cache = EmbeddingCache(max_bytes=1024, model_name="esm2")
+    batch = np.zeros((8, 4), dtype=np.float32)
+    cache.put(cache.key("AA"), batch[0])
+    batch[0] = 1
+
+    cached = cache.get(cache.key("AA"))
+    assert cached.base is None and not cached.any()
+
+
+def test_eviction_is_by_bytes_in_lru_order():
+    # Room for 40 bytes: a 16-byte and a 24-byte embedding fit, anything more evicts the least recently used
+    cache = EmbeddingCache(max_bytes=40, model_name="esm2")
+    cache.put(cache.key("AA"), np.zeros(4, dtype=np.float32))
+    cache.put(cache.key("CC"), np.zeros(6, dtype=np.float32))
+    cache.get(cache.key("AA"))
+
+    cache.put(cache.key("DD"), np.zeros(2, dtype=np.float32))
+
+    assert cache.get(cache.key("CC")) is None
+    assert cache.get(cache.key("AA")) is not None and cache.get(cache.key("DD")) is not None
+    assert cache.stats()["bytes"] == 24 and cache.stats()["evictions"] == 1
+
+
+def test_embeddings_larger_than_the_budget_are_not_cached():
+    cache = EmbeddingCache(max_bytes=8, model_name="esm2")
+    cache.put(cache.key("AA"), np.zeros(4, dtype=np.float32))
+    assert cache.stats()["entries"] == 0
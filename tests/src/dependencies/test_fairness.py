@@ -0,0 +1,75 @@
+import pytest
+
+from src.dependencies.fairness import Caller, FairQueue, QuotaExceededError, UserQuotas
+
+
+def drain(queue: FairQueue) -> list:
+    items = []
+    while queue:
+        items.append(queue.pop())
+    return items
+
+
+def test_an_idle_flow_goes_ahead_of_a_backlog():
+    queue = FairQueue()
+    for i in range(100):
+        queue.push(f"batch{i}", "user:batch", cost=5000)
+    assert [queue.pop() for _ in range(3)] == ["batch0", "batch1", "batch2"]
+    queue.push("small0", "user:small", cost=300)
+    queue.push("small1", "user:small", cost=300)
+
+    assert [queue.pop() for _ in range(3)] == ["small0", "small1", "batch3"]
+
+
+def test_backlogged_flows_share_in_proportion_to_their_weights():
+    queue = FairQueue()
+    for i in range(40):
+        queue.push(("user", i), "user:a", cost=100)
+        queue.push(("admin", i), "user:admin", cost=100, weight=3)
+
+    first = drain(queue)[:20]
+
+    assert sum(flow == "admin" for flow, _ in first) == 15
+    # Each flow keeps its order
+    assert [i for flow, i in first if flow == "user"] == list(range(5))
+
+
+def test_retain_drops_items():
+    queue = FairQueue()
+    for i in range(6):
+        queue.push(i, f"flow{i % 2}", cost=1)
+    queue.retain(lambda item: item % 3)
+
+    assert sorted(drain(queue)) == [1, 2, 4, 5]
+
+
+def test_quotas_reject_a_caller_whose_bucket_is_used_up():
+    quotas = UserQuotas(residues_per_second=100, burst_residues=1000, hit_cost=2)
+    jdoe = Caller("user:jdoe")
+    quotas.charge(jdoe, residues=600, hits=100)
+
+    with pytest.raises(QuotaExceededError) as e:
+        quotas.charge(jdoe, residues=300, hits=0)
+    # 200 residues left, 100 more refill in about a second
+    assert e.value.retry_after == 1
+    # Other callers have their own bucket
+    quotas.charge(Caller("user:other"), residues=1000, hits=0)
+    assert quotas.stats()["rejected_requests"] == 1
+
+
+def test_a_request_larger_than_the_burst_is_admitted_from_a_full_bucket_and_leaves_a_debt():
+    quotas = UserQuotas(residues_per_second=1000, burst_residues=1000)
+    admin = Caller("user:admin", weight=4)
+    quotas.charge(admin, residues=9000, hits=0)
+
+    with pytest.raises(QuotaExceededError) as e:
+        quotas.charge(admin, residues=10, hits=0)
+    # The 8000 residue debt refills at 4 times the rate
+    assert e.value.retry_after == 3
+
+
+def test_quotas_are_disabled_without_a_rate():
+    quotas = UserQuotas()
+    for _ in range(10):
+        quotas.charge(Caller(), residues=2500000, hits=500000)
+    assert quotas.stats()["callers"] == 0
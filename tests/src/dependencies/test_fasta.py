@@ -0,0 +1,17 @@
+import gzip
+
+from src.dependencies.fasta import iter_chunks, parse_fasta, read_fasta
+
+
+def test_parse_fasta_joins_wrapped_sequences():
+    lines = ["junk before the first record\n", ">sp|P1|A  some description\n", "MKT AY\n", "IAK\n", "\n"]
+    lines += [">P2\n", ">P3\n", "QR"]
+    assert list(parse_fasta(lines)) == [("sp|P1|A  some description", "MKTAYIAK"), ("P2", ""), ("P3", "QR")]
+
+
+def test_read_fasta_streams_gzip(tmp_path):
+    path = tmp_path / "db.fasta.gz"
+    with gzip.open(path, "wt") as f:
+        f.write(">P1\nMKT\n>P2\nAY\n")
+    assert list(read_fasta(path)) == [("P1", "MKT"), ("P2", "AY")]
+    assert list(iter_chunks(read_fasta(path), 1)) == [(["P1"], ["MKT"]), (["P2"], ["AY"])]
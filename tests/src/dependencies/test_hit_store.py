@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from src.dependencies.hit_store import HitStore
+
+
+def chunks(tags, embeddings, chunk_size):
+    for start in range(0, len(tags), chunk_size):
+        yield tags[start : start + chunk_size], embeddings[start : start + chunk_size]
+
+
+@pytest.fixture
+def rows():
+    tags = ["Q5HAN0", "Q5FFY2", "", "Q5AYI7", "sp|P69905|HBA_HUMAN", "Ünïcode"]
+    embeddings = np.arange(len(tags) * 3, dtype=np.float16).reshape(len(tags), 3)
+    return tags, embeddings
+
+
+@pytest.fixture
+def store(tmp_path, rows):
+    tags, embeddings = rows
+    return HitStore.write(tmp_path / "store", chunks(tags, embeddings, 4), num_rows=len(tags), dim=3, dtype=np.float16)
+
+
+def test_write_round_trips_through_mmap(store, rows):
+    tags, embeddings = rows
+    assert len(store) == len(tags)
+    assert isinstance(store.embeddings, np.memmap)
+    assert store.embeddings.dtype == np.float16
+    assert store.get_tags(np.arange(len(tags))) == tags
+    assert np.array_equal(store.get_embeddings(np.arange(len(tags))), embeddings)
+    assert store.manifest["num_rows"] == len(tags) and store.manifest["dtype"] == "float16"
+
+
+def test_gather_keeps_request_order_and_repeats(store, rows):
+    tags, embeddings = rows
+    indices = np.array([5, 0, 2, 5, 3])
+    assert store.get_tags(indices) == [tags[i] for i in indices]
+    assert np.array_equal(store.get_embeddings(indices), embeddings[indices])
+
+
+def test_gather_of_nothing(store):
+    assert store.get_tags(np.array([], dtype=np.int64)) == []
+    assert store.get_embeddings(np.array([], dtype=np.int64)).shape == (0, 3)
+
+
+def test_reopening_an_existing_store(tmp_path, store, rows):
+    assert HitStore.open_or_build(tmp_path / "missing_dataset", tmp_path / "store").get_tags([1]) == [rows[0][1]]
+
+
+def test_write_rejects_a_short_row_count(tmp_path, rows):
+    tags, embeddings = rows
+    with pytest.raises(ValueError):
+        HitStore.write(tmp_path / "store", chunks(tags, embeddings, 4), num_rows=len(tags) + 1, dim=3)
+    assert not (tmp_path / "store").exists()
@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from src.build_index import write_flat_index
+from src.dependencies.hit_store import HitStore
+from src.dependencies.index_engines import FaissIndex, SearchParams
+
+faiss = pytest.importorskip("faiss")
+
+
+@pytest.fixture
+def store(tmp_path):
+    rng = np.random.default_rng(0)
+    # Clustered unit vectors, like protein families
+    centers = rng.standard_normal((20, 32))
+    embeddings = (centers[rng.integers(0, 20, 2000)] + 0.3 * rng.standard_normal((2000, 32))).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    tags = [f"P{i:05d}" for i in range(len(embeddings))]
+    return HitStore.write(tmp_path / "store", [(tags, embeddings)], num_rows=len(tags), dim=32)
+
+
+def recall(store, index, queries, top_k, params):
+    exact = np.argsort(-(queries @ np.asarray(store.embeddings).T), axis=1)[:, :top_k]
+    _, indices = index.search(queries, top_k, params)
+    return np.mean([len(set(found) & set(expected)) / top_k for found, expected in zip(indices, exact)])
+
+
+@pytest.mark.parametrize(
+    "engine, build_settings, min_recall",
+    [("ivf", {}, 0.95), ("ivfpq", {"pq_m": 16, "pq_nbits": 6}, 0.5), ("hnsw", {"hnsw_m": 16}, 0.95)],
+)
+def test_approximate_engines_find_the_exact_neighbours(tmp_path, store, engine, build_settings, min_recall):
+    index = FaissIndex.open_or_build(store, tmp_path / "indexes", engine, **build_settings)
+    queries = np.asarray(store.embeddings[:50])
+
+    params = index.search_params(nprobe=32, ef_search=128)
+    assert recall(store, index, queries, 10, params) >= min_recall
+    scores, indices = index.search(queries[:3], 1, params)
+    # The database rows find themselves with cosine similarity 1 (up to quantization)
+    if engine != "ivfpq":
+        assert [int(i[0]) for i in indices] == [0, 1, 2]
+        assert np.allclose([s[0] for s in scores], 1, atol=1e-4)
+
+    # A second open reads the index written by the first
+    reopened = FaissIndex.open_or_build(store, tmp_path / "indexes", engine, **build_settings)
+    assert reopened.index.ntotal == len(store)
+    assert len(list((tmp_path / "indexes").glob("*.faiss"))) == 1
+
+
+def test_search_knobs_are_clamped(tmp_path, store):
+    ivf = FaissIndex.open_or_build(store, tmp_path, "ivf", default_nprobe=4, max_nprobe=16)
+    hnsw = FaissIndex.open_or_build(store, tmp_path, "hnsw", default_ef_search=32, max_ef_search=64)
+
+    assert ivf.search_params() == SearchParams(nprobe=4)
+    assert ivf.search_params(nprobe=1000, ef_search=10) == SearchParams(nprobe=16)
+    assert hnsw.search_params(nprobe=8) == SearchParams(ef_search=32)
+    assert hnsw.search_params(ef_search=1000) == SearchParams(ef_search=64)
+
+    # More probes only ever find more of the exact neighbours
+    queries = np.asarray(store.embeddings[:50])
+    assert recall(store, ivf, queries, 10, SearchParams(nprobe=1)) <= recall(store, ivf, queries, 10, SearchParams(16))
+
+
+@pytest.mark.parametrize("engine, knob", [("ivf", "nprobe"), ("hnsw", "ef_search")])
+def test_concurrent_searches_with_different_knobs_match_serial_ones(tmp_path, store, engine, knob):
+    index = FaissIndex.open_or_build(store, tmp_path, engine)
+    queries = np.asarray(store.embeddings[:200])
+    params = [SearchParams(**{knob: value}) for value in (1, 64) * 8]
+
+    serial = [index.search(queries, 10, p)[1] for p in params]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        concurrent = list(executor.map(lambda p: index.search(queries, 10, p)[1], params))
+
+    assert all(np.array_equal(a, b) for a, b in zip(serial, concurrent))
+
+
+@pytest.mark.parametrize("engine", ["flat", "ivf", "hnsw"])
+def test_mapped_indexes_search_like_the_indexes_read_into_memory(tmp_path, store, engine):
+    if engine == "flat":
+        flat = faiss.IndexFlatIP(32)
+        flat.add(np.asarray(store.embeddings))
+        faiss.write_index(flat, str(tmp_path / "flat.index"))
+        mapped = FaissIndex.open_flat(tmp_path / "flat.index", mmap=True)
+        read = FaissIndex.open_flat(tmp_path / "flat.index")
+    else:
+        # The freshly built index is reopened mapped
+        mapped = FaissIndex.open_or_build(store, tmp_path, engine, mmap=True)
+        read = FaissIndex.open_or_build(store, tmp_path, engine)
+    queries = np.asarray(store.embeddings[:20])
+
+    mapped_scores, mapped_indices = mapped.search(queries, 5, mapped.search_params())
+    scores, indices = read.search(queries, 5, read.search_params())
+
+    assert np.array_equal(mapped_indices, indices) and np.allclose(mapped_scores, scores)
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_flat_and_approximate_indexes_of_a_built_database_score_alike(tmp_path, store, mmap):
+    write_flat_index(store, tmp_path / "db.index")
+    flat = FaissIndex.open_flat(tmp_path / "db.index", mmap=mmap)
+    ivf = FaissIndex.open_or_build(store, tmp_path / "indexes", "ivf", nlist=4)
+    # Pooled query embeddings are not unit vectors
+    queries = 3 * np.asarray(store.embeddings[:20]) + 0.1
+
+    flat_scores, flat_indices = flat.search(queries, 5)
+    ivf_scores, ivf_indices = ivf.search(queries, 5, SearchParams(nprobe=4))
+
+    assert flat.manifest["normalize_queries"]
+    assert np.array_equal(flat_indices, ivf_indices) and np.allclose(flat_scores, ivf_scores, atol=1e-5)
+    assert np.all(np.asarray(flat_scores) <= 1 + 1e-5)
+    assert not FaissIndex.open_flat(tmp_path / "db.index", normalize_queries=False).manifest["normalize_queries"]
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+
+import pytest
+
+from src.dependencies.inference_executor import InferenceExecutor, InferenceQueueFullError
+
+
+def test_run_executes_off_the_event_loop_thread():
+    executor = InferenceExecutor(max_workers=1)
+
+    async def run():
+        return await executor.run(threading.current_thread)
+
+    assert asyncio.run(run()) is not threading.main_thread()
+
+
+def test_admit_rejects_requests_beyond_capacity():
+    executor = InferenceExecutor(max_queued_queries=10, retry_after_seconds=7)
+    with executor.admit(6):
+        with executor.admit(4):
+            assert executor.stats()["queued_queries"] == 10
+            with pytest.raises(InferenceQueueFullError) as e:
+                with executor.admit(1):
+                    pass
+            assert e.value.retry_after == 7
+    assert executor.stats()["queued_queries"] == 0
+    assert executor.stats()["rejected_requests"] == 1
+
+
+def test_admit_lets_an_oversized_request_through_an_empty_queue():
+    executor = InferenceExecutor(max_queued_queries=10)
+    with executor.admit(50):
+        with pytest.raises(InferenceQueueFullError):
+            with executor.admit(1):
+                pass
+
+
+def test_admit_releases_capacity_when_the_request_fails():
+    executor = InferenceExecutor(max_queued_queries=10)
+    with pytest.raises(ValueError):
+        with executor.admit(10):
+            raise ValueError()
+    with executor.admit(10):
+        pass
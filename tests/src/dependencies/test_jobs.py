@@ -0,0 +1,112 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from src.dependencies.jobs import CANCELLED, DONE, FAILED, QUEUED, RUNNING, JobManager
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    path = tmp_path / "queries.fasta"
+    path.write_text("".join(f">Q{i}\n{'M' * (i + 2)}\n" for i in range(5)))
+    return path
+
+
+class FakeSearch:
+    """Writes one line per sequence holding its header and length, failing on the sequences of fail_on"""
+
+    def __init__(self, fail_on=()):
+        self.searched = []
+        self.fail_on = fail_on
+
+    async def __call__(self, parameters, headers, sequences):
+        self.searched.append(list(headers))
+        if set(headers) & set(self.fail_on):
+            raise RuntimeError("search failed")
+        return b"".join(
+            json.dumps({"QueryId": h, "length": len(s), "max_hits": parameters["max_hits"]}).encode() + b"\n"
+            for h, s in zip(headers, sequences)
+        )
+
+
+async def wait_for(job_manager, job_id, statuses=(DONE, FAILED)):
+    for _ in range(200):
+        job = job_manager.get(job_id)
+        if job is None or job.status in statuses:
+            return job
+        await asyncio.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+def read_results(job_manager, job):
+    lines = []
+    for chunk in range(job.chunks):
+        lines += gzip.decompress(job_manager.chunk_path(job.job_id, chunk).read_bytes()).splitlines()
+    return [json.loads(line) for line in lines]
+
+
+def test_job_results_are_written_chunk_by_chunk(tmp_path, fasta):
+    search = FakeSearch()
+    job_manager = JobManager(tmp_path / "jobs", search, chunk_size=2)
+
+    async def run():
+        job_id, _ = job_manager.create()
+        job = job_manager.submit(job_id, fasta, 5, {"max_hits": 3})
+        assert job.status == QUEUED
+        return await wait_for(job_manager, job_id)
+
+    job = asyncio.run(run())
+
+    assert job.status == DONE and job.processed == 5 and job.chunks == 3
+    assert job.status_dict()["progress"] == 1.0 and "input_path" not in job.status_dict()
+    assert search.searched == [["Q0", "Q1"], ["Q2", "Q3"], ["Q4"]]
+    assert [(line["QueryId"], line["length"]) for line in read_results(job_manager, job)] == [
+        (f"Q{i}", i + 2) for i in range(5)
+    ]
+
+
+def test_interrupted_jobs_resume_after_their_last_chunk(tmp_path, fasta):
+    first = JobManager(tmp_path / "jobs", FakeSearch(fail_on=["Q2"]), chunk_size=2)
+
+    async def crash():
+        job_id, _ = first.create()
+        first.submit(job_id, fasta, 5, {"max_hits": 1})
+        return await wait_for(first, job_id)
+
+    job = asyncio.run(crash())
+    assert job.status == FAILED and job.error == "search failed" and job.chunks == 1
+    # Stand in for a server killed while the job ran
+    job.status = RUNNING
+    first._write(job)
+
+    search = FakeSearch()
+    restarted = JobManager(tmp_path / "jobs", search, chunk_size=2)
+
+    async def resume():
+        await restarted.start()
+        return await wait_for(restarted, job.job_id)
+
+    job = asyncio.run(resume())
+
+    assert search.searched == [["Q2", "Q3"], ["Q4"]]
+    assert job.status == DONE and job.processed == 5
+    assert [line["QueryId"] for line in read_results(restarted, job)] == [f"Q{i}" for i in range(5)]
+
+
+def test_cancelled_jobs_are_removed(tmp_path, fasta):
+    job_manager = JobManager(tmp_path / "jobs", FakeSearch(), chunk_size=2)
+
+    async def run():
+        job_id, job_dir = job_manager.create()
+        job_manager.submit(job_id, fasta, 5, {"max_hits": 1})
+        assert job_manager.cancel(job_id)
+        await wait_for(job_manager, job_id)
+        return job_id, job_dir
+
+    job_id, job_dir = asyncio.run(run())
+
+    assert job_manager.get(job_id) is None and not job_dir.exists()
+    assert not job_manager.cancel(job_id) and job_manager.get("../../etc") is None
+    assert CANCELLED not in [job.status for job in job_manager.list()]
@@ -0,0 +1,39 @@
+import pytest
+
+from src.dependencies.logs import SimilarityLog, tail_lines
+
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_tail_lines_matches_reading_the_whole_file(tmp_path, trailing_newline):
+    path = tmp_path / "nohup.out"
+    lines = [f"INFO:root:line {i} " + "x" * (i % 7) for i in range(200)]
+    path.write_text("\n".join(lines) + ("\n" if trailing_newline else ""))
+
+    for n in (0, 1, 5, 199, 200, 500):
+        # Blocks smaller than a line exercise lines split across blocks
+        assert tail_lines(str(path), n, block_size=7) == (lines[-n:] if n else [])
+    assert tail_lines(str(path), 3) == lines[-3:]
+
+
+def test_tail_lines_of_an_empty_file(tmp_path):
+    path = tmp_path / "nohup.out"
+    path.write_bytes(b"")
+    assert tail_lines(str(path), 10) == []
+
+
+def summary(i):
+    return {"num_sequences": i, "total_sequence_length": 10 * i, "response_size": 3 * i, "execution_time": 0.5}
+
+
+def test_similarity_log_keeps_the_latest_entries():
+    log = SimilarityLog(max_entries=3)
+    for i in range(5):
+        log.record(summary(i))
+
+    entries = log.last(10)
+    assert [entry["sequences"] for entry in entries] == [2, 3, 4]
+    assert (
+        entries[-1]["length"] == 40 and entries[-1]["hits"] == 12 and entries[-1]["type"] == "similarity_process_info"
+    )
+    assert [entry["sequences"] for entry in log.last(2)] == [3, 4]
+    assert log.last(0) == []
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from src.dependencies import memory_budget
+from src.dependencies.memory_budget import BudgetedEmbedder, is_out_of_memory, padded_tokens
+
+
+class FakeModel:
+    """Embeds a sequence as [len(sequence)] * 4, running out of memory on passes of more than max_tokens"""
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens
+        self.passes = []
+
+    def embed_pooled(self, sequences):
+        if self.max_tokens is not None and padded_tokens(sequences) > self.max_tokens:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        self.passes.append([len(sequence) for sequence in sequences])
+        return np.array([[len(sequence)] * 4 for sequence in sequences], dtype=np.float32)
+
+
+def test_passes_are_bounded_by_padded_tokens_and_keep_the_order():
+    model = FakeModel()
+    embedder = BudgetedEmbedder(model.embed_pooled, token_budget=100)
+    sequences = ["A" * n for n in (48, 8, 3, 8, 30, 3)]
+
+    embeddings = embedder(sequences)
+
+    # Shortest first: 4 x 10 tokens, then 2 x 50
+    assert model.passes == [[3, 3, 8, 8], [30, 48]]
+    assert embeddings[:, 0].tolist() == [48, 8, 3, 8, 30, 3]
+
+
+def test_a_pass_out_of_memory_is_split_and_lowers_the_budget():
+    model = FakeModel(max_tokens=50)
+    embedder = BudgetedEmbedder(model.embed_pooled, token_budget=1000)
+    sequences = ["A" * 18] * 8
+
+    embeddings = embedder(sequences)
+
+    # 8 x 20 tokens fail, then 4 x 20, then passes of 2 x 20 succeed
+    assert model.passes == [[18, 18]] * 4
+    assert embeddings.shape == (8, 4)
+    assert embedder.token_budget == 40
+    assert embedder.stats()["failed_tokens"] == 80
+
+
+def test_a_single_sequence_out_of_memory_fails():
+    embedder = BudgetedEmbedder(FakeModel(max_tokens=10).embed_pooled, token_budget=1000)
+    with pytest.raises(RuntimeError, match="out of memory"):
+        embedder(["A" * 20])
+
+
+def test_other_errors_are_not_retried():
+    def embed_pooled(sequences):
+        raise ValueError("invalid sequence")
+
+    assert not is_out_of_memory(ValueError("invalid sequence"))
+    with pytest.raises(ValueError):
+        BudgetedEmbedder(embed_pooled)(["AA", "CC"])
+
+
+def test_the_budget_grows_back_below_the_pass_that_failed():
+    model = FakeModel(max_tokens=70)
+    embedder = BudgetedEmbedder(model.embed_pooled, token_budget=200, max_token_budget=400, grow_after=2)
+    embedder(["A" * 18] * 8)
+    assert embedder.token_budget == 40
+
+    for _ in range(20):
+        embedder(["A" * 18] * 8)
+
+    assert embedder.token_budget == 79
+    assert all(len(lengths) <= 3 for lengths in model.passes)
+
+
+def test_passes_beyond_the_memory_limit_are_split_before_they_run(monkeypatch):
+    rss = {"current": 1000}
+    monkeypatch.setattr(memory_budget, "current_rss", lambda: rss["current"])
+    monkeypatch.setattr(memory_budget, "reset_peak_rss", lambda: True)
+    # Each pass peaks 10 bytes per token above the current RSS
+    monkeypatch.setattr(
+        memory_budget, "peak_rss", lambda: rss["current"] + 10 * len(model.passes[-1]) * (max(model.passes[-1]) + 2)
+    )
+    model = FakeModel()
+    embedder = BudgetedEmbedder(model.embed_pooled, token_budget=1000, memory_limit_bytes=2000)
+
+    embedder(["A" * 8] * 4)
+    assert embedder.bytes_per_token == 10
+    rss["current"] = 1500
+    embedder(["A" * 8] * 8)
+
+    # 500 bytes left hold 50 tokens, the pass of 8 x 10 tokens is split in halves
+    assert model.passes == [[8] * 4, [8] * 4, [8] * 4]
@@ -0,0 +1,68 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+# Imported as the application imports it: a second copy of the module would register every metric twice
+from dependencies.metrics import EMBEDDING_CACHE_LOOKUPS, STAGE_SECONDS, render_metrics
+from src.dependencies.inference_executor import InferenceExecutor
+
+SRC_DIR = Path(__file__).parents[3] / "llm_homology_api" / "src"
+
+# A uvicorn worker recording metrics, and exiting cleanly or not
+WORKER = """
+import sys
+from dependencies.metrics import QUEUED_QUERIES, QUERIES, STAGE_SECONDS, mark_process_dead
+
+QUERIES.inc(3)
+STAGE_SECONDS.labels(stage="embed").observe(0.2)
+QUEUED_QUERIES.set(int(sys.argv[1]))
+if sys.argv[2] == "exit":
+    mark_process_dead()
+"""
+
+
+def samples(text: bytes) -> dict:
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(text.decode())
+        for sample in family.samples
+    }
+
+
+def test_metrics_of_this_process_are_rendered(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    before = REGISTRY.get_sample_value("llm_homology_stage_seconds_count", {"stage": "search"}) or 0
+    STAGE_SECONDS.labels(stage="search").observe(0.05)
+    EMBEDDING_CACHE_LOOKUPS.labels(result="hit").inc(2)
+    executor = InferenceExecutor()
+
+    with executor.admit(7):
+        rendered = samples(render_metrics())
+
+    assert rendered[("llm_homology_stage_seconds_count", (("stage", "search"),))] == before + 1
+    assert rendered[("llm_homology_stage_seconds_bucket", (("le", "0.05"), ("stage", "search")))] >= 1
+    assert rendered[("llm_homology_embedding_cache_lookups_total", (("result", "hit"),))] >= 2
+    assert rendered[("llm_homology_inference_queued_queries", ())] == 7
+    assert REGISTRY.get_sample_value("llm_homology_inference_queued_queries") == 0
+    executor.shutdown()
+
+
+def test_multiprocess_mode_aggregates_every_worker(tmp_path, monkeypatch):
+    for queued, ending in ((5, "exit"), (2, "crash"), (4, "crash")):
+        subprocess.run(
+            [sys.executable, "-c", WORKER, str(queued), ending],
+            env={"PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "PYTHONPATH": str(SRC_DIR)},
+            check=True,
+        )
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    rendered = samples(render_metrics())
+
+    # Counters and histograms add up over every worker that ever ran
+    assert rendered[("llm_homology_queries_total", ())] == 9
+    assert rendered[("llm_homology_stage_seconds_count", (("stage", "embed"),))] == 3
+    # Live gauges only over the workers that did not exit
+    assert rendered[("llm_homology_inference_queued_queries", ())] == 6
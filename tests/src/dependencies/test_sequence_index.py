@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from src.dependencies.hit_store import HitStore
+from src.dependencies.sequence_index import SequenceIndex, sequence_digests
+
+SEQUENCES = ["MKTAYIAK", "GSHMLE", "MKTAYIAK", "A" * 40, "PEPTIDE"]
+MODEL = "facebook/esm2_t6_8M_UR50D"
+
+
+@pytest.fixture
+def database(tmp_path):
+    rng = np.random.default_rng(0)
+    pooled = rng.standard_normal((len(SEQUENCES), 8)).astype(np.float32)
+    norms = np.linalg.norm(pooled, axis=1)
+    hit_store = HitStore.write(
+        tmp_path / "db.hitstore",
+        [([f"P{i}" for i in range(len(SEQUENCES))], pooled / norms[:, None])],
+        num_rows=len(SEQUENCES),
+        dim=8,
+        dtype="float16",
+    )
+    SequenceIndex.write(
+        tmp_path / "db.sequences",
+        [(sequence_digests(SEQUENCES[:2]), norms[:2]), (sequence_digests(SEQUENCES[2:]), norms[2:])],
+        num_rows=len(SEQUENCES),
+        embedder=f"{MODEL} (torch)",
+        window_size=32,
+        window_overlap=8,
+        normalized=True,
+    )
+    return hit_store, pooled
+
+
+def test_lookup_finds_the_first_row_of_each_database_sequence(tmp_path, database):
+    hit_store, _ = database
+    sequence_index = SequenceIndex(tmp_path / "db.sequences", hit_store)
+
+    rows = sequence_index.lookup(["PEPTIDE", "MKTAYIAK", "NOTINDB", "GSHMLE", ""])
+
+    assert rows.tolist() == [4, 0, -1, 1, -1]
+    assert SequenceIndex(tmp_path / "db.sequences", hit_store, max_length=10).lookup(["A" * 40]).tolist() == [-1]
+
+
+def test_stored_embeddings_are_restored_to_their_pooled_scale(tmp_path, database):
+    hit_store, pooled = database
+    sequence_index = SequenceIndex(tmp_path / "db.sequences", hit_store)
+
+    embeddings = sequence_index.embeddings(["GSHMLE", "NOTINDB", "PEPTIDE"])
+
+    assert embeddings[1] is None
+    # Up to the float16 precision of the hit store
+    assert np.allclose(embeddings[0], pooled[1], rtol=1e-2, atol=1e-2)
+    assert np.allclose(embeddings[2], pooled[4], rtol=1e-2, atol=1e-2)
+
+
+def test_open_checks_the_model_and_windows(tmp_path, database):
+    hit_store, _ = database
+    sequence_dir = tmp_path / "db.sequences"
+
+    assert SequenceIndex.open(tmp_path / "missing", hit_store, MODEL) is None
+    assert SequenceIndex.open(sequence_dir, hit_store, "facebook/esm2_t33_650M_UR50D") is None
+    assert SequenceIndex.open(sequence_dir, hit_store, MODEL, 32, 8).max_length is None
+    # Sequences longer than a window of either side are embedded differently
+    assert SequenceIndex.open(sequence_dir, hit_store, MODEL, 1022, 256).max_length == 32
+    assert SequenceIndex.open(sequence_dir, hit_store, MODEL, 0, 0).max_length == 32
@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+from src.dependencies.hit_store import HitStore
+from src.dependencies.index_engines import SearchParams
+from src.dependencies.shards import ShardedHitStore, ShardedIndex, merge_top_k
+
+
+@pytest.fixture
+def database():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((50, 16)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return [f"P{i:03d}" for i in range(len(embeddings))], embeddings
+
+
+def write_shards(tmp_path, database, sizes):
+    """Write each shard the way build_index does and a manifest listing them"""
+    faiss = pytest.importorskip("faiss")
+    tags, embeddings = database
+    manifests = []
+    start = 0
+    for shard, size in enumerate(sizes):
+        output = tmp_path / f"shard{shard}"
+        rows = slice(start, start + size)
+        HitStore.write(f"{output}.hitstore", [(tags[rows], embeddings[rows])], num_rows=size, dim=16)
+        index = faiss.IndexFlatIP(16)
+        index.add(embeddings[rows])
+        faiss.write_index(index, f"{output}.index")
+        build = {
+            "dataset": str(output),
+            "flat_index": f"{output}.index",
+            "hit_store": f"{output}.hitstore",
+            "index_dir": f"{output}.indexes",
+        }
+        with open(f"{output}.manifest.json", "w") as f:
+            json.dump(build, f)
+        manifests.append(f"shard{shard}.manifest.json")
+        start += size
+    with open(tmp_path / "shards.json", "w") as f:
+        json.dump({"shards": manifests}, f)
+    return tmp_path / "shards.json"
+
+
+def test_merge_top_k_offsets_rows_and_drops_padding():
+    first = (np.array([[0.9, 0.5, -3.4e38]]), np.array([[2, 0, -1]]))
+    second = (np.array([[0.7, 0.6, 0.1]]), np.array([[1, 0, 2]]))
+
+    scores, indices = merge_top_k([first, second], offsets=[0, 3], top_k=4)
+
+    assert indices[0].tolist() == [2, 4, 3, 0]
+    assert np.allclose(scores[0], [0.9, 0.7, 0.6, 0.5])
+    # Fewer hits than top_k in the whole database are padded like a single index pads them
+    _, indices = merge_top_k([first], offsets=[0], top_k=3)
+    assert indices[0].tolist() == [2, 0, -1]
+
+
+def test_sharded_hit_store_looks_up_database_rows(tmp_path, database):
+    tags, embeddings = database
+    stores = [
+        HitStore.write(tmp_path / name, [(tags[rows], embeddings[rows])], num_rows=len(tags[rows]), dim=16)
+        for name, rows in [("a", slice(0, 20)), ("b", slice(20, 35)), ("c", slice(35, 50))]
+    ]
+    hit_store = ShardedHitStore(stores)
+    rows = np.array([49, 0, 20, 19, 35, 20])
+
+    assert len(hit_store) == 50
+    assert hit_store.get_tags(rows) == [tags[row] for row in rows]
+    assert np.array_equal(hit_store.get_embeddings(rows), embeddings[rows])
+
+
+def test_sharded_index_finds_the_neighbours_of_the_whole_database(tmp_path, database):
+    _, embeddings = database
+    manifest = write_shards(tmp_path, database, [20, 15, 15])
+    queries = embeddings[[3, 25, 40]] + 0.01
+
+    index = ShardedIndex.open(manifest, "flat")
+    try:
+        scores, indices = index.search(queries, 5, index.search_params(nprobe=4))
+    finally:
+        index.close()
+
+    # The shards hold unit vectors, so the scores are cosine similarities
+    cosines = queries / np.linalg.norm(queries, axis=1, keepdims=True) @ embeddings.T
+    exact = np.argsort(-cosines, axis=1)[:, :5]
+    assert index.offsets == [0, 20, 35]
+    assert [i.tolist() for i in indices] == exact.tolist()
+    assert np.allclose(scores, np.take_along_axis(cosines, exact, axis=1), atol=1e-5)
+    assert len(ShardedHitStore.open(manifest)) == 50
+
+
+def test_sharded_index_clamps_the_knobs_of_its_engine():
+    class Shard:
+        num_rows = 10
+
+    index = ShardedIndex([Shard(), Shard()], "ivf", default_nprobe=4, max_nprobe=8)
+
+    assert index.offsets == [0, 10]
+    assert index.search_params() == SearchParams(nprobe=4)
+    assert index.search_params(nprobe=100, ef_search=5) == SearchParams(nprobe=8)
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from src.dependencies.startup import FAILED, LOADING, READY, WARMING_UP, StartupLoader
+
+
+def test_the_loader_is_ready_once_loaded_and_warmed_up():
+    events = []
+
+    async def warmup():
+        events.append(("warmup", loader.status))
+
+    async def resume_jobs():
+        events.append(("on_ready", loader.status))
+
+    loader = StartupLoader(lambda: events.append(("load", loader.status)), warmup=warmup, on_ready=[resume_jobs])
+
+    async def run():
+        await loader.start()
+        assert not loader.ready
+        await loader._task
+
+    asyncio.run(run())
+
+    assert events == [("load", LOADING), ("warmup", WARMING_UP), ("on_ready", READY)]
+    assert loader.ready and set(loader.status_dict()["seconds"]) == {LOADING, WARMING_UP}
+
+
+def test_a_failed_load_is_reported():
+    ready = []
+
+    def load():
+        raise FileNotFoundError("MODEL_DIR.index")
+
+    async def on_ready():
+        ready.append(True)
+
+    loader = StartupLoader(load, on_ready=[on_ready])
+
+    asyncio.run(loader.run())
+
+    assert loader.status_dict() == {"status": FAILED, "seconds": {}, "error": "MODEL_DIR.index"}
+    assert not loader.ready and not ready
+
+
+def test_a_failed_foreground_load_is_raised():
+    def load():
+        raise FileNotFoundError("MODEL_DIR.index")
+
+    loader = StartupLoader(load)
+
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(loader.run_in_foreground())
+    assert loader.status_dict()["status"] == FAILED
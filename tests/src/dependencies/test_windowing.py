@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from src.dependencies.windowing import embed_windowed, window_spans, window_weights
+
+
+def test_short_sequences_are_not_split():
+    assert window_spans(10, window_size=10, overlap=2) == [(0, 10)]
+    assert window_spans(5000, window_size=0, overlap=2) == [(0, 5000)]
+
+
+def test_windows_overlap_and_cover_the_sequence():
+    spans = window_spans(25, window_size=10, overlap=4)
+
+    assert spans == [(0, 10), (6, 16), (12, 22), (15, 25)]
+    assert all(end - start == 10 for start, end in spans)
+    assert window_weights(25, spans).sum() == pytest.approx(25)
+
+
+def per_residue_embed(sequences):
+    """Pools per-residue embeddings that depend only on the residue, so overlapping windows agree"""
+    return np.array([[np.mean([ord(c) for c in sequence]), 1.0] for sequence in sequences], dtype=np.float32)
+
+
+def test_windowed_embedding_matches_the_residue_mean():
+    long_sequence = "ACDEFGHIKLMNPQRSTVWY" * 3
+    calls = []
+
+    def embed(sequences):
+        calls.append(list(sequences))
+        return per_residue_embed(sequences)
+
+    embeddings = embed_windowed(embed, ["MKV", long_sequence], window_size=16, overlap=5)
+
+    # The windows of the long sequence are embedded in the same call as the short sequence
+    assert len(calls) == 1 and calls[0][0] == "MKV" and len(calls[0]) == 1 + len(window_spans(60, 16, 5))
+    assert max(len(sequence) for sequence in calls[0]) == 16
+    assert embeddings.shape == (2, 2)
+    assert embeddings[0].tolist() == per_residue_embed(["MKV"])[0].tolist()
+    assert embeddings[1] == pytest.approx(per_residue_embed([long_sequence])[0], rel=1e-3)
@@ -0,0 +1,149 @@
+import base64
+import json
+
+import numpy as np
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+import src.models.response_encoding as response_encoding
+from src.models.request_models import EmbeddingEncoding
+from src.models.response_encoding import (
+    encode_embeddings,
+    encode_ndjson_proteins,
+    encode_ndjson_summary,
+    encode_similarity_arrow,
+    encode_similarity_response,
+)
+from src.models.response_models import SimilarityResponse, QueryProtein, HitDetail
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(response_encoding, "orjson", None)
+    return encode_similarity_response
+
+
+def pydantic_response(summary, query_ids, query_embeddings, scores, tags, embeddings, discard_embeddings):
+    """The response as it was built before, one Pydantic model per hit (EmbeddingScale is only written for int8)"""
+    proteins = []
+    for i, query_id in enumerate(query_ids):
+        hits = [
+            HitDetail(HitID=tag, Score=score, Embedding=[] if discard_embeddings else list(map(float, embedding)))
+            for tag, score, embedding in zip(
+                tags[i], scores[i], [[]] * len(tags[i]) if embeddings[i] is None else embeddings[i]
+            )
+        ]
+        proteins.append(
+            QueryProtein(
+                QueryId=query_id,
+                Embedding=[] if discard_embeddings else list(map(float, query_embeddings[i])),
+                total_hits=len(hits),
+                Hits=hits,
+            )
+        )
+    return jsonable_encoder(SimilarityResponse(proteins=proteins, summary=summary), exclude_none=True)
+
+
+@pytest.mark.parametrize("discard_embeddings", [True, False])
+def test_matches_the_pydantic_response(encoder, discard_embeddings):
+    rng = np.random.default_rng(0)
+    summary = {"num_sequences": 3, "total_sequence_length": 42, "response_size": 3, "execution_time": 0.25}
+    query_ids = [">Q5HAN0", ">Q5HAN0", ">Q5AYI7"]
+    query_embeddings = rng.standard_normal((3, 8)).astype(np.float32)
+    scores = [np.float32([0.9999960660934448, 0.95]).tolist(), [], np.float32([0.91]).tolist()]
+    tags = [["Q5HAN0", "Q5FFY2"], [], ["Q5AYI7"]]
+    embeddings = [rng.standard_normal((n, 8)).astype(np.float16) for n in (2, 0, 1)]
+    if discard_embeddings:
+        embeddings = [None, None, None]
+
+    args = (summary, query_ids, query_embeddings, scores, tags, embeddings, discard_embeddings)
+    assert json.loads(encoder(*args)) == pydantic_response(*args)
+
+
+def test_ndjson_lines_match_the_response():
+    rng = np.random.default_rng(0)
+    summary = {"num_sequences": 2, "response_size": 1}
+    args = (
+        ["q1", "q2"],
+        rng.standard_normal((2, 4)).astype(np.float32),
+        [[0.9], []],
+        [["hit1"], []],
+        [rng.standard_normal((1, 4)).astype(np.float16), np.empty((0, 4), dtype=np.float16)],
+        False,
+    )
+
+    lines = (encode_ndjson_proteins(*args) + encode_ndjson_summary(summary)).decode().splitlines()
+
+    document = json.loads(encode_similarity_response(summary, *args))
+    assert [json.loads(line) for line in lines] == document["proteins"] + [{"summary": document["summary"]}]
+
+
+def decode(value, dtype):
+    return np.frombuffer(base64.b64decode(value), dtype=dtype)
+
+
+def test_binary_encodings_round_trip():
+    embeddings = np.array([[0.5, -1.25, 3.0], [0.0, 0.0, 0.0]], dtype=np.float32)
+
+    values, scales = encode_embeddings(embeddings, 2, EmbeddingEncoding.base64_f32)
+    assert scales is None
+    assert np.array_equal(decode(values[0], "<f4"), embeddings[0])
+
+    values, _ = encode_embeddings(embeddings, 2, EmbeddingEncoding.base64_f16)
+    assert np.array_equal(decode(values[0], "<f2"), embeddings[0])
+
+    values, scales = encode_embeddings(embeddings, 2, EmbeddingEncoding.int8)
+    assert decode(values[0], np.int8).tolist() == [21, -53, 127]
+    assert np.allclose(decode(values[0], np.int8) * scales[0], embeddings[0], atol=scales[0] / 2)
+    assert scales[1] == 1 and not decode(values[1], np.int8).any()
+
+
+def test_int8_response_carries_the_scales():
+    content = json.loads(
+        encode_similarity_response(
+            {"num_sequences": 1},
+            ["q1"],
+            np.array([[1.0, -2.0]], dtype=np.float32),
+            [[0.9]],
+            [["hit1"]],
+            [np.array([[4.0, 2.0]], dtype=np.float16)],
+            False,
+            EmbeddingEncoding.int8,
+        )
+    )
+    protein = content["proteins"][0]
+    assert protein["EmbeddingScale"] == pytest.approx(2 / 127)
+    assert protein["Hits"][0]["EmbeddingScale"] == pytest.approx(4 / 127)
+    assert decode(protein["Hits"][0]["Embedding"], np.int8).tolist() == [127, 64]
+
+
+@pytest.mark.parametrize("discard_embeddings", [True, False])
+def test_arrow_stream(discard_embeddings):
+    pa = pytest.importorskip("pyarrow")
+    query_embeddings = np.arange(4, dtype=np.float32).reshape(2, 2)
+    hit_embeddings = [np.array([[9, 9], [8, 8]], dtype=np.float16), np.empty((0, 2), dtype=np.float16)]
+
+    content = encode_similarity_arrow(
+        {"num_sequences": 2},
+        ["q1", "q2"],
+        query_embeddings,
+        [[0.9, 0.8], []],
+        [["hit1", "hit2"], []],
+        [None, None] if discard_embeddings else hit_embeddings,
+        discard_embeddings,
+    )
+
+    table = pa.ipc.open_stream(content).read_all()
+    assert json.loads(table.schema.metadata[b"summary"]) == {"num_sequences": 2.0}
+    assert table.column("QueryIndex").to_pylist() == [0, 1, 0, 0]
+    assert table.column("QueryId").to_pylist() == ["q1", "q2", "q1", "q1"]
+    assert table.column("HitID").to_pylist() == [None, None, "hit1", "hit2"]
+    assert table.column("Score").to_pylist() == [None, None, pytest.approx(0.9), pytest.approx(0.8)]
+    if discard_embeddings:
+        assert "Embedding" not in table.column_names
+    else:
+        matrix = table.column("Embedding").combine_chunks().flatten().to_numpy().reshape(-1, 2)
+        assert matrix.tolist() == [[0, 1], [2, 3], [9, 9], [8, 8]]
@@ -1,18 +1,37 @@
 # # test similarity route
 # # test fastapi route
+import asyncio
+import json
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 
+import numpy as np
 import pytest
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from fastapi.testclient import TestClient
 
 from src.config import get_settings
 from src.factory import (
     create_app,
 )  # Adjust the import path according to your project structure
-from src.routes.similarity import router as similarity_router, get_filtered_annotations
+from src.dependencies.batcher import MicroBatcher
+from src.dependencies.embedding_cache import EmbeddingCache
+from src.dependencies.fairness import Caller, QuotaExceededError, UserQuotas
+from src.dependencies.hit_store import HitStore
+from src.dependencies.inference_executor import InferenceExecutor, InferenceQueueFullError
+from src.dependencies.logs import SimilarityLog
+from src.models.request_models import SimilarityRequest
+from src.routes import similarity
+from src.routes.similarity import (
+    router as similarity_router,
+    get_caller,
+    get_filtered_annotations,
+    search_queries,
+    stream_similarity,
+)
 from src.routes.status import router as status_router
 
+
 #
 # @pytest.fixture(scope="module")
 # def before():
@@ -133,45 +152,169 @@ from src.routes.status import router as status_router
 #                 assert isinstance(e, float)
 #
 #
-# def test_get_filtered_annotations():
-#     # Mock inputs
-#     hit_indices = [1, 2, 3]
-#     hit_scores = [0.9, 0.95, 0.85]
-#     threshold = 0.9
-#
-#     # Expected outputs for both scenarios
-#     expected_filtered_scores = [0.9, 0.95]  # Only scores >= threshold
-#     expected_filtered_tags = ["Tag1", "Tag2"]  # Corresponding tags for hit indices [1, 2]
-#
-#     # Mock the SimilaritySearch instance's methods
-#     mock_ss = MagicMock()
-#     mock_ss.get_sequence_tags.side_effect = lambda indices: ["Tag0", "Tag1", "Tag2", "Tag3"][
-#         min(indices) : max(indices) + 1
-#     ]
-#     mock_ss.get_sequence_embeddings.side_effect = lambda indices: [[0.0, 0.1], [0.1, 0.2], [0.3, 0.4], [0.5, 0.6]][
-#         min(indices) : max(indices) + 1
-#     ]
-#
-#     # Test case when discard_embeddings is False
-#     discard_embeddings = False
-#     filtered_scores, filtered_tags, filtered_embeddings = get_filtered_annotations(
-#         hit_indices, hit_scores, threshold, discard_embeddings, mock_ss
-#     )
-#
-#     # Assertions when embeddings are not discarded
-#     assert filtered_scores == expected_filtered_scores
-#     assert filtered_tags == expected_filtered_tags
-#
-#     # Test case when discard_embeddings is True
-#     discard_embeddings = True
-#     _, _, filtered_embeddings_discard = get_filtered_annotations(
-#         hit_indices, hit_scores, threshold, discard_embeddings, mock_ss
-#     )
-#
-#     # Assertions when embeddings are discarded
-#     assert filtered_embeddings_discard == [], "Embeddings were not discarded as expected"
-#
-#
+@pytest.fixture
+def hit_store(tmp_path):
+    tags = ["Tag0", "Tag1", "Tag2", "Tag3"]
+    embeddings = np.array([[0.0, 0.1], [0.1, 0.2], [0.3, 0.4], [0.5, 0.6]], dtype=np.float32)
+    return HitStore.write(tmp_path / "hit_store", [(tags, embeddings)], num_rows=4, dim=2)
+
+
+def test_get_filtered_annotations(hit_store):
+    search_results = SimpleNamespace(
+        total_scores=[np.array([0.95, 0.9, 0.85]), np.array([0.99, 0.5, 0.4]), np.array([0.8, 0.7, 0.6])],
+        total_indices=[np.array([2, 1, 3]), np.array([2, -1, 0]), np.array([0, 1, 2])],
+    )
+
+    filtered_scores, filtered_tags, filtered_embeddings = get_filtered_annotations(
+        search_results, threshold=0.9, discard_embeddings=False, hit_store=hit_store
+    )
+
+    # Only scores >= threshold survive, per query and in index order, and hits shared between queries repeat
+    assert filtered_scores == [pytest.approx([0.95, 0.9]), pytest.approx([0.99]), []]
+    assert filtered_tags == [["Tag2", "Tag1"], ["Tag2"], []]
+    assert np.allclose(filtered_embeddings[0], [[0.3, 0.4], [0.1, 0.2]])
+    assert np.allclose(filtered_embeddings[1], [[0.3, 0.4]])
+    assert len(filtered_embeddings[2]) == 0
+
+    # Padding from the index (-1) is dropped even when it clears the threshold
+    _, filtered_tags, filtered_embeddings = get_filtered_annotations(
+        search_results, threshold=0.0, discard_embeddings=True, hit_store=hit_store
+    )
+    assert filtered_tags[1] == ["Tag2", "Tag0"]
+    assert filtered_embeddings == [None, None, None], "Embeddings were not discarded as expected"
+
+
+def test_get_filtered_annotations_rejects_misaligned_results(hit_store):
+    search_results = SimpleNamespace(total_scores=[[0.9, 0.8]], total_indices=[[1]])
+    with pytest.raises(ValueError):
+        get_filtered_annotations(search_results, threshold=0.5, discard_embeddings=True, hit_store=hit_store)
+
+
+class FakeSimilaritySearch:
+    """Embeds a sequence as [len(sequence)] * 2 and hits the first top_k database rows"""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_pooled_embeddings(self, sequences):
+        return np.array([[len(sequence)] * 2 for sequence in sequences], dtype=np.float32)
+
+    def search(self, query_embedding, top_k):
+        self.batches.append(len(query_embedding))
+        total_scores = [np.linspace(1.0, 0.7, top_k) for _ in query_embedding]
+        total_indices = [np.arange(top_k) for _ in query_embedding]
+        return SimpleNamespace(total_scores=total_scores, total_indices=total_indices), query_embedding
+
+
+def stream_state(hit_store, max_queued_queries=2000):
+    ss = FakeSimilaritySearch()
+    executor = InferenceExecutor(max_queued_queries=max_queued_queries)
+    return SimpleNamespace(
+        ss=ss,
+        hit_store=hit_store,
+        inference_executor=executor,
+        embedding_cache=EmbeddingCache(max_bytes=1 << 20, model_name="fake"),
+        batcher=MicroBatcher(ss, executor, max_wait_ms=1),
+        similarity_log=SimilarityLog(),
+        user_quotas=UserQuotas(residues_per_second=1, burst_residues=50),
+    )
+
+
+def similarity_request(num_sequences):
+    return SimilarityRequest(
+        sequences=[{"id": f">Query{i}", "sequence": "M" * (i + 2)} for i in range(num_sequences)],
+        threshold=0.5,
+        max_hits=2,
+        discard_embeddings=False,
+    )
+
+
+def test_stream_similarity(hit_store):
+    state = stream_state(hit_store)
+
+    async def collect():
+        return [chunk async for chunk in stream_similarity(state, similarity_request(5), chunk_size=2)]
+
+    chunks = asyncio.run(collect())
+
+    # One chunk of lines per two queries, then the summary line
+    assert [chunk.count(b"\n") for chunk in chunks] == [2, 2, 1, 1]
+    assert max(state.ss.batches) <= 2
+    lines = [json.loads(line) for line in b"".join(chunks).splitlines()]
+    assert [line["QueryId"] for line in lines[:-1]] == [f">Query{i}" for i in range(5)]
+    assert [hit["HitID"] for hit in lines[0]["Hits"]] == ["Tag0", "Tag1"]
+    assert lines[4]["Embedding"] == [6.0, 6.0]
+    assert lines[-1]["summary"]["num_sequences"] == 5
+    assert lines[-1]["summary"]["response_size"] == 10
+    assert [(entry["sequences"], entry["hits"]) for entry in state.similarity_log.last(10)] == [(5, 10)]
+
+
+def test_stream_similarity_rejects_before_the_first_line(hit_store):
+    state = stream_state(hit_store, max_queued_queries=3)
+
+    async def first_line():
+        with state.inference_executor.admit(2):
+            return await stream_similarity(state, similarity_request(2), chunk_size=2).__anext__()
+
+    with pytest.raises(InferenceQueueFullError):
+        asyncio.run(first_line())
+
+
+def test_stream_similarity_charges_the_quota_of_the_caller(hit_store):
+    state = stream_state(hit_store)
+    caller = Caller("user:jdoe")
+
+    async def first_line():
+        return await stream_similarity(state, similarity_request(4), chunk_size=2, caller=caller).__anext__()
+
+    # 14 residues and 8 hits, twice
+    asyncio.run(first_line())
+    asyncio.run(first_line())
+    assert state.user_quotas.stats()["callers"] == 1
+    with pytest.raises(QuotaExceededError):
+        asyncio.run(first_line())
+    assert state.inference_executor.stats()["queued_queries"] == 0
+
+
+def caller_request(auth_client):
+    return SimpleNamespace(
+        client=SimpleNamespace(host="10.0.0.1"), app=SimpleNamespace(state=SimpleNamespace(auth_client=auth_client))
+    )
+
+
+class RejectingAuthClient:
+    async def get_user_auth_roles(self, token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+
+def test_get_caller_schedules_an_invalid_token_as_anonymous(monkeypatch):
+    monkeypatch.setattr(similarity.settings, "STRICT_CALLER_AUTH", False)
+    request = caller_request(RejectingAuthClient())
+
+    assert asyncio.run(get_caller(request, authorization="bad", kbase_session=None)).name == "anonymous:10.0.0.1"
+    assert asyncio.run(get_caller(request, authorization=None, kbase_session=None)).name == "anonymous:10.0.0.1"
+
+
+def test_get_caller_refuses_an_invalid_token_when_strict(monkeypatch):
+    monkeypatch.setattr(similarity.settings, "STRICT_CALLER_AUTH", True)
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(get_caller(caller_request(RejectingAuthClient()), authorization="bad", kbase_session=None))
+    assert e.value.status_code == 401
+
+
+def test_search_queries_embeds_the_normalized_sequence(hit_store):
+    state = stream_state(hit_store)
+
+    # The fake model embeds a sequence as its length: "mkt al" as typed would be 6
+    _, _, first = asyncio.run(search_queries(state, ["mkt al"], top_k=2))
+    _, _, second = asyncio.run(search_queries(state, ["MKTAL"], top_k=2))
+
+    assert first.tolist() == [[5.0, 5.0]]
+    assert second.tolist() == [[5.0, 5.0]]
+    assert state.embedding_cache.stats()["hits"] == 1
+
+
 # # def test_similarity_request_constraints():
 # #     # Test exceeding the maximum number of sequences per request
 # #     request_payload = {
@@ -0,0 +1,122 @@
+import json
+
+import numpy as np
+import pytest
+
+from src import build_index
+from src.build_index import assemble, build_shards, length_sorted_batches, read_shard
+
+EMBEDDED = []
+
+
+class CompositionEmbedder:
+    """Embeds a sequence as its length and amino acid counts, failing on sequences containing X when asked to"""
+
+    def __init__(self, fail_on_x=False):
+        self.fail_on_x = fail_on_x
+
+    def embed_pooled(self, sequences):
+        EMBEDDED.extend(sequences)
+        if self.fail_on_x and any("X" in sequence for sequence in sequences):
+            raise RuntimeError("worker crashed")
+        return np.array([[len(s) + 1, s.count("A"), s.count("C"), s.count("X")] for s in sequences], dtype=np.float32)
+
+
+def failing_embedder():
+    return CompositionEmbedder(fail_on_x=True)
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    rng = np.random.default_rng(0)
+    records = [(f"sp|P{i:03d}|TEST", "".join(rng.choice(list("ACDE"), rng.integers(5, 40)))) for i in range(23)]
+    # The fourth shard holds the sequence that crashes the failing embedder
+    records[16] = ("sp|P016|TEST", "AAXAA")
+    path = tmp_path / "db.fasta"
+    path.write_text("".join(f">{tag}\n{sequence}\n" for tag, sequence in records))
+    return path, records
+
+
+def test_length_sorted_batches_respect_the_token_budget():
+    sequences = ["A" * n for n in (30, 5, 12, 6, 31, 100)]
+
+    batches = length_sorted_batches(sequences, max_tokens=40, window_size=20, window_overlap=4)
+
+    assert batches == [[1, 3], [2], [0], [4], [5]]
+    assert sorted(i for batch in batches for i in batch) == list(range(len(sequences)))
+
+
+def test_interrupted_builds_resume_from_the_last_shard(tmp_path, fasta):
+    path, records = fasta
+    work_dir = tmp_path / "work"
+    settings = dict(embedder_name="composition", workers=0, shard_size=5, max_tokens=64, dtype="float32")
+
+    with pytest.raises(RuntimeError):
+        build_shards(path, work_dir, failing_embedder, **settings)
+    assert sorted(p.name for p in work_dir.glob("shard_*.npy")) == [f"shard_{i:05d}.npy" for i in range(3)]
+
+    EMBEDDED.clear()
+    num_shards = build_shards(path, work_dir, CompositionEmbedder, **settings)
+
+    # Only the unfinished shards were embedded again
+    assert num_shards == 5
+    assert sorted(EMBEDDED) == sorted(sequence for _, sequence in records[15:])
+    tags, embeddings = zip(*(read_shard(work_dir, shard) for shard in range(num_shards)))
+    assert [tag for shard_tags in tags for tag in shard_tags] == [tag for tag, _ in records]
+    raw = np.array([[len(s) + 1, s.count("A"), s.count("C"), s.count("X")] for _, s in records], dtype=np.float32)
+    # Unit vectors, in FASTA order whatever the batching
+    assert np.allclose(np.concatenate(embeddings), raw / np.linalg.norm(raw, axis=1, keepdims=True))
+
+    with pytest.raises(SystemExit):
+        build_shards(path, work_dir, CompositionEmbedder, **(settings | {"embedder_name": "another model"}))
+
+
+def test_worker_processes_embed_the_shards(tmp_path, fasta):
+    path, records = fasta
+    build_shards(path, tmp_path / "work", CompositionEmbedder, "composition", workers=2, shard_size=10, max_tokens=64)
+
+    tags, embeddings = read_shard(tmp_path / "work", 2)
+    assert tags == [tag for tag, _ in records[20:]]
+    assert embeddings.dtype == np.float16 and embeddings.shape == (3, 4)
+
+
+def test_a_lowercase_fasta_is_embedded_and_indexed_like_the_queries(tmp_path, fasta):
+    path, records = fasta
+    path.write_text("".join(f">{tag}\n{sequence.lower()}\n" for tag, sequence in records))
+    work_dir = tmp_path / "work"
+    EMBEDDED.clear()
+    num_shards = build_shards(path, work_dir, CompositionEmbedder, "composition", workers=0, shard_size=10)
+    shards = [read_shard(work_dir, shard) for shard in range(num_shards)]
+    hit_store = build_index.HitStore.write(tmp_path / "db.hitstore", shards, num_rows=len(records), dim=4)
+    build_index.write_sequence_index(work_dir, num_shards, tmp_path / "db.sequences", len(records))
+
+    sequence_index = build_index.SequenceIndex(tmp_path / "db.sequences", hit_store)
+
+    assert sorted(EMBEDDED) == sorted(sequence for _, sequence in records)
+    assert sequence_index.lookup([records[5][1], records[5][1].lower()]).tolist() == [5, 5]
+
+
+def test_assemble_writes_the_dataset_the_service_loads(tmp_path, fasta):
+    pytest.importorskip("datasets")
+    faiss = pytest.importorskip("faiss")
+    path, records = fasta
+    work_dir = tmp_path / "work"
+    num_shards = build_shards(path, work_dir, CompositionEmbedder, "composition", workers=0, shard_size=10)
+    output = tmp_path / "db_esm_faiss"
+
+    outputs = assemble(work_dir, output, num_shards, "float16", index_engines=["hnsw"], hnsw_m=8)
+
+    from datasets import load_from_disk
+
+    dataset = load_from_disk(str(output))
+    assert dataset["tags"] == [tag for tag, _ in records]
+    index = faiss.read_index(outputs["flat_index"])
+    scores, indices = index.search(np.asarray(dataset["embeddings"][:3], dtype=np.float32), 1)
+    assert indices[:, 0].tolist() == [0, 1, 2]
+    assert build_index.HitStore(outputs["hit_store"]).get_tags(np.array([22])) == [records[22][0]]
+    assert len(list((tmp_path / "db_esm_faiss.indexes").glob("HNSW8_Flat.faiss"))) == 1
+    sequence_index = build_index.SequenceIndex(outputs["sequence_index"], build_index.HitStore(outputs["hit_store"]))
+    assert sequence_index.lookup([records[5][1], "ACDEACDE" * 10]).tolist() == [5, -1]
+    raw = np.array([[len(s) + 1, s.count("A"), s.count("C"), s.count("X")] for s in (records[5][1],)])
+    assert np.allclose(sequence_index.embeddings([records[5][1]])[0], raw[0], rtol=1e-2)
+    assert outputs["num_rows"] == 23 and json.dumps(outputs)